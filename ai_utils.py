@@ -10,88 +10,443 @@ run in environments where the model server is not present.
 from __future__ import annotations
 
 import base64
+import json
 import os
 import re
-from typing import Dict
-
-import requests
+import tempfile
+import threading
+import time
+from concurrent.futures import CancelledError
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterator, Optional
 
 from config import CONFIG
+from inference_scheduler import scheduler
+from log_utils import get_logger
+from metrics import incr, observe
+from parsing_utils import parse_title
+
+logger = get_logger("ai_utils")
 
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+# Seconds to connect, and to wait for each streamed chunk (not the whole
+# generation, which may legitimately take much longer).
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_READ_TIMEOUT = 60
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, float] = {
+    "generations": 0, "cancelled": 0, "failed": 0,
+    "ttft_ms": 0.0, "tokens": 0, "eval_seconds": 0.0,
+}
+_last_generation: Dict[str, Any] = {}
+
+
+def _allowed_image_path(image_path: str) -> Path | None:
+    """Resolve *image_path* if it lies inside the app folder or the system
+    temp folder (where Gradio stores uploads); otherwise return ``None``."""
+    safe_path = Path(image_path).resolve()
+    roots = (Path(__file__).resolve().parent, Path(tempfile.gettempdir()).resolve())
+    if any(root == safe_path or root in safe_path.parents for root in roots):
+        return safe_path
+    return None
+
+
+def _record(stats: Dict[str, Any]) -> None:
+    if not stats["cancelled"]:
+        observe("ollama_generation", stats["elapsed_ms"])
+        if stats["ttft_ms"] is not None:
+            observe("ollama_ttft", stats["ttft_ms"])
+    with _stats_lock:
+        _last_generation.clear()
+        _last_generation.update(stats)
+        if stats["cancelled"]:
+            _stats["cancelled"] += 1
+            return
+        _stats["generations"] += 1
+        _stats["ttft_ms"] += stats["ttft_ms"] or 0.0
+        _stats["tokens"] += stats["tokens"]
+        _stats["eval_seconds"] += stats["eval_seconds"]
+
+
+def generation_stats() -> Dict[str, Any]:
+    """Return streaming metrics since process start.
+
+    ``avg_ttft_ms`` is the mean time to first token of completed
+    generations and ``tokens_per_sec`` their overall decode rate; ``last``
+    holds the figures of the most recent generation.
+    """
+    with _stats_lock:
+        done = _stats["generations"]
+        return {
+            "generations": int(done),
+            "cancelled": int(_stats["cancelled"]),
+            "failed": int(_stats["failed"]),
+            "avg_ttft_ms": round(_stats["ttft_ms"] / done, 1) if done else 0.0,
+            "tokens_per_sec": (
+                round(_stats["tokens"] / _stats["eval_seconds"], 1)
+                if _stats["eval_seconds"] else 0.0
+            ),
+            "last": dict(_last_generation),
+        }
+
+
+def reset_generation_stats() -> None:
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+        _last_generation.clear()
+
 
+def stream_ollama_vision(
+    image_path: str,
+    prompt: str,
+    cancel: Optional[threading.Event] = None,
+    response_format: Optional[str] = None,
+    priority: str = "interactive",
+    owner: Optional[Hashable] = None,
+) -> Iterator[str]:
+    """Yield response text from the Ollama vision endpoint as it streams.
 
-def _query_ollama_vision(image_path: str, prompt: str) -> str | None:
+    Generation stops, and the HTTP connection is closed so Ollama abandons
+    it, as soon as *cancel* is set or the caller closes the generator.
+    Timing is recorded for :func:`generation_stats`.  Raises ``ValueError``
+    for paths outside the allowed folders and ``requests`` errors when the
+    server cannot be reached.  ``response_format="json"`` makes Ollama
+    constrain its output to JSON.
+
+    The call first waits for a slot from
+    :data:`inference_scheduler.scheduler` in the *priority* class; setting
+    *cancel* while it waits raises ``concurrent.futures.CancelledError``.
+    """
+    import requests
+
+    safe_path = _allowed_image_path(image_path)
+    if safe_path is None:
+        raise ValueError(f"Image path not allowed: {image_path}")
+    with safe_path.open("rb") as f:
+        b64 = base64.b64encode(f.read()).decode()
+    payload = {
+        "model": CONFIG.get("ai_model", "phi3"),
+        "prompt": prompt,
+        "images": [b64],
+        "stream": True,
+    }
+    if response_format:
+        payload["format"] = response_format
+    # Queue time is the scheduler's to report; TTFT starts at the grant.
+    with scheduler.slot(priority, owner, cancel) as ticket:
+        stats: Dict[str, Any] = {
+            "ttft_ms": None, "tokens": 0, "eval_seconds": 0.0, "cancelled": True,
+        }
+        start = time.perf_counter()
+        first = None
+        failed = False
+        try:
+            with requests.post(
+                f"{OLLAMA_URL}/api/generate",
+                json=payload,
+                stream=True,
+                timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
+            ) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    if ticket.cancelled:
+                        return
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise RuntimeError(chunk["error"])
+                    piece = chunk.get("response", "")
+                    if piece:
+                        if first is None:
+                            first = time.perf_counter()
+                            stats["ttft_ms"] = round((first - start) * 1000, 1)
+                        stats["tokens"] += 1
+                        yield piece
+                    if chunk.get("done"):
+                        # Ollama reports exact token counts; fall back to our
+                        # own chunk count and wall clock otherwise.
+                        if chunk.get("eval_count") and chunk.get("eval_duration"):
+                            stats["tokens"] = chunk["eval_count"]
+                            stats["eval_seconds"] = chunk["eval_duration"] / 1e9
+                        elif first is not None:
+                            stats["eval_seconds"] = time.perf_counter() - first
+                        stats["cancelled"] = False
+                        break
+        except Exception:
+            failed = True
+            incr("errors", stage="ollama_generation")
+            with _stats_lock:
+                _stats["failed"] += 1
+            raise
+        finally:
+            # Also reached via GeneratorExit when the consumer stops early.
+            if not failed:
+                stats["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                stats["tokens_per_sec"] = (
+                    round(stats["tokens"] / stats["eval_seconds"], 1)
+                    if stats["eval_seconds"] else 0.0
+                )
+                _record(stats)
+
+
+def _query_ollama_vision(
+    image_path: str,
+    prompt: str,
+    response_format: Optional[str] = None,
+    priority: str = "interactive",
+) -> str | None:
     """Send *image_path* to the local Ollama vision endpoint.
 
     Returns the textual response or ``None`` if the request fails.
     """
     try:
-        safe_path = os.path.abspath(
-Returns the textual response or ``None`` if the request fails.
+        return "".join(stream_ollama_vision(
+            image_path, prompt, response_format=response_format, priority=priority
+        )).strip()
+    except Exception:
+        return None
+
+
+# Stamp columns the model can read off the image, with the rules each
+# value must satisfy.  Listing and sale columns are left to the user.
+METADATA_SCHEMA: Dict[str, Dict[str, Any]] = {
+    "stamp_name": {},
+    "country": {},
+    "denomination": {"pattern": r"\d"},
+    "year": {"pattern": r"(18|19|20)\d{2}"},
+    "catalog_number": {},
+    "color": {},
+    "perforation": {},
+    "format": {"enum": ["Single", "Pair", "Strip", "Block", "Sheet"]},
+    "mint_used": {"enum": ["Mint", "Used"]},
+    "description": {},
+}
+METADATA_FIELDS = tuple(METADATA_SCHEMA)
+
+# Keys models tend to use instead of ours.
+METADATA_ALIASES = {
+    "name": "stamp_name", "title": "stamp_name", "subject": "stamp_name",
+    "catalogue_number": "catalog_number", "catalog": "catalog_number",
+    "catalog_no": "catalog_number", "scott": "catalog_number",
+    "scott_number": "catalog_number", "colour": "color", "colors": "color",
+    "face_value": "denomination", "value": "denomination",
+    "issue_year": "year", "date": "year", "perf": "perforation",
+    "perforations": "perforation", "condition": "mint_used",
+    "mint_or_used": "mint_used", "type": "format",
+}
+# Lower-case answers mapped onto the ``enum`` values above.
+ENUM_SYNONYMS = {
+    "unused": "Mint", "mnh": "Mint", "mh": "Mint", "mint never hinged": "Mint",
+    "cancelled": "Used", "canceled": "Used", "postmarked": "Used", "cto": "Used",
+    "block of four": "Block", "souvenir sheet": "Sheet", "single stamp": "Single",
+}
+_EMPTY_VALUES = {"", "unknown", "n/a", "na", "none", "null", "-", "?"}
+
+METADATA_PROMPT = (
+    "You are cataloguing a postage stamp. Reply with a single JSON object "
+    "with these string keys: " + ", ".join(METADATA_FIELDS) + ". "
+    "year is the four-digit issue year, denomination the printed face value "
+    "with its unit (e.g. \"5c\"), format one of Single, Pair, Strip, Block, "
+    "Sheet, and mint_used either Mint or Used. description is one line about "
+    "the design. Use \"\" for anything you cannot read."
+)
+
+
+def repair_json(text: str) -> Dict[str, Any]:
+    """Parse a JSON object from model output, repairing common damage.
+
+    Code fences and chatter around the object are dropped, a response cut
+    off mid-way is closed (unterminated string, dangling key, missing
+    brackets) and trailing commas are removed.  If the text still does not
+    parse, flat ``"key": value`` pairs are salvaged.  Returns ``{}`` when
+    nothing usable is found.
     """
+    if not text:
+        return {}
+    begin = text.find("{")
+    if begin < 0:
+        return {}
+    text = text[begin:]
     try:
-        # Import pathlib for secure path handling
-        from pathlib import Path
-
-        base_dir = Path(__file__).parent
-        safe_path = (base_dir / image_path).resolve()
-        if base_dir not in safe_path.parents:
-            return None  # Path is outside the allowed directory
-        with safe_path.open("rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-        payload = {
-            "model": CONFIG.get("ai_model", "phi3"),
-        )
-        if not safe_path.startswith(os.path.dirname(__file__)):
-            return None  # Path is outside the allowed directory
-        with open(safe_path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-        payload = {
-            "model": CONFIG.get("ai_model", "phi3"),
-            "prompt": prompt,
-            "images": [b64],
-        }
-        resp = requests.post(
-            f"{OLLAMA_URL}/api/generate", json=payload, timeout=60
-        )
-        if resp.status_code == 200:
-            return resp.json().get("response", "").strip()
-    except Exception:
+        data = json.JSONDecoder().raw_decode(text)[0]
+        return data if isinstance(data, dict) else {}
+    except ValueError:
         pass
-    return None
+
+    stack = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    fixed = text.rstrip("`\n ")
+    if in_string:
+        fixed = fixed.rstrip("\\") + '"'
+    if stack and stack[-1] == "}":
+        # A key that never got its value: drop it with its comma.
+        fixed = re.sub(r'[,{]\s*"[^"]*"\s*:?\s*$', lambda m: m.group(0)[0], fixed)
+    fixed = re.sub(r"[,:]\s*$", "", fixed) + "".join(reversed(stack))
+    fixed = re.sub(r",\s*([}\]])", r"\1", fixed)
+    try:
+        data = json.loads(fixed)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
+    pairs = re.findall(r'"([^"]+)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?)', text)
+    return {key: json.loads(value) for key, value in pairs}
 
 
-def generate_metadata(image_path: str) -> Dict[str, str]:
-    """Return a dictionary with AI generated metadata for *image_path*.
+def _metadata_value(value: Any) -> str:
+    if isinstance(value, bool) or value is None or isinstance(value, dict):
+        return ""
+    if isinstance(value, (list, tuple)):
+        return ", ".join(_metadata_value(v) for v in value if _metadata_value(v))
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = " ".join(str(value).split())
+    return "" if text.lower() in _EMPTY_VALUES else text
 
-    The function attempts to query Ollama.  If the model is unavailable a
-    deterministic fallback is returned so that unit tests can run without
-    external dependencies.
+
+def validate_metadata(data: Dict[str, Any]) -> Dict[str, str]:
+    """Check model output against :data:`METADATA_SCHEMA`.
+
+    Keys are normalised (case, spaces, known aliases), values coerced to
+    strings, and values that break a field's rule are blanked.  Year,
+    country and denomination still missing are then recovered from the
+    description with :func:`parsing_utils.parse_title`.  Every field in
+    :data:`METADATA_FIELDS` is present in the result.
     """
-    prompt = "Identify the stamp's country and denomination"
-    response = _query_ollama_vision(image_path, prompt)
-    if not response:
-        # Fallback deterministic values based on file name to make tests stable
-        name = os.path.splitext(os.path.basename(image_path))[0]
-        return {
-            "name": name,
-            "country": "Unknown",
-            "denomination": "",
-            "description": f"Stamp from {name}",
-        }
+    metadata = {field: "" for field in METADATA_FIELDS}
+    for key, value in (data or {}).items():
+        key = re.sub(r"[^a-z0-9]+", "_", str(key).lower()).strip("_")
+        key = METADATA_ALIASES.get(key, key)
+        rule = METADATA_SCHEMA.get(key)
+        if rule is None or metadata[key]:
+            continue
+        text = _metadata_value(value)
+        if text and "enum" in rule:
+            lowered = text.lower()
+            text = ENUM_SYNONYMS.get(lowered) or next(
+                (v for v in rule["enum"] if lowered.startswith(v.lower())), ""
+            )
+        elif text and "pattern" in rule:
+            match = re.search(rule["pattern"], text)
+            if not match:
+                text = ""
+            elif key == "year":
+                text = match.group(0)
+        metadata[key] = text
 
-    metadata = {
-        "name": "",
-        "country": "Unknown",
-        "denomination": "",
-        "description": response,
-    }
-    m = re.search(r"(18|19|20)\d{2}", response)
-    if m:
-        metadata["year"] = m.group(0)
-    for word in ["USA", "Germany", "France", "UK", "Canada", "Japan", "Italy"]:
-        if word.lower() in response.lower():
-            metadata["country"] = word
-            break
+    missing = [f for f in ("year", "country", "denomination") if not metadata[f]]
+    if missing and metadata["description"]:
+        year, country, denomination = parse_title(metadata["description"])
+        found = {"year": year, "country": country, "denomination": denomination}
+        for field in missing:
+            metadata[field] = found[field]
+    return metadata
+
+
+def generate_metadata(image_path: str, priority: str = "interactive") -> Dict[str, str]:
+    """Return catalogue fields for the stamp in *image_path*.
+
+    One JSON-mode call to the vision model fills every field in
+    :data:`METADATA_FIELDS`; the reply is repaired and validated locally
+    rather than re-queried.  If the model is unavailable every field is
+    blank except a file-name based ``stamp_name`` and ``description``, so
+    unit tests can run without external dependencies.
+    """
+    response = _query_ollama_vision(
+        image_path, METADATA_PROMPT, response_format="json", priority=priority
+    )
+    data = repair_json(response or "")
+    if not data and response:
+        data = {"description": response}  # ignored the format: keep the text
+    metadata = validate_metadata(data)
+    if not data:
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        metadata.update(stamp_name=name, description=f"Stamp from {name}")
     return metadata
+
+
+DESCRIPTION_PROMPT = (
+    "Describe this postage stamp in one line: country, year, "
+    "denomination and subject."
+)
+
+
+def _settled_fields(text: str) -> Dict[str, str]:
+    """Parse the complete words of partial model output.
+
+    The last word may still be growing ("Can" -> "Canada"), so it is left
+    out until whitespace or punctuation follows it.
+    """
+    cut = max(text.rfind(ch) for ch in " \n\t,.;:")
+    if cut < 0:
+        return {}
+    year, country, denomination = parse_title(text[:cut])
+    fields = {"year": year, "country": country, "denomination": denomination}
+    return {key: value for key, value in fields.items() if value}
+
+
+def stream_description(
+    image_path: str,
+    cancel: Optional[threading.Event] = None,
+    priority: str = "interactive",
+) -> Iterator[Dict[str, Any]]:
+    """Describe *image_path* progressively.
+
+    Yields ``{"text", "fields", "done"}`` as tokens arrive, where
+    ``fields`` holds the year, country and denomination found in the text
+    so far.  When the model cannot be reached a single ``done`` update with
+    the same fallback as :func:`generate_description` is yielded.
+    """
+    text = ""
+    fields: Dict[str, str] = {}
+    try:
+        for piece in stream_ollama_vision(
+            image_path, DESCRIPTION_PROMPT, cancel, priority=priority
+        ):
+            text += piece
+            fields = _settled_fields(text) or fields
+            yield {"text": text, "fields": fields, "done": False}
+    except CancelledError:
+        return
+    except Exception as e:
+        logger.warning("⚠️ Vision model unavailable: %s", e)
+    if cancel is not None and cancel.is_set():
+        return
+    text = text.strip()
+    if not text:
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        yield {"text": f"Stamp from {name}", "fields": {}, "done": True}
+        return
+    year, country, denomination = parse_title(text)
+    fields = {"year": year, "country": country, "denomination": denomination}
+    yield {"text": text, "fields": {k: v for k, v in fields.items() if v}, "done": True}
+
+
+def generate_description(image_path: str, priority: str = "interactive") -> str:
+    """Return a one-line description of the stamp in *image_path*.
+
+    The text names country, denomination and year where the model can tell,
+    so it can be fed to :func:`parsing_utils.parse_title`.
+    """
+    response = _query_ollama_vision(image_path, DESCRIPTION_PROMPT, priority=priority)
+    if response:
+        return response
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    return f"Stamp from {name}"
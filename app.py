@@ -1,11 +1,23 @@
 import os
-import requests
-from PIL import Image
+import time
 import gradio as gr
-from config import IMAGES_DIR, TINEYE_API_URL, TINEYE_API_KEY
-from db import Session, Stamp
-from image_utils import enhance_and_crop
-from ai_utils import generate_description
+from config import IMAGES_DIR, settings
+from db import LEAK_AGE, Session, Stamp, init_db, report_open_sessions, session_scope
+from image_utils import enhance_and_crop, get_file_hash
+from ai_utils import generation_stats, stream_description
+from metadata_resolver import DETAIL_FIELDS, resolver_stats
+import job_queue
+import maintenance
+from changes import changes_since, new_token
+from facets import FACETS, facet_counts
+from gallery import TAG_MODES, search_stamps, tag_counts
+from query_cache import cached_query, gallery_cache, invalidates
+import metrics
+from metrics import timed
+import profiling
+from profiling import profiled
+from log_utils import setup_logging, with_request_id
+from inference_scheduler import scheduler_stats
 
 def save_image(file, upload_dir=IMAGES_DIR):
     filename = os.path.join(upload_dir, os.path.basename(file.name))
@@ -13,38 +25,389 @@ def save_image(file, upload_dir=IMAGES_DIR):
     return filename
 
 def reverse_image_lookup(image_path):
-    if not image_path or not os.path.exists(image_path):
-        return "❌ No valid image found."
+    """Identify *image_path* against local sources (remote only as fallback)."""
+    from reverse_search import format_lookup, reverse_lookup
 
-    # Primary: TinEye reverse image search
     try:
-        with open(image_path, "rb") as image_file:
-            response = requests.post(
-                TINEYE_API_URL,
-                auth=(TINEYE_API_KEY, ""),
-                files={"image": image_file}
-            )
-        if response.status_code == 200:
-            results = response.json().get("results", [])
-            if results:
-                return results
-    except Exception as e:
-        print(f"Tineye lookup failed: {e}")
-
-    # Fallback: Google Images reverse search
-    try:
-        encoded_filename = os.path.basename(image_path).replace(" ", "+")
-        fallback_url = f"https://images.google.com/searchbyimage?image_url={encoded_filename}"
-        return f"🔍 No TinEye match. Try Google Images:\n{fallback_url}"
+        return format_lookup(reverse_lookup(image_path))
+    except ValueError as e:
+        return f"❌ {e}"
     except Exception as e:
         return f"⚠️ Reverse lookup failed: {str(e)}"
 
+def _stream_progress(update):
+    """One-line status for a :func:`ai_utils.stream_description` update."""
+    found = " · ".join(f"{k.title()}: {v}" for k, v in update["fields"].items())
+    state = "✅ Done" if update["done"] else "⏳ Describing…"
+    return f"{state}  {found}".rstrip()
+
+@with_request_id
+@profiled()
 def enhance_and_classify(file):
+    """Stream the lookup: local matches first, then the model's description
+    token by token, with fields shown as soon as they can be read."""
     image_path = save_image(file)
     enhanced_path = enhance_and_crop(image_path)
-    description = generate_description(enhanced_path)
     reverse_results = reverse_image_lookup(enhanced_path)
-    return enhanced_path, description, reverse_results
+    yield enhanced_path, "", "⏳ Waiting for the vision model…", reverse_results
+    # Gradio closes this generator when the event is cancelled, which closes
+    # the connection and stops the generation in Ollama.
+    for update in stream_description(enhanced_path):
+        yield enhanced_path, update["text"], _stream_progress(update), reverse_results
+
+def facet_choices():
+    """Return dropdown choices ``[("USA (12)", "USA"), ...]`` per facet."""
+    counts = facet_counts()
+    return {
+        facet: [(f"{value} ({count})", value) for value, count in counts[facet]]
+        for facet in FACETS
+    }
+
+def gallery_row(s):
+    return [s.id, s.country, s.denomination, s.year, s.notes]
+
+def _browse_filters(selected):
+    """Build search filters from the facet dropdowns, tag picker and tag mode."""
+    *facet_values, tags, tag_mode = selected
+    filters = {facet: value for facet, value in zip(FACETS, facet_values) if value}
+    if tags:
+        filters["tags"] = list(tags)
+        filters["tag_mode"] = tag_mode or "any"
+    return filters
+
+def _gallery_outputs(view):
+    rows = [view["rows"][sid] for sid in sorted(view["rows"])]
+    choices = facet_choices()
+    updates = [gr.update(choices=choices[facet]) for facet in FACETS]
+    tag_choices = [(f"{name} ({count})", name) for name, count in tag_counts()]
+    return (rows, view, *updates, gr.update(choices=tag_choices))
+
+@with_request_id
+@profiled()
+@timed("gallery_load")
+def browse_gallery(*selected):
+    """Load every stamp matching the selected facet values and tags."""
+    filters = _browse_filters(selected)
+    token = new_token()
+    rows = {s.id: gallery_row(s) for s in search_stamps("", filters)}
+    return _gallery_outputs({"token": token, "filters": filters, "rows": rows})
+
+@with_request_id
+@profiled()
+@timed("gallery_refresh")
+def refresh_gallery(view, *selected):
+    """Patch the loaded rows with the changes since the last load.
+
+    Only stamps reported by the change feed are re-queried, so the cost of
+    a refresh follows the number of edits rather than the collection size.
+    """
+    filters = _browse_filters(selected)
+    if not view or view.get("filters") != filters:
+        return browse_gallery(*selected)
+    feed = changes_since(view["token"])
+    if feed["reset"]:
+        return browse_gallery(*selected)
+
+    rows = dict(view["rows"])
+    for sid in feed["deleted"]:
+        rows.pop(sid, None)
+    changed = [s.id for s in feed["inserted"] + feed["updated"]]
+    if changed:
+        for sid in changed:
+            rows.pop(sid, None)
+        for s in search_stamps.uncached("", {**filters, "ids": changed}):
+            rows[s.id] = gallery_row(s)
+    return _gallery_outputs({"token": feed["token"], "filters": filters, "rows": rows})
+
+@cached_query(
+    "load_stamp_details",
+    lambda stamp_id: {"stamps", f"stamp:{int(stamp_id)}"},
+    key=lambda stamp_id: int(stamp_id),
+)
+def load_stamp_details(stamp_id):
+    with session_scope(Session, read_only=True) as session:
+        s = session.get(Stamp, int(stamp_id))
+        if s:
+            return s.id, s.image_path, s.country, s.denomination, s.year, s.notes
+        return "", None, "", "", "", ""
+
+@invalidates(lambda stamp_id, *fields: {"stamps", f"stamp:{int(stamp_id)}"})
+@with_request_id
+@profiled()
+def update_stamp_details(stamp_id, country, denom, year, notes):
+    try:
+        with session_scope(Session) as session:
+            s = session.get(Stamp, int(stamp_id))
+            if not s:
+                return "❌ Stamp not found."
+            s.country = country
+            s.denomination = denom
+            s.year = year
+            s.notes = notes
+        return f"✅ Updated {stamp_id} with new details."
+    except Exception as e:
+        return f"❌ Update failed: {e}"
+
+def on_gallery_table_select(evt: gr.SelectData, table):
+    """Load the stamp whose row was clicked in the gallery table."""
+    row = evt.index[0]
+    return load_stamp_details(table.iloc[row, 0])
+
+# Stamp columns shown between the image path and the notes in the preview.
+PREVIEW_FIELDS = ("country", "denomination", "year", *DETAIL_FIELDS)
+PREVIEW_HEADERS = [
+    "Image Path", "Country", "Denomination", "Year", "Name", "Catalog #",
+    "Color", "Perforation", "Format", "Mint/Used", "Notes",
+]
+
+def _error_row(image_path, message):
+    return [image_path, "Unknown", *[""] * (len(PREVIEW_FIELDS) - 1), f"Error: {message}"]
+
+def _preview_row(image_path, resolved, source_note=""):
+    if not resolved:
+        return _error_row(image_path, "metadata could not be resolved")
+    notes = (
+        f"{resolved['description']}\n"
+        f"[{resolved['tier']}, confidence {resolved['confidence']:.2f}]"
+    )
+    if source_note:
+        notes += f"\n{source_note}"
+    return [image_path, *(resolved[field] for field in PREVIEW_FIELDS), notes]
+
+# Seconds a multi-file preview may sit in the queue before a worker takes it.
+PREVIEW_TIMEOUT = 120
+# Seconds between progress polls of a queued preview or scan.
+SCAN_POLL_INTERVAL = 1.0
+
+def _pending_rows(paths, message):
+    return [[path, *[""] * len(PREVIEW_FIELDS), message] for path in paths]
+
+@with_request_id
+@profiled()
+def preview_upload(files, split_sheets=False):
+    """Preview uploaded files with resolved metadata.
+
+    With *split_sheets*, each file is treated as a page scan and every stamp
+    found on it becomes its own row; files with no detectable stamps are
+    previewed whole.  Metadata comes from the tiered resolver, so only
+    images nothing cheaper can identify are sent to the AI model.  A single
+    image is previewed right here, ahead of any batch work; several run in
+    a ``preview`` worker and this handler yields placeholder rows with the
+    worker's progress until it finishes.
+    """
+    paths = [file.name for file in files or []]
+    if not paths:
+        yield []
+        return
+    if len(paths) == 1:
+        from worker_pool import preview_images
+
+        try:
+            result = preview_images(paths, bool(split_sheets), priority="interactive")
+        except Exception as e:
+            yield [_error_row(paths[0], e)]
+            return
+    else:
+        job_id = job_queue.enqueue(
+            "preview", {"paths": paths, "split_sheets": bool(split_sheets)}, priority="batch"
+        )
+        deadline = time.monotonic() + PREVIEW_TIMEOUT
+        while True:
+            job = job_queue.get_job(job_id)
+            if job["status"] in ("done", "failed"):
+                break
+            if job["status"] == "queued" and time.monotonic() >= deadline:
+                job = dict(job, error=job["error"] or "no preview worker picked up the upload")
+                break
+            if job["progress"]:
+                message = f"⏳ Resolving {job['progress']['images']} images…"
+            else:
+                message = "⏳ Waiting for a preview worker…"
+            yield _pending_rows(paths, message)
+            time.sleep(SCAN_POLL_INTERVAL)
+        if job["status"] != "done":
+            yield [_error_row(path, job["error"]) for path in paths]
+            return
+        result = job["result"]
+    resolved = result["resolved"]
+    yield [_preview_row(path, resolved.get(path), note) for path, note in result["images"]]
+
+@invalidates(lambda preview_data: {"stamps"})
+@with_request_id
+@profiled()
+def save_uploads(preview_data):
+    """Save previewed uploads to the database, skipping duplicate files."""
+    rows = preview_data.values.tolist() if hasattr(preview_data, "values") else preview_data
+    if not rows:
+        return "❌ No data to save"
+    try:
+        saved = []
+        with session_scope(Session) as session:
+            for image_path, *values, notes in rows:
+                if not image_path:
+                    continue
+                file_hash = get_file_hash(image_path)
+                if file_hash and session.query(Stamp.id).filter_by(file_hash=file_hash).first():
+                    continue
+                session.add(Stamp(
+                    image_path=image_path,
+                    file_hash=file_hash,
+                    notes=notes,
+                    **dict(zip(PREVIEW_FIELDS, values)),
+                ))
+                saved.append((file_hash, image_path))
+        if saved:
+            job_queue.enqueue("index", {"images": saved}, priority="backfill")
+        return f"✅ Saved {len(saved)} stamps to database"
+    except Exception as e:
+        return f"❌ Save failed: {e}"
+
+@with_request_id
+@profiled()
+def find_similar_stamps(stamp_id):
+    """Return gallery items ``(image_path, caption)`` for stamps that look
+    like *stamp_id*, most similar first."""
+    if not stamp_id:
+        return []
+    from embedding_index import find_similar
+
+    try:
+        matches = find_similar(stamp_id=int(stamp_id), k=12)
+    except ValueError as e:
+        gr.Warning(str(e))
+        return []
+    with session_scope(Session, read_only=True) as session:
+        stamps = {s.id: s for s in session.query(Stamp).filter(Stamp.id.in_([m[0] for m in matches]))}
+    return [
+        (stamps[sid].image_path, f"#{sid} {stamps[sid].country or ''} ({score:.2f})")
+        for sid, score in matches
+        if stamps[sid].image_path and os.path.exists(stamps[sid].image_path)
+    ]
+
+def scan_job_rows():
+    import scan_jobs
+
+    return [
+        [job["id"], job["name"], job["status"], job["total"],
+         job["counts"]["done"], job["counts"]["review"], job["counts"]["duplicate"],
+         job["counts"]["failed"]]
+        for job in scan_jobs.list_jobs()
+    ]
+
+def _follow_scan(queue_id):
+    """Yield ``(progress, job rows)`` while a ``scan`` worker runs the job.
+
+    Closing the page only stops the polling; the scan carries on.
+    """
+    import scan_jobs
+
+    while True:
+        job = job_queue.get_job(queue_id)
+        status = job["result"] or job["progress"]
+        if job["status"] == "failed":
+            text = f"❌ Scan failed: {job['error']}"
+        elif status:
+            text = scan_jobs.format_job(status)
+        else:
+            text = "⏳ Waiting for a scan worker…"
+        yield text, scan_job_rows()
+        if job["status"] in ("done", "failed"):
+            return
+        time.sleep(SCAN_POLL_INTERVAL)
+
+@with_request_id
+@profiled()
+def start_scan(files, split):
+    if not files:
+        yield "❌ No files selected", scan_job_rows()
+        return
+    queue_id = job_queue.enqueue(
+        "scan", {"paths": [f.name for f in files], "split_sheets": bool(split)}
+    )
+    yield from _follow_scan(queue_id)
+
+@with_request_id
+@profiled()
+def resume_scan(job_id):
+    import scan_jobs
+
+    if not job_id:
+        yield "❌ Select a job first", scan_job_rows()
+        return
+    try:
+        # A job left running by a runner that died can be resumed; one
+        # whose runner still holds its lease cannot.
+        scan_jobs.recover_jobs(int(job_id))
+        status = scan_jobs.job_status(int(job_id))
+    except ValueError as e:
+        yield f"❌ {e}", scan_job_rows()
+        return
+    if status["status"] == "running":
+        yield f"❌ Job #{status['id']} is already running", scan_job_rows()
+        return
+    yield from _follow_scan(job_queue.enqueue("scan", {"job_id": status["id"]}))
+
+@with_request_id
+@profiled()
+def pause_scan(job_id):
+    import scan_jobs
+
+    if job_id and scan_jobs.pause_job(int(job_id)):
+        return f"⏸ Job #{int(job_id)} will pause after the current chunk", scan_job_rows()
+    return "❌ That job is not running", scan_job_rows()
+
+@with_request_id
+@profiled()
+def retry_scan(job_id):
+    import scan_jobs
+
+    if not job_id:
+        yield "❌ Select a job first", scan_job_rows()
+        return
+    count = scan_jobs.retry_failed(int(job_id))
+    if not count:
+        yield "✅ Nothing to retry", scan_job_rows()
+        return
+    yield from resume_scan(job_id)
+
+def on_scan_table_select(evt: gr.SelectData, table):
+    """Pick the job whose row was clicked."""
+    return int(table.iloc[evt.index[0], 0])
+
+DIAGNOSTIC_HEADERS = ["Stage", "Count", "Mean ms", "p50 ms", "p95 ms", "p99 ms", "Total s"]
+
+def diagnostics():
+    """Timing histograms, counters, job queue and inference scheduler
+    statistics from every process, plus this process's resolver, model,
+    cache and open-session statistics."""
+    snap = metrics.collect()
+    stages = [
+        [r["stage"], r["count"], r["mean_ms"], r["p50_ms"], r["p95_ms"], r["p99_ms"],
+         round(r["total_ms"] / 1000, 2)]
+        for r in metrics.summary(snap)
+    ]
+    counters = [[name, value] for name, value in sorted(snap["counters"].items())]
+    stats = {
+        "job_queue": job_queue.queue_stats(),
+        "inference_scheduler": scheduler_stats(),
+        "generation": generation_stats(),
+        "resolver": resolver_stats(),
+        "gallery_cache": gallery_cache.stats(),
+        "sessions": report_open_sessions(LEAK_AGE).splitlines(),
+    }
+    if not metrics.ENABLED:
+        stages = [["(metrics disabled in config.json)", 0, 0, 0, 0, 0, 0]]
+    return stages, counters, stats
+
+def profile_next_request():
+    pending = profiling.request_profile()
+    return f"🧪 The next {pending} request(s) will be profiled"
+
+def profile_choices():
+    return gr.update(choices=[(os.path.basename(p), p) for p in profiling.list_profiles()])
+
+def show_profile(path):
+    return profiling.format_profile(path) if path else ""
 
 def toggle_views(view_mode):
     return (
@@ -52,52 +415,159 @@ def toggle_views(view_mode):
         gr.update(visible=(view_mode == "Images Only"))
     )
 
-with gr.Blocks(title="Stamp’d") as demo:
-    with gr.Tab("🔍 Reverse Lookup"):
-        file_input = gr.File(label="Upload Stamp")
-        image_output = gr.Image()
-        description_output = gr.Textbox(label="AI Description")
-        results_output = gr.Textbox(label="Reverse Image Results")
-
-        file_input.change(
-            enhance_and_classify,
-            inputs=file_input,
-            outputs=[image_output, description_output, results_output]
-        )
+def build_demo():
+    """Build the UI; importing the handlers alone does not pay for it."""
+    with gr.Blocks(title="Stamp’d") as demo:
+        with gr.Tab("🔍 Reverse Lookup"):
+            file_input = gr.File(label="Upload Stamp")
+            image_output = gr.Image()
+            description_output = gr.Textbox(label="AI Description")
+            progress_output = gr.Textbox(label="Progress")
+            results_output = gr.Textbox(label="Reverse Image Results")
+            stop_btn = gr.Button("⏹ Stop")
 
-    with gr.Tab("📋 Gallery"):
-        stamp_id = gr.Textbox(label="Stamp ID")
-        reverse_btn_gallery = gr.Button("🔎 Gallery Reverse Search")
-        ebay_frame_g = gr.Textbox()
-        colnect_frame_g = gr.Textbox()
-        hipstamp_frame_g = gr.Textbox()
-        suggested_title_g = gr.Textbox()
-        country_edit = gr.Textbox(label="Country")
-        denom_edit = gr.Textbox(label="Denomination")
-        year_edit = gr.Textbox(label="Year")
-        notes_edit = gr.Textbox(label="Notes")
-        update_status = gr.Textbox()
-
-        def gallery_reverse_search(stamp_id):
-            # Placeholder lookup for now
-            return ("eBay result", "Colnect result", "HipStamp result", "Suggested title", "US", "5¢", "1950")
-
-        def update_stamp_details(stamp_id, country, denom, year, notes):
-            # Placeholder update logic
-            return f"✅ Updated {stamp_id} with new details."
-
-        reverse_btn_gallery.click(
-            gallery_reverse_search,
-            inputs=stamp_id,
-            outputs=[ebay_frame_g, colnect_frame_g, hipstamp_frame_g, suggested_title_g, country_edit, denom_edit, year_edit]
-        )
+            lookup_event = file_input.upload(
+                enhance_and_classify,
+                inputs=file_input,
+                outputs=[image_output, description_output, progress_output, results_output]
+            )
+            # Clearing the upload or pressing Stop abandons the running generation.
+            file_input.clear(None, None, None, cancels=[lookup_event])
+            stop_btn.click(None, None, None, cancels=[lookup_event])
 
-        update_btn = gr.Button("💾 Update Stamp")
-        update_btn.click(
-            update_stamp_details,
-            inputs=[stamp_id, country_edit, denom_edit, year_edit, notes_edit],
-            outputs=update_status
-        )
+        with gr.Tab("➕ Upload Stamps"):
+            upload_input = gr.File(file_types=["image"], file_count="multiple", label="Upload Stamp Images")
+            split_sheets = gr.Checkbox(label="📄 Page scans: split each file into individual stamps", value=False)
+            preview_table = gr.Dataframe(
+                headers=PREVIEW_HEADERS,
+                datatype=["str"] * len(PREVIEW_HEADERS),
+                row_count=(0, "dynamic")
+            )
+            save_btn = gr.Button("💾 Save to Database")
+            save_status = gr.Textbox(label="Save Status")
+            upload_input.upload(preview_upload, [upload_input, split_sheets], preview_table)
+            save_btn.click(save_uploads, preview_table, save_status)
+
+        with gr.Tab("🔍 Scan"):
+            scan_input = gr.File(file_types=["image"], file_count="multiple", label="Select Images to Scan")
+            scan_split = gr.Checkbox(label="📄 Page scans: split each file into individual stamps", value=False)
+            scan_btn = gr.Button("🚀 Start Scan")
+            scan_progress = gr.Textbox(label="Scan Progress")
+            scan_table = gr.Dataframe(
+                headers=["Job", "Name", "Status", "Items", "Done", "To Review", "Duplicates", "Failed"],
+                value=scan_job_rows,
+                interactive=False,
+            )
+            with gr.Row():
+                scan_job_id = gr.Number(label="Job", precision=0)
+                resume_btn = gr.Button("▶️ Resume")
+                pause_btn = gr.Button("⏸ Pause")
+                retry_btn = gr.Button("🔁 Retry Failed")
+            scan_btn.click(start_scan, [scan_input, scan_split], [scan_progress, scan_table])
+            resume_btn.click(resume_scan, scan_job_id, [scan_progress, scan_table])
+            pause_btn.click(pause_scan, scan_job_id, [scan_progress, scan_table])
+            retry_btn.click(retry_scan, scan_job_id, [scan_progress, scan_table])
+            scan_table.select(on_scan_table_select, scan_table, scan_job_id)
+
+        with gr.Tab("📋 Gallery"):
+            with gr.Row():
+                facet_inputs = [
+                    gr.Dropdown(label=facet.replace("_", " ").title(), choices=[])
+                    for facet in FACETS
+                ]
+            with gr.Row():
+                tag_input = gr.Dropdown(label="Tags", choices=[], multiselect=True)
+                tag_mode_input = gr.Radio(list(TAG_MODES), value="any", label="Match tags")
+            browse_inputs = [*facet_inputs, tag_input, tag_mode_input]
+            refresh_btn = gr.Button("🔄 Refresh")
+            gallery_table = gr.Dataframe(
+                headers=["ID", "Country", "Denomination", "Year", "Notes"],
+                datatype=["number", "str", "str", "str", "str"],
+                row_count=(0, "dynamic")
+            )
+            gallery_view = gr.State()
+            gallery_outputs = [gallery_table, gallery_view, *facet_inputs, tag_input]
+            for browse_input in browse_inputs:
+                browse_input.input(browse_gallery, browse_inputs, gallery_outputs)
+            refresh_btn.click(refresh_gallery, [gallery_view, *browse_inputs], gallery_outputs)
+            demo.load(browse_gallery, browse_inputs, gallery_outputs)
+
+            stamp_id = gr.Textbox(label="Stamp ID")
+            image_display = gr.Image(label="Stamp Image")
+            reverse_btn_gallery = gr.Button("🔎 Gallery Reverse Search")
+            similar_btn = gr.Button("🧭 Find Similar")
+            similar_gallery = gr.Gallery(label="Similar Stamps", columns=6, height="auto")
+            ebay_frame_g = gr.Textbox()
+            colnect_frame_g = gr.Textbox()
+            hipstamp_frame_g = gr.Textbox()
+            suggested_title_g = gr.Textbox()
+            country_edit = gr.Textbox(label="Country")
+            denom_edit = gr.Textbox(label="Denomination")
+            year_edit = gr.Textbox(label="Year")
+            notes_edit = gr.Textbox(label="Notes")
+            update_status = gr.Textbox()
+
+            def gallery_reverse_search(stamp_id):
+                # Placeholder lookup for now
+                return ("eBay result", "Colnect result", "HipStamp result", "Suggested title", "US", "5¢", "1950")
+
+            gallery_table.select(
+                on_gallery_table_select,
+                gallery_table,
+                [stamp_id, image_display, country_edit, denom_edit, year_edit, notes_edit]
+            )
+
+            reverse_btn_gallery.click(
+                gallery_reverse_search,
+                inputs=stamp_id,
+                outputs=[ebay_frame_g, colnect_frame_g, hipstamp_frame_g, suggested_title_g, country_edit, denom_edit, year_edit]
+            )
+
+            similar_btn.click(find_similar_stamps, inputs=stamp_id, outputs=similar_gallery)
+
+            update_btn = gr.Button("💾 Update Stamp")
+            update_btn.click(
+                update_stamp_details,
+                inputs=[stamp_id, country_edit, denom_edit, year_edit, notes_edit],
+                outputs=update_status
+            )
+
+        with gr.Tab("🩺 Diagnostics") as diagnostics_tab:
+            diagnostics_refresh = gr.Button("🔄 Refresh")
+            stage_table = gr.Dataframe(headers=DIAGNOSTIC_HEADERS, interactive=False)
+            counter_table = gr.Dataframe(headers=["Counter", "Value"], interactive=False)
+            stats_json = gr.JSON(label="Live statistics")
+            diagnostics_outputs = [stage_table, counter_table, stats_json]
+            diagnostics_refresh.click(diagnostics, None, diagnostics_outputs)
+            diagnostics_tab.select(diagnostics, None, diagnostics_outputs)
+
+            with gr.Row():
+                profile_btn = gr.Button("🧪 Profile Next Request")
+                profile_status = gr.Textbox(label="Profiling", interactive=False)
+            profile_picker = gr.Dropdown(label="Saved profiles (slow requests)", choices=[])
+            profile_view = gr.Textbox(label="Top functions by cumulative time", lines=20)
+            profile_btn.click(profile_next_request, None, profile_status)
+            diagnostics_refresh.click(profile_choices, None, profile_picker)
+            diagnostics_tab.select(profile_choices, None, profile_picker)
+            profile_picker.change(show_profile, profile_picker, profile_view)
+    return demo
 
 if __name__ == "__main__":
-    demo.launch()
+    # Heavy work runs in separate worker processes; with autostart off,
+    # run ``python worker_pool.py`` alongside the app.  Importing this
+    # module (tests, tools) neither touches the database nor loads them.
+    import backup
+    import worker_pool
+
+    setup_logging("app")
+    init_db()
+    settings.start_watcher()  # config.json edits apply without a restart
+    pool = worker_pool.WorkerPool().start() if worker_pool.AUTOSTART else None
+    metrics.serve_metrics()
+    backup.start_scheduler()
+    maintenance.start()
+    try:
+        build_demo().launch()
+    finally:
+        if pool is not None:
+            pool.stop()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""Database snapshots and image backups for Stamp'd.
+
+A snapshot is a directory ``BACKUP_DIR/snapshots/<YYYYmmdd_HHMMSS>``
+holding
+
+* ``stampd.db`` -- a consistent copy made with SQLite's online backup API,
+  ``pages_per_step`` pages at a time with a ``step_sleep_ms`` pause between
+  steps, so the app keeps reading and writing while it runs;
+* ``images.tar.gz`` -- only the files of ``IMAGES_DIR`` that are new or
+  changed since the previous snapshot (``compress: false`` writes a plain
+  ``.tar``; ``include_images: false`` skips images);
+* ``manifest.json`` -- the database's checksum and row counts, and the
+  size and modification time of every image at snapshot time.
+
+Snapshots are written under a ``.partial`` name and renamed when
+complete.  Only the newest ``keep`` are kept; the images of a pruned
+snapshot that are still current are folded into the next one's archive, so
+every kept snapshot can be restored on its own.  :func:`start_scheduler`
+takes one every ``interval_hours`` when ``enabled``::
+
+    python backup.py                     # take a snapshot now
+    python backup.py --list
+    python backup.py --verify NAME
+    python backup.py --restore NAME      # with the app and workers stopped
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from config import BACKUP_DIR, DB_PATH, IMAGES_DIR, settings
+from log_utils import get_logger, setup_logging
+from metrics import timed
+
+logger = get_logger("backup")
+
+
+@settings.bind("backup")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global BACKUP_ENABLED, INTERVAL_HOURS, KEEP_SNAPSHOTS, PAGES_PER_STEP
+    global STEP_SLEEP_MS, INCLUDE_IMAGES, COMPRESS_IMAGES
+    BACKUP_ENABLED = section.get("enabled", True)
+    INTERVAL_HOURS = section.get("interval_hours", 24)
+    KEEP_SNAPSHOTS = section.get("keep", 7)
+    PAGES_PER_STEP = section.get("pages_per_step", 256)
+    STEP_SLEEP_MS = section.get("step_sleep_ms", 20)
+    INCLUDE_IMAGES = section.get("include_images", True)
+    COMPRESS_IMAGES = section.get("compress", True)
+
+
+SNAPSHOT_DIR = os.path.join(BACKUP_DIR, "snapshots")
+DB_FILE = "stampd.db"
+MANIFEST_FILE = "manifest.json"
+# How often the scheduler checks whether a snapshot is due (seconds).
+SCHEDULER_POLL = 300
+# Paced copies restarted this often by concurrent writes finish in one step.
+MAX_RESTARTS = 3
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _table_counts(conn: sqlite3.Connection) -> Dict[str, int]:
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    return {name: conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0] for name in names}
+
+
+def _integrity(conn: sqlite3.Connection) -> str:
+    return conn.execute("PRAGMA integrity_check").fetchone()[0]
+
+
+class _Restarted(Exception):
+    pass
+
+
+def copy_database(source_path: str, target_path: str, pages: Optional[int] = None,
+                  sleep_ms: Optional[float] = None) -> None:
+    """Copy the live database at *source_path* to *target_path* in paced
+    steps of *pages* pages (default ``PAGES_PER_STEP``), sleeping
+    *sleep_ms* (``STEP_SLEEP_MS``) between them.
+
+    Each step holds the source's read lock only briefly.  A write by
+    another connection between steps makes SQLite restart the copy, so
+    the result is always consistent; under constant writes the copy is
+    redone in one step after ``MAX_RESTARTS`` restarts, which in WAL mode
+    still does not block writers.  The copy is left in rollback-journal
+    mode, a single self-contained file.
+    """
+    pages = PAGES_PER_STEP if pages is None else pages
+    sleep_ms = STEP_SLEEP_MS if sleep_ms is None else sleep_ms
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path)
+    progress = {"remaining": None, "restarts": 0}
+
+    def pace(status, remaining, total):
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+            if progress["restarts"] >= MAX_RESTARTS:
+                raise _Restarted()
+        progress["remaining"] = remaining
+        time.sleep(sleep_ms / 1000)
+
+    try:
+        try:
+            source.backup(target, pages=pages, progress=pace)
+        except _Restarted:
+            logger.info("💾 %s keeps changing; copying it in one step", source_path)
+            source.backup(target)
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+
+def _image_index(images_dir: str) -> Dict[str, List[int]]:
+    """``{relative path: [size, mtime_ns]}`` of every file under *images_dir*."""
+    index = {}
+    for root, _, files in os.walk(images_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            index[os.path.relpath(path, images_dir).replace(os.sep, "/")] = [st.st_size, st.st_mtime_ns]
+    return index
+
+
+def list_snapshots(directory: Optional[str] = None) -> List[str]:
+    """Complete snapshots in *directory*, oldest first."""
+    directory = directory or SNAPSHOT_DIR
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name for name in os.listdir(directory)
+        if not name.endswith(".partial") and os.path.exists(os.path.join(directory, name, MANIFEST_FILE))
+    )
+
+
+def load_manifest(name: str, directory: Optional[str] = None) -> Dict[str, Any]:
+    with open(os.path.join(directory or SNAPSHOT_DIR, name, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(folder: str, manifest: Dict[str, Any]) -> None:
+    tmp = os.path.join(folder, MANIFEST_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(folder, MANIFEST_FILE))
+
+
+def _with_images(names: List[str], directory: str) -> List[Dict[str, Any]]:
+    """Manifests of the snapshots among *names* that backed up images."""
+    manifests = [load_manifest(name, directory) for name in names]
+    return [m for m in manifests if m["images"]["included"]]
+
+
+def _archive_members(folder: str, archive: Optional[str]) -> List[tarfile.TarInfo]:
+    if not archive:
+        return []
+    with tarfile.open(os.path.join(folder, archive), "r:*") as tar:
+        return tar.getmembers()
+
+
+@timed("backup_snapshot")
+def create_snapshot(db_path: Optional[str] = None, images_dir: Optional[str] = None,
+                    directory: Optional[str] = None, include_images: Optional[bool] = None,
+                    compress: Optional[bool] = None, keep: Optional[int] = None) -> str:
+    """Snapshot the database and the images added since the last snapshot;
+    prune old snapshots and return the new snapshot's name.  Unset options
+    come from the ``backup`` settings."""
+    include_images = INCLUDE_IMAGES if include_images is None else include_images
+    compress = COMPRESS_IMAGES if compress is None else compress
+    db_path = db_path or DB_PATH
+    images_dir = images_dir or IMAGES_DIR
+    directory = directory or SNAPSHOT_DIR
+    if not os.path.exists(db_path):
+        raise ValueError(f"No database at {db_path}")
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    name = datetime.now().strftime("%Y%m%d_%H%M%S")
+    while os.path.exists(os.path.join(directory, name)):  # two in one second
+        name += "_1"
+    folder = os.path.join(directory, name + ".partial")
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    db_copy = os.path.join(folder, DB_FILE)
+    copy_database(db_path, db_copy)
+    conn = sqlite3.connect(db_copy)
+    try:
+        integrity, tables = _integrity(conn), _table_counts(conn)
+    finally:
+        conn.close()
+    if integrity != "ok":
+        shutil.rmtree(folder, ignore_errors=True)
+        raise RuntimeError(f"Snapshot of {db_path} failed the integrity check: {integrity}")
+
+    index: Dict[str, List[int]] = {}
+    archive = None
+    added = 0
+    include_images = include_images and os.path.isdir(images_dir)
+    if include_images:
+        # Images are a chain of deltas over the snapshots that include them.
+        bases = _with_images(list_snapshots(directory), directory)
+        previous = bases[-1]["images"]["index"] if bases else {}
+        index = _image_index(images_dir)
+        changed = sorted(path for path, stat in index.items() if previous.get(path) != stat)
+        if changed:
+            archive = "images.tar.gz" if compress else "images.tar"
+            with tarfile.open(os.path.join(folder, archive), "w:gz" if compress else "w") as tar:
+                for path in changed:
+                    tar.add(os.path.join(images_dir, path), arcname=path)
+            added = len(changed)
+
+    manifest = {
+        "name": name,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "source": os.path.abspath(db_path),
+        "db": {
+            "file": DB_FILE,
+            "bytes": os.path.getsize(db_copy),
+            "sha256": _sha256(db_copy),
+            "tables": tables,
+        },
+        "images": {"included": include_images, "archive": archive, "added": added, "index": index},
+    }
+    _save_manifest(folder, manifest)
+    os.replace(folder, os.path.join(directory, name))
+    prune_snapshots(keep, directory)
+    logger.info(
+        "💾 Snapshot %s: database %.1f MB, %s new image(s), %.1f s",
+        name, manifest["db"]["bytes"] / 1e6, added, time.perf_counter() - start,
+        extra={"snapshot": name, "images_added": added},
+    )
+    return name
+
+
+def _fold(older: str, newer: str, directory: str) -> None:
+    """Carry the images of snapshot *older* that *newer* still lists, but
+    does not archive itself, into *newer*'s archive."""
+    old_folder, new_folder = os.path.join(directory, older), os.path.join(directory, newer)
+    old_manifest, new_manifest = load_manifest(older, directory), load_manifest(newer, directory)
+    old_archive, new_archive = old_manifest["images"]["archive"], new_manifest["images"]["archive"]
+    if not old_archive:
+        return
+    index = new_manifest["images"]["index"]
+    have = {m.name for m in _archive_members(new_folder, new_archive)}
+    carry = [m for m in _archive_members(old_folder, old_archive)
+             if m.isfile() and m.name in index and m.name not in have]
+    if not carry:
+        return
+    archive = new_archive or old_archive
+    compressed = archive.endswith(".gz")
+    tmp = os.path.join(new_folder, archive + ".tmp")
+    with tarfile.open(tmp, "w:gz" if compressed else "w") as out:
+        for folder, name, members in ((old_folder, old_archive, carry), (new_folder, new_archive, None)):
+            if not name:
+                continue
+            with tarfile.open(os.path.join(folder, name), "r:*") as tar:
+                wanted = {m.name for m in members} if members is not None else None
+                for member in tar:
+                    if wanted is None or member.name in wanted:
+                        out.addfile(member, tar.extractfile(member) if member.isfile() else None)
+    os.replace(tmp, os.path.join(new_folder, archive))
+    if new_archive and new_archive != archive:
+        os.remove(os.path.join(new_folder, new_archive))
+    new_manifest["images"]["archive"] = archive
+    new_manifest["images"]["carried"] = new_manifest["images"].get("carried", 0) + len(carry)
+    _save_manifest(new_folder, new_manifest)
+
+
+def prune_snapshots(keep: Optional[int] = None, directory: Optional[str] = None) -> List[str]:
+    """Delete all but the newest *keep* (default ``KEEP_SNAPSHOTS``)
+    snapshots and leftovers of interrupted ones; return the names deleted."""
+    directory = directory or SNAPSHOT_DIR
+    keep = max(1, KEEP_SNAPSHOTS if keep is None else keep)
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if name.endswith(".partial"):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    snapshots = list_snapshots(directory)
+    pruned = snapshots[:-keep]
+    for i, name in enumerate(pruned):
+        # Hand the images on to the next snapshot whose delta builds on them.
+        successors = _with_images(snapshots[i + 1:], directory)
+        if successors:
+            _fold(name, successors[0]["name"], directory)
+        shutil.rmtree(os.path.join(directory, name))
+    if pruned:
+        logger.info("🧹 Pruned snapshot(s) %s", ", ".join(pruned))
+    return pruned
+
+
+def verify_snapshot(name: str, directory: Optional[str] = None) -> Dict[str, Any]:
+    """Check a snapshot's database checksum, integrity and image archives;
+    raise ``RuntimeError`` on the first problem, return its manifest."""
+    directory = directory or SNAPSHOT_DIR
+    if name not in list_snapshots(directory):
+        raise ValueError(f"No snapshot named {name!r} in {directory}")
+    manifest = load_manifest(name, directory)
+    db_copy = os.path.join(directory, name, manifest["db"]["file"])
+    if _sha256(db_copy) != manifest["db"]["sha256"]:
+        raise RuntimeError(f"Snapshot {name}: database checksum does not match")
+    conn = sqlite3.connect(f"file:{db_copy}?mode=ro", uri=True)
+    try:
+        integrity = _integrity(conn)
+    finally:
+        conn.close()
+    if integrity != "ok":
+        raise RuntimeError(f"Snapshot {name}: integrity check failed: {integrity}")
+    # Every image the snapshot lists must be in its archive or an older one.
+    archived = set()
+    for older in list_snapshots(directory):
+        archive = load_manifest(older, directory)["images"]["archive"]
+        archived.update(m.name for m in _archive_members(os.path.join(directory, older), archive))
+        if older == name:
+            break
+    missing = set(manifest["images"]["index"]) - archived
+    if missing:
+        raise RuntimeError(f"Snapshot {name}: {len(missing)} image(s) missing, e.g. {sorted(missing)[0]}")
+    return manifest
+
+
+def _safe_member(member: tarfile.TarInfo) -> bool:
+    path = member.name.replace("\\", "/")
+    return member.isfile() and not path.startswith("/") and ".." not in path.split("/")
+
+
+def restore_snapshot(name: str, db_path: Optional[str] = None, images_dir: Optional[str] = None,
+                     directory: Optional[str] = None) -> Dict[str, Any]:
+    """Verify snapshot *name*, then restore its database over *db_path*
+    and its images into *images_dir*; return what was restored.
+
+    Run it with the app and workers stopped.  The current database is
+    first saved as ``<db_path>.pre-restore``.  The restored database is
+    checked against the manifest's row counts; ``RuntimeError`` is raised
+    if it does not match.
+    """
+    db_path = db_path or DB_PATH
+    images_dir = images_dir or IMAGES_DIR
+    directory = directory or SNAPSHOT_DIR
+    manifest = verify_snapshot(name, directory)
+
+    if os.path.exists(db_path):
+        copy_database(db_path, db_path + ".pre-restore", pages=-1, sleep_ms=0)
+    source = sqlite3.connect(f"file:{os.path.join(directory, name, manifest['db']['file'])}?mode=ro", uri=True)
+    target = sqlite3.connect(db_path, timeout=30)
+    try:
+        source.backup(target)  # replaces the content under SQLite's locks, WAL included
+        integrity, tables = _integrity(target), _table_counts(target)
+    finally:
+        target.close()
+        source.close()
+    if integrity != "ok" or tables != manifest["db"]["tables"]:
+        raise RuntimeError(
+            f"Restored database does not match snapshot {name}; "
+            f"the previous database is at {db_path}.pre-restore"
+        )
+
+    # Later archives hold newer versions, so extract oldest first.
+    index = manifest["images"]["index"]
+    restored = 0
+    for older in list_snapshots(directory):
+        archive = load_manifest(older, directory)["images"]["archive"]
+        if archive:
+            with tarfile.open(os.path.join(directory, older, archive), "r:*") as tar:
+                members = [m for m in tar.getmembers() if m.name in index and _safe_member(m)]
+                tar.extractall(images_dir, members=members)
+                restored += len(members)
+        if older == name:
+            break
+    logger.info("♻️ Restored snapshot %s into %s (%s image file(s))", name, db_path, restored)
+    return {"snapshot": name, "db_path": db_path, "tables": manifest["db"]["tables"],
+            "images": len(index), "extracted": restored}
+
+
+def snapshot_due(interval_hours: Optional[float] = None, directory: Optional[str] = None) -> bool:
+    interval_hours = INTERVAL_HOURS if interval_hours is None else interval_hours
+    snapshots = list_snapshots(directory)
+    if not snapshots:
+        return True
+    created = datetime.fromisoformat(load_manifest(snapshots[-1], directory)["created"])
+    return datetime.now() - created >= timedelta(hours=interval_hours)
+
+
+def start_scheduler(stop: Optional[threading.Event] = None,
+                    interval_hours: Optional[float] = None) -> threading.Thread:
+    """Until *stop* is set, take a snapshot whenever the newest is
+    *interval_hours* (default ``INTERVAL_HOURS``, re-read on every check)
+    old, as long as backups are enabled."""
+    stop = stop or threading.Event()
+
+    def run():
+        while True:
+            try:
+                if BACKUP_ENABLED and snapshot_due(interval_hours):
+                    create_snapshot()
+            except Exception as e:
+                logger.exception("⚠️ Scheduled backup failed: %s", e)
+            if stop.wait(SCHEDULER_POLL):
+                return
+
+    thread = threading.Thread(target=run, name="backup-scheduler", daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Snapshot, verify and restore the Stamp'd database and images")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--list", action="store_true", help="list snapshots")
+    group.add_argument("--verify", metavar="NAME", help="check a snapshot")
+    group.add_argument("--restore", metavar="NAME", help="restore a snapshot (stop the app first)")
+    parser.add_argument("--no-images", action="store_true", help="snapshot the database only")
+    args = parser.parse_args(argv)
+    setup_logging("backup")
+    if args.list:
+        for name in list_snapshots():
+            manifest = load_manifest(name)
+            print(f"{name}  {manifest['db']['bytes'] / 1e6:8.1f} MB  "
+                  f"{len(manifest['images']['index']):6} images ({manifest['images']['added']} new)")
+    elif args.verify:
+        verify_snapshot(args.verify)
+        print(f"✅ Snapshot {args.verify} is intact")
+    elif args.restore:
+        result = restore_snapshot(args.restore)
+        print(f"✅ Restored {result['snapshot']}: {sum(result['tables'].values())} rows, "
+              f"{result['images']} images")
+    else:
+        print(f"💾 Created snapshot {create_snapshot(include_images=not args.no_images)}")
+
+
+if __name__ == "__main__":
+    main()
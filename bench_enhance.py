@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Benchmark the enhance-and-crop stage over the sample images for Stamp'd.
+
+Runs ``enhance_and_crop`` on every JPEG in ``images/`` plus a synthetic
+10 MP scan (a rotated stamp on a flat scanner bed) and reports the median
+time per image.  Usage: ``python bench_enhance.py [--repeat N]``.
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from image_utils import enhance_and_crop  # noqa: E402
+
+TARGET_MS = 200.0
+
+
+def synthetic_scan(path, size=(3872, 2592), angle=7):
+    """Write a 10 MP scan with one rotated, patterned stamp to *path*."""
+    bed = (232, 236, 226)
+    scan = Image.new("RGB", size, bed)
+    stamp = Image.new("RGB", (1400, 1700), (40, 60, 140))
+    draw = ImageDraw.Draw(stamp)
+    for x in range(0, 1400, 50):
+        draw.line([(x, 0), (1400 - x, 1700)], fill=(200, 180, 60), width=8)
+    stamp = stamp.rotate(angle, expand=True, fillcolor=bed)
+    scan.paste(stamp, (1000, 300))
+    scan.save(path, quality=90)
+    return path
+
+
+def time_image(path, out_dir, repeat):
+    output = os.path.join(out_dir, "out_" + os.path.basename(path))
+    enhance_and_crop(path, output)  # warm-up (lazy imports, file cache)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        enhance_and_crop(path, output)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), Image.open(output).size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as out_dir:
+        paths = sorted(glob.glob(os.path.join(here, "images", "*.jpg")))
+        paths.append(synthetic_scan(os.path.join(out_dir, "synthetic_10mp.jpg")))
+
+        print(f"{'image':<40} {'input':>11} {'output':>11} {'ms':>8}")
+        slowest = 0.0
+        for path in paths:
+            with Image.open(path) as img:
+                in_size = img.size
+            ms, out_size = time_image(path, out_dir, args.repeat)
+            slowest = max(slowest, ms)
+            print(
+                f"{os.path.basename(path)[-40:]:<40} "
+                f"{'%dx%d' % in_size:>11} {'%dx%d' % out_size:>11} {ms:8.1f}"
+            )
+
+    status = "✅" if slowest < TARGET_MS else "⚠️"
+    print(f"{status} Slowest image: {slowest:.1f} ms (target {TARGET_MS:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
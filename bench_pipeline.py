@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""Benchmark the Stamp'd catalogue pipeline at collection scale.
+
+Builds a synthetic collection of 1k/10k/100k stamps in a throw-away
+database (the real ``stampd.db`` is never touched) plus a small corpus of
+synthetic stamp images, then times:
+
+* hashing and thumbnailing the image corpus;
+* duplicate lookup by file hash and by perceptual hash;
+* loading, refreshing and searching the gallery;
+* CSV and XLSX export;
+* ingesting the corpus end to end as a scan job, with the Ollama HTTP
+  calls answered in-process after ``--ollama-latency`` ms.
+
+Results are written as JSON (``bench_results/<commit>.json`` by default)
+so runs from different commits can be compared::
+
+    python bench_pipeline.py --scale 1000 --scale 10000
+    python bench_pipeline.py --compare bench_results/abc1234.json
+    python bench_pipeline.py --compare old.json new.json
+
+Comparing exits with status 1 when a benchmark got slower by more than
+``--threshold``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+from unittest.mock import patch
+
+from PIL import Image, ImageDraw
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+SCALES = (1000, 10000, 100000)
+RESULTS_DIR = os.path.join(HERE, "bench_results")
+COUNTRIES = ["Canada", "Peru", "France", "Germany", "Japan", "Brazil", "India", "Kenya"]
+DENOMINATIONS = ["1c", "5c", "10c", "25c", "1d", "2p", "50 centimes", "1 peso"]
+COLOURS = ["red", "blue", "green", "brown", "violet", "black"]
+INSERT_BATCH = 5000
+
+
+# -------------------------
+# Synthetic data
+# -------------------------
+
+
+def synthetic_stamp(path: str, seed: int, size=(400, 480)) -> str:
+    """Write a patterned stamp image to *path*; every *seed* looks different
+    so neither file nor perceptual hashes collide."""
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, (245, 242, 232))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([20, 20, size[0] - 20, size[1] - 20],
+                   fill=tuple(rng.randrange(40, 200) for _ in range(3)))
+    for _ in range(12):
+        box = sorted(rng.randrange(30, size[0] - 30) for _ in range(2)) + \
+            sorted(rng.randrange(30, size[1] - 30) for _ in range(2))
+        draw.ellipse([box[0], box[2], box[1], box[3]],
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    img.save(path, quality=90)
+    return path
+
+
+def synthetic_rows(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Return *count* plausible ``stamps`` rows."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        country = rng.choice(COUNTRIES)
+        year = str(rng.randrange(1850, 2020))
+        denomination = rng.choice(DENOMINATIONS)
+        rows.append({
+            "image_path": f"images/synthetic_{i:06d}.jpg",
+            "file_hash": f"{rng.getrandbits(128):032x}",
+            "stamp_name": f"{country} {year} definitive",
+            "country": country,
+            "denomination": denomination,
+            "year": year,
+            "color": rng.choice(COLOURS),
+            "format": rng.choice(["Single", "Pair", "Block"]),
+            "mint_used": rng.choice(["Mint", "Used"]),
+            "description": f"{country} {year} {denomination} {rng.choice(COLOURS)}",
+            "notes": "",
+            "collection": rng.choice(["", "Europe", "Americas", "Asia"]),
+            "listing_status": rng.choice(["Unlisted", "Draft", "Live", "Sold"]),
+        })
+    return rows
+
+
+def populate(count: int) -> List[Dict[str, Any]]:
+    """Recreate the schema and insert *count* stamps with perceptual
+    hashes; return the rows."""
+    from sqlalchemy import insert
+
+    from db import Base, Stamp, engine, init_db, session_scope
+    from metadata_resolver import ImageSignature
+
+    Base.metadata.drop_all(engine)
+    init_db()
+    with engine.begin() as connection:
+        # export_utils reads through the db_utils model, which also maps
+        # thumbnail_path; db.Stamp does not create that column.
+        connection.exec_driver_sql("ALTER TABLE stamps ADD COLUMN thumbnail_path VARCHAR")
+    rows = synthetic_rows(count)
+    rng = random.Random(1)
+    for start in range(0, count, INSERT_BATCH):
+        batch = rows[start:start + INSERT_BATCH]
+        with session_scope() as session:
+            session.execute(insert(Stamp), batch)
+            session.execute(insert(ImageSignature), [
+                {"file_hash": row["file_hash"], "phash": f"{rng.getrandbits(64):016x}"}
+                for row in batch
+            ])
+    return rows
+
+
+class FakeOllama:
+    """Stands in for ``requests.post`` to ``/api/generate``: waits
+    *latency_ms*, then streams a JSON metadata answer token by token."""
+
+    def __init__(self, latency_ms: float = 50.0, seed: int = 0):
+        self.latency = latency_ms / 1000.0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, url, json=None, stream=False, timeout=None, **kwargs):
+        with self.lock:
+            self.calls += 1
+            country = self.rng.choice(COUNTRIES)
+            year = self.rng.randrange(1850, 2020)
+            denomination = self.rng.choice(DENOMINATIONS)
+        answer = (
+            f'{{"country": "{country}", "year": "{year}", "denomination": "{denomination}",'
+            f' "format": "Single", "mint_used": "Used",'
+            f' "description": "{country} {year} {denomination} definitive"}}'
+        )
+        time.sleep(self.latency)
+        return _FakeResponse(answer)
+
+
+class _FakeResponse:
+    def __init__(self, answer: str):
+        self.answer = answer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        pieces = [self.answer[i:i + 4] for i in range(0, len(self.answer), 4)]
+        for piece in pieces:
+            yield json.dumps({"response": piece, "done": False}).encode()
+        yield json.dumps({"response": "", "done": True, "eval_count": len(pieces),
+                          "eval_duration": int(len(pieces) * 2e7)}).encode()
+
+
+# -------------------------
+# Measurement
+# -------------------------
+
+
+def measure(fn: Callable[[], Any], repeat: int = 5, items: int = 1, warmup: bool = True) -> Dict[str, Any]:
+    """Time *fn* *repeat* times; *items* is how much work one call does."""
+    if warmup:
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    median = statistics.median(timings)
+    return {
+        "runs": repeat,
+        "items": items,
+        "median_ms": round(median, 3),
+        "p95_ms": round(timings[min(len(timings) - 1, math.ceil(0.95 * len(timings)) - 1)], 3),
+        "per_item_ms": round(median / max(1, items), 4),
+        "items_per_sec": round(items / (median / 1000), 1) if median else 0.0,
+    }
+
+
+def run_scale(scale: int, corpus: List[str], work_dir: str, repeat: int = 5,
+              ollama_latency: float = 50.0) -> Dict[str, Dict[str, Any]]:
+    """Run every benchmark against a fresh collection of *scale* stamps."""
+    import export_utils
+    import image_utils
+    import metadata_resolver
+    import scan_jobs
+    from changes import changes_since, new_token
+    from db import Stamp, session_scope
+    from gallery import search_stamps
+    from image_utils import generate_thumbnail, get_file_hash, get_perceptual_hash
+
+    results: Dict[str, Dict[str, Any]] = {}
+    start = time.perf_counter()
+    rows = populate(scale)
+    populate_ms = (time.perf_counter() - start) * 1000
+    results["populate"] = {
+        "runs": 1, "items": scale, "median_ms": round(populate_ms, 3), "p95_ms": round(populate_ms, 3),
+        "per_item_ms": round(populate_ms / scale, 4), "items_per_sec": round(scale / (populate_ms / 1000), 1),
+    }
+
+    results["hash_file"] = measure(lambda: [get_file_hash(p) for p in corpus], repeat, len(corpus))
+    results["hash_perceptual"] = measure(lambda: [get_perceptual_hash(p) for p in corpus], repeat, len(corpus))
+    with patch.object(image_utils, "TEMP_UPLOADS", work_dir):
+        results["thumbnail"] = measure(lambda: [generate_thumbnail(p) for p in corpus], repeat, len(corpus))
+
+    probes = [row["file_hash"] for row in random.Random(2).sample(rows, min(100, scale))]
+
+    def lookup_hashes():
+        with session_scope(read_only=True) as session:
+            for file_hash in probes:
+                session.query(Stamp.id).filter_by(file_hash=file_hash).first()
+
+    results["dedup_file_hash"] = measure(lookup_hashes, repeat, len(probes))
+
+    probe = corpus[0]
+    probe_phash = {probe: get_perceptual_hash(probe)}
+    results["dedup_phash"] = measure(
+        lambda: metadata_resolver._resolve_by_phash([probe], probe_phash, {}), repeat
+    )
+
+    results["gallery_load"] = measure(
+        lambda: [[s.id, s.country, s.denomination, s.year, s.notes]
+                 for s in search_stamps.uncached("", {})],
+        repeat, scale,
+    )
+    search_stamps("", {})
+    results["gallery_load_cached"] = measure(lambda: search_stamps("", {}), repeat, scale)
+
+    def refresh():
+        token = new_token()
+        with session_scope() as session:
+            for stamp in session.query(Stamp).limit(10):
+                stamp.notes = f"edited {time.perf_counter()}"
+        changes_since(token)
+
+    results["gallery_refresh_10_edits"] = measure(refresh, repeat, 10)
+    results["search_text"] = measure(lambda: search_stamps.uncached("peru", {}), repeat)
+    results["search_facets"] = measure(
+        lambda: search_stamps.uncached("", {"country": "Peru", "mint_used": "Used"}), repeat
+    )
+
+    with patch.object(export_utils, "BACKUP_DIR", work_dir):
+        results["export_csv"] = measure(export_utils.export_csv, repeat, scale, warmup=False)
+        results["export_xlsx"] = measure(export_utils.export_xlsx, max(1, repeat // 2), scale, warmup=False)
+
+    fake = FakeOllama(ollama_latency)
+    jobs_dir = os.path.join(work_dir, f"jobs_{scale}")
+    with patch("requests.post", fake), patch.object(scan_jobs, "JOBS_DIR", jobs_dir):
+        start = time.perf_counter()
+        job_id = scan_jobs.create_job(corpus, name=f"bench {scale}")
+        for status in scan_jobs.run_job(job_id):
+            pass
+        ingest_ms = (time.perf_counter() - start) * 1000
+    if status["counts"]["done"] != len(corpus):
+        raise RuntimeError(f"Ingestion benchmark saved {status['counts']} of {len(corpus)} images")
+    results["ingest_scan_job"] = {
+        "runs": 1, "items": len(corpus), "median_ms": round(ingest_ms, 3), "p95_ms": round(ingest_ms, 3),
+        "per_item_ms": round(ingest_ms / len(corpus), 4),
+        "items_per_sec": round(len(corpus) / (ingest_ms / 1000), 1),
+        "ollama_calls": fake.calls, "ollama_latency_ms": ollama_latency,
+    }
+    return results
+
+
+# -------------------------
+# Results
+# -------------------------
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        "commit": _git("rev-parse", "--short", "HEAD") or "unknown",
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare_results(base: Dict[str, Any], new: Dict[str, Any], threshold: float = 0.15) -> List[Dict[str, Any]]:
+    """Return one row per benchmark present in both runs, with the ratio of
+    per-item medians and whether it regressed beyond *threshold*."""
+    rows = []
+    for scale, benches in new["scales"].items():
+        for name, result in benches.items():
+            old = base["scales"].get(scale, {}).get(name)
+            if not old or not old["per_item_ms"]:
+                continue
+            ratio = result["per_item_ms"] / old["per_item_ms"]
+            rows.append({
+                "scale": scale, "benchmark": name, "base_ms": old["per_item_ms"],
+                "new_ms": result["per_item_ms"], "ratio": round(ratio, 3),
+                "regressed": ratio > 1 + threshold,
+            })
+    return rows
+
+
+def print_comparison(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> bool:
+    """Print the comparison table; return True if anything regressed."""
+    rows = compare_results(base, new, threshold)
+    print(f"Comparing {base['environment']['commit']} -> {new['environment']['commit']}")
+    print(f"{'scale':>7} {'benchmark':<26} {'base ms/item':>13} {'new ms/item':>12} {'change':>8}")
+    for row in rows:
+        mark = " ⚠️" if row["regressed"] else ""
+        print(
+            f"{row['scale']:>7} {row['benchmark']:<26} {row['base_ms']:13.4f} "
+            f"{row['new_ms']:12.4f} {(row['ratio'] - 1) * 100:+7.1f}%{mark}"
+        )
+    regressed = [row for row in rows if row["regressed"]]
+    if regressed:
+        print(f"⚠️ {len(regressed)} benchmark(s) slower by more than {threshold:.0%}")
+    else:
+        print("✅ No regressions")
+    return bool(regressed)
+
+
+def _load(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run_suite(scales: List[int], images: int, repeat: int, ollama_latency: float,
+              work_dir: str) -> Dict[str, Any]:
+    """Run the benchmarks at every scale; return the JSON-ready results."""
+    corpus_dir = os.path.join(work_dir, "corpus")
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = [synthetic_stamp(os.path.join(corpus_dir, f"stamp_{i:04d}.jpg"), i) for i in range(images)]
+    results = {"environment": environment(), "images": images, "scales": {}}
+    for scale in scales:
+        print(f"⏱️ Benchmarking {scale} stamps ...")
+        results["scales"][str(scale)] = run_scale(scale, corpus, work_dir, repeat, ollama_latency)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, action="append",
+                        help=f"collection size (repeatable; default {SCALES[0]})")
+    parser.add_argument("--images", type=int, default=50, help="synthetic images to hash and ingest")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--ollama-latency", type=float, default=50.0,
+                        help="simulated model latency per image in ms")
+    parser.add_argument("--output", help="results file (default bench_results/<commit>.json)")
+    parser.add_argument("--compare", nargs="+", metavar="RESULTS",
+                        help="compare a run with BASE, or compare two saved files")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="slowdown that counts as a regression (0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) == 2:
+        base, new = (_load(path) for path in args.compare)
+        return int(print_comparison(base, new, args.threshold))
+
+    with tempfile.TemporaryDirectory(prefix="stampd_bench_") as work_dir:
+        # Must be set before db is first imported.
+        os.environ["STAMPD_DB_PATH"] = os.path.join(work_dir, "bench.db")
+        results = run_suite(args.scale or [SCALES[0]], args.images, args.repeat,
+                            args.ollama_latency, work_dir)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['environment']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    for scale, benches in results["scales"].items():
+        print(f"\n{scale} stamps")
+        print(f"{'benchmark':<26} {'median ms':>11} {'p95 ms':>10} {'items/s':>10}")
+        for name, r in benches.items():
+            print(f"{name:<26} {r['median_ms']:11.2f} {r['p95_ms']:10.2f} {r['items_per_sec']:10.1f}")
+    print(f"\n💾 Results written to {output}")
+
+    if args.compare:
+        return int(print_comparison(_load(args.compare[0]), results, args.threshold))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""Change feed for Stamp'd.
+
+Clients keep an opaque token and ask for everything that changed since
+it.  SQLite triggers append a row to ``stamp_changes`` for every insert,
+update and delete of a stamp, bulk statements included, and the token is
+the sequence number of the last row seen.  SQLite runs one write
+transaction at a time and the sequence only grows, so once a reader sees a
+sequence number every lower one is committed: a long transaction can delay
+its changes but never hide them.  Cost is proportional to the number of
+changed rows, not the size of the collection.
+
+Rows older than ``CHANGE_RETENTION`` are pruned by the app's maintenance
+thread; clients holding an older token are told to reload everything.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import Column, DateTime, Integer, String, event, func
+
+from db import Base, Stamp, session_scope
+from maintenance import register_task
+
+# Change rows older than this are pruned; clients with an older token are
+# told to reload everything instead.
+CHANGE_RETENTION = timedelta(days=7)
+# How often the maintenance thread prunes them (seconds).
+PRUNE_INTERVAL = 6 * 3600
+
+
+class StampChange(Base):
+    __tablename__ = "stamp_changes"
+    __table_args__ = {"sqlite_autoincrement": True}  # sequence numbers are never reused
+
+    seq = Column(Integer, primary_key=True)
+    stamp_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)  # insert, update, delete
+    changed_at = Column(DateTime, nullable=False, index=True)
+
+
+# The timestamp uses the text layout SQLAlchemy writes for DateTime on
+# SQLite (six digit microseconds) so values compare and parse consistently.
+_NOW = "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+_CHANGE_FEED_DDL = tuple(
+    f"CREATE TRIGGER IF NOT EXISTS stamp_changes_{suffix} AFTER {event_name} ON stamps "
+    f"BEGIN INSERT INTO stamp_changes (stamp_id, op, changed_at) "
+    f"VALUES ({row}.id, '{op}', {_NOW}); END"
+    for suffix, event_name, row, op in (
+        ("ai", "INSERT", "NEW", "insert"),
+        ("au", "UPDATE", "NEW", "update"),
+        ("ad", "DELETE", "OLD", "delete"),
+    )
+) + (
+    # Replaced by stamp_changes.
+    "DROP TRIGGER IF EXISTS stamp_tombstones_ad",
+    "DROP TABLE IF EXISTS stamp_tombstones",
+)
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _install_change_feed(target, connection, **kw):
+    for statement in _CHANGE_FEED_DDL:
+        connection.exec_driver_sql(statement)
+
+
+def _parse_token(token: str) -> int:
+    try:
+        seq = int(token)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid change token")
+    if seq < 0:
+        raise ValueError("Invalid change token")
+    return seq
+
+
+def _latest(session) -> int:
+    return session.query(func.max(StampChange.seq)).scalar() or 0
+
+
+def new_token() -> str:
+    """Return a token for a snapshot the caller is about to read."""
+    with session_scope(read_only=True) as session:
+        return str(_latest(session))
+
+
+def change_token() -> int:
+    """Return a value that changes whenever any process commits an insert,
+    update or delete of a stamp.  One lookup at the end of the primary
+    key, so cheap enough to check before serving a cached read."""
+    with session_scope(read_only=True) as session:
+        return _latest(session)
+
+
+def changes_since(token: Optional[str] = None) -> Dict[str, Any]:
+    """Return the stamps changed since *token*.
+
+    The result has the keys:
+
+    ``token``
+        Pass this back on the next call.
+    ``reset``
+        ``True`` when the caller must discard its copy and use ``inserted``
+        as the full collection (first call, or a token whose changes were
+        pruned or that belongs to another database).
+    ``inserted`` / ``updated``
+        Lists of ``Stamp`` objects created or modified since the token.
+    ``deleted``
+        IDs of stamps removed since the token.
+    """
+    since = _parse_token(token) if token else None
+
+    # One read transaction, so the rows and the token match.
+    with session_scope(read_only=True) as session:
+        latest = _latest(session)
+        oldest = session.query(func.min(StampChange.seq)).scalar()
+        reset = (
+            since is None
+            or since > latest
+            or (oldest is not None and since < oldest - 1)
+        )
+        result: Dict[str, Any] = {
+            "token": str(latest),
+            "reset": reset,
+            "inserted": [],
+            "updated": [],
+            "deleted": [],
+        }
+        if reset:
+            result["inserted"] = session.query(Stamp).order_by(Stamp.id).all()
+            return result
+
+        last_op: Dict[int, str] = {}
+        inserted = set()
+        for stamp_id, op in (
+            session.query(StampChange.stamp_id, StampChange.op)
+            .filter(StampChange.seq > since)
+            .order_by(StampChange.seq)
+        ):
+            last_op[stamp_id] = op
+            if op == "insert":
+                inserted.add(stamp_id)
+        live = [sid for sid, op in last_op.items() if op != "delete"]
+        # A reused ID that was re-inserted after the delete is live.
+        result["deleted"] = sorted(sid for sid, op in last_op.items() if op == "delete")
+        if live:
+            for stamp in session.query(Stamp).filter(Stamp.id.in_(live)).order_by(Stamp.id):
+                result["inserted" if stamp.id in inserted else "updated"].append(stamp)
+        return result
+
+
+def prune_changes() -> int:
+    """Delete change rows older than ``CHANGE_RETENTION``, always keeping
+    the newest so the sequence carries on.  Returns the number removed."""
+    cutoff = datetime.utcnow() - CHANGE_RETENTION
+    with session_scope() as session:
+        newest = _latest(session)
+        return (
+            session.query(StampChange)
+            .filter(StampChange.changed_at < cutoff, StampChange.seq < newest)
+            .delete(synchronize_session=False)
+        )
+
+
+def _prune_task() -> Optional[str]:
+    removed = prune_changes()
+    return f"Pruned {removed} change-feed rows" if removed else None
+
+
+register_task("prune_changes", PRUNE_INTERVAL, _prune_task)
@@ -1,16 +1,42 @@
 """Configuration utilities for Stamp'd.
 
 Settings are stored in a JSON file so that the application can reload
-changes at runtime.  This module exposes helper functions to read and
-update that file as well as common path constants used throughout the
+changes at runtime.  The file is parsed once and cached by
+:data:`settings`, a :class:`ConfigService` that re-reads it only when its
+modification time changes -- checked at most once per
+``CHECK_INTERVAL`` seconds on access, or continuously by the watcher
+thread the app and workers start.  Every version is validated against
+:data:`CONFIG_SCHEMA`; an invalid edit is logged and ignored, keeping the
+last good settings.  Modules that keep settings in module constants
+load them with :meth:`ConfigService.bind`, which calls the loader with
+the section now and again whenever it changes, so edits apply without a
+restart::
+
+    @settings.bind("scan_jobs")
+    def _load_settings(section):
+        global SCAN_CHUNK_SIZE
+        SCAN_CHUNK_SIZE = section.get("chunk_size", 8)
+
+``CONFIG`` is a read-only, always-current view of the settings, so
+``CONFIG.get("ai_model")`` at call time sees edits without a restart.
+Only settings used once when a process starts need one:
+``workers.counts`` and ``workers.autostart`` (read when the pool starts)
+and ``metrics.host``/``port`` (the endpoint binds once).
+This module also exposes common path constants used throughout the
 project.
 """
 
 from __future__ import annotations
 
+import copy
+import functools
 import json
+import logging
 import os
-from typing import Any, Dict
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
@@ -30,26 +56,249 @@ DEFAULT_CONFIG: Dict[str, Any] = {
     "gallery": {"enable_search": True},
 }
 
+# Expected types of the known settings; sections are nested dicts.  Keys
+# not listed here are accepted as they are.
+_NUMBER = (int, float)
+CONFIG_SCHEMA: Dict[str, Any] = {
+    "ai_model": str,
+    "export_options": {
+        name: bool for name in ("csv", "xlsx", "pdf", "ebay", "hipstamp", "colnect", "stampworld")
+    },
+    "gallery": {
+        "enable_search": bool, "cache_size": int, "cache_ttl": _NUMBER,
+        "cache_check_interval": _NUMBER,
+    },
+    "inference": {"max_concurrent": int, "aging_seconds": _NUMBER},
+    "job_queue": {"lease_seconds": _NUMBER, "max_attempts": int, "retention_days": _NUMBER},
+    "workers": {"counts": dict, "autostart": bool, "poll_interval": _NUMBER, "shutdown_timeout": _NUMBER},
+    "logging": {"level": str, "levels": dict, "max_bytes": int, "backup_count": int, "console": bool},
+    "metrics": {"enabled": bool, "host": str, "port": int, "snapshot_interval": _NUMBER},
+    "profiling": {
+        "enabled": bool, "threshold_ms": _NUMBER, "mode": str,
+        "sample_interval_ms": _NUMBER, "max_profiles": int,
+    },
+    "resolver": {"min_confidence": _NUMBER, "phash_max_distance": int},
+    "reverse_lookup": {
+        "min_local_confidence": _NUMBER, "tineye_api_url": str,
+        "tineye_api_key": str, "remote_timeout": _NUMBER,
+    },
+    "ocr": {"workers": (int, type(None))},
+    "scan_jobs": {"storage_dir": str, "chunk_size": int, "lease_seconds": _NUMBER},
+    "backup": {
+        "enabled": bool, "interval_hours": _NUMBER, "keep": int, "pages_per_step": int,
+        "step_sleep_ms": _NUMBER, "include_images": bool, "compress": bool,
+    },
+}
+# Seconds between modification-time checks on access, and of the watcher.
+CHECK_INTERVAL = 1.0
+WATCH_INTERVAL = 2.0
+
+# log_utils imports this module, so log through the standard library here.
+logger = logging.getLogger("stampd.config")
+
+Subscriber = Callable[[Dict[str, Any], Dict[str, Any]], None]
+
+
+def _schema_errors(value: Any, schema: Any, path: str) -> List[str]:
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return [f"{path or 'config'} must be an object"]
+        errors = []
+        for key, expected in schema.items():
+            if key in value:
+                errors += _schema_errors(value[key], expected, f"{path}.{key}" if path else key)
+        return errors
+    types = schema if isinstance(schema, tuple) else (schema,)
+    # bool is an int subclass, but true is not a valid count.
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        names = " or ".join(t.__name__ for t in types)
+        return [f"{path} must be of type {names}, not {type(value).__name__}"]
+    return []
+
+
+def validate_config(cfg: Dict[str, Any], schema: Dict[str, Any] = CONFIG_SCHEMA) -> None:
+    """Raise ``ValueError`` listing every setting of *cfg* with the wrong type."""
+    errors = _schema_errors(cfg, schema, "")
+    if errors:
+        raise ValueError("Invalid configuration: " + "; ".join(errors))
+
+
+class ConfigService:
+    """Parsed settings of one JSON file, re-read when the file changes."""
+
+    def __init__(self, path: str, defaults: Optional[Dict[str, Any]] = None,
+                 check_interval: float = CHECK_INTERVAL):
+        self.path = path
+        self.defaults = DEFAULT_CONFIG if defaults is None else defaults
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._config: Dict[str, Any] = {}
+        self._signature: Optional[Tuple[int, int]] = None
+        self._checked = 0.0
+        self._subscribers: List[Subscriber] = []
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        if not os.path.exists(path):
+            self.save(self.defaults)
+        else:
+            self.reload(force=True, strict=True)
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        # Size too, for file systems with coarse timestamps.
+        return st.st_mtime_ns, st.st_size
+
+    def get(self) -> Dict[str, Any]:
+        """Return the current settings; do not modify them.  Checks the
+        file's modification time at most every ``check_interval`` seconds."""
+        if time.monotonic() - self._checked >= self.check_interval:
+            self.reload()
+        return self._config
+
+    def section(self, name: str) -> Dict[str, Any]:
+        """Return the *name* section, or ``{}`` when it is not set."""
+        return self.get().get(name, {})
+
+    def reload(self, force: bool = False, strict: bool = False) -> bool:
+        """Re-read the file if it changed since it was last read (always
+        with *force*); return True when the settings changed.
+
+        An unreadable or invalid file keeps the previous settings and is
+        logged, or raises ``ValueError`` with *strict*.
+        """
+        with self._lock:
+            self._checked = time.monotonic()
+            signature = self._stat()
+            if signature is None or (signature == self._signature and not force):
+                return False
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    cfg = json.load(f)
+                validate_config(cfg)
+            except (OSError, ValueError) as e:
+                if strict:
+                    raise ValueError(f"{self.path}: {e}") from e
+                logger.warning("⚠️ Ignoring changes to %s: %s", self.path, e)
+                self._signature = signature  # don't re-read until it changes again
+                return False
+            self._signature = signature
+            return self._replace(cfg)
+
+    def save(self, cfg: Dict[str, Any]) -> None:
+        """Validate *cfg*, write it to the file and apply it at once."""
+        validate_config(cfg)
+        cfg = copy.deepcopy(cfg)
+        with self._lock:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(cfg, f, indent=2)
+            os.replace(tmp, self.path)  # readers never see half a file
+            self._signature = self._stat()
+            self._checked = time.monotonic()
+            self._replace(cfg)
+
+    def _replace(self, cfg: Dict[str, Any]) -> bool:
+        previous = self._config
+        if cfg == previous:
+            return False
+        self._config = cfg
+        for callback in list(self._subscribers):
+            try:
+                callback(cfg, previous)
+            except Exception as e:
+                logger.exception("⚠️ Config subscriber %r failed: %s", callback, e)
+        return True
+
+    def subscribe(self, callback: Subscriber) -> Subscriber:
+        """Call ``callback(cfg, previous)`` after each change of the
+        settings; returns *callback*, so it also works as a decorator."""
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def bind(self, name: str, loader: Optional[Callable[[Dict[str, Any]], None]] = None) -> Any:
+        """Call ``loader(section)`` with the *name* section now and after
+        every change of it; returns *loader*.  Without *loader*, returns a
+        decorator for it."""
+        if loader is None:
+            return functools.partial(self.bind, name)
+
+        def apply(cfg: Dict[str, Any], previous: Dict[str, Any]) -> None:
+            if cfg.get(name, {}) != previous.get(name, {}):
+                loader(cfg.get(name, {}))
+
+        loader(self.section(name))
+        self.subscribe(apply)
+        return loader
+
+    def unsubscribe(self, callback: Subscriber) -> None:
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def start_watcher(self, interval: float = WATCH_INTERVAL) -> threading.Thread:
+        """Check the file every *interval* seconds from a daemon thread, so
+        subscribers hear of edits even when nothing reads the settings."""
+        with self._lock:
+            if self._watcher is None or not self._watcher.is_alive():
+                self._stop.clear()
+                self._watcher = threading.Thread(
+                    target=self._watch, args=(interval,), name="config-watcher", daemon=True
+                )
+                self._watcher.start()
+            return self._watcher
+
+    def stop_watcher(self) -> None:
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.reload()
+
+
+class _LiveConfig(Mapping):
+    """Read-only view of the current settings of a :class:`ConfigService`."""
+
+    def __init__(self, service: ConfigService):
+        self._service = service
+
+    def __getitem__(self, key: str) -> Any:
+        return self._service.get()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._service.get())
+
+    def __len__(self) -> int:
+        return len(self._service.get())
+
+    def __repr__(self) -> str:
+        return f"CONFIG({self._service.get()!r})"
+
 
 def load_config() -> Dict[str, Any]:
-    """Load configuration from ``CONFIG_FILE``.  If the file does not
-    exist, ``DEFAULT_CONFIG`` is written to disk and returned."""
+    """Return a copy of the settings, re-read from ``CONFIG_FILE`` only if
+    it changed.  If the file does not exist, ``DEFAULT_CONFIG`` is written
+    to disk and returned."""
     if not os.path.exists(CONFIG_FILE):
         save_config(DEFAULT_CONFIG)
-    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    settings.reload()
+    return copy.deepcopy(settings.get())
 
 
 def save_config(cfg: Dict[str, Any]) -> None:
-    """Persist *cfg* to ``CONFIG_FILE``."""
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, indent=2)
+    """Persist *cfg* to ``CONFIG_FILE`` and apply it; raises ``ValueError``
+    if it does not match :data:`CONFIG_SCHEMA`."""
+    settings.save(cfg)
 
 
-# Load configuration immediately for modules that simply need access to
-# values without wanting to manage file IO themselves.  Call ``load_config``
-# again if a refreshed copy is required.
-CONFIG = load_config()
+settings = ConfigService(CONFIG_FILE)
+CONFIG: Mapping = _LiveConfig(settings)
 
 # Common paths --------------------------------------------------------------
 DB_PATH = os.environ.get("STAMPD_DB_PATH", os.path.join(BASE_DIR, "stampd.db"))
@@ -1,13 +1,38 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Float, DateTime
+import sys
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session as OrmSession
 from datetime import datetime
 
+import metrics
+from log_utils import get_logger, setup_logging
+from maintenance import register_task
+
 DB_NAME = "stampd.db"
-DB_PATH = os.path.join(os.path.dirname(__file__), DB_NAME)
+DB_PATH = os.environ.get(
+    "STAMPD_DB_PATH", os.path.join(os.path.dirname(__file__), DB_NAME)
+)
+
+logger = get_logger("db")
 
 engine = create_engine(f"sqlite:///{DB_PATH}", echo=False)
+metrics.instrument_engine(engine)
+
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    # Worker processes write while the UI reads: WAL lets readers carry on
+    # during a write, and writers wait for each other instead of failing.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
 Base = declarative_base()
 Session = sessionmaker(bind=engine)
 
@@ -37,42 +62,156 @@ class Stamp(Base):
     lot_number = Column(String)
     listing_status = Column(String) # Unlisted, Draft, Live, Sold
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
-def init_db():
-    """Initializes the database and creates the table if not exists."""
-    Base.metadata.create_all(engine)
 
-def populate_missing_hashes():
-    """Populate file_hash for existing records that don't have it."""
-    from image_utils import get_file_hash
-    session = Session()
-    try:
-from image_utils import get_file_hash
-    session = Session()
+@event.listens_for(Base.metadata, "after_create")
+def _add_missing_columns(target, connection, tables=(), **kw):
+    # Tables from older versions lack newer columns, and create_all does not
+    # alter existing tables.  Registered before the other modules' hooks, so
+    # their triggers and indexes can rely on every column being there.
+    for table in target.sorted_tables:
+        if table in tables:
+            continue
+        existing = {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+        if not existing:
+            continue
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.warning("⚠️ Cannot add NOT NULL column %s.%s; recreate the table", table.name, column.name)
+                continue
+            ddl_type = column.type.compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {ddl_type}')
+            logger.info("🛠️ Added column %s.%s", table.name, column.name)
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    # Rows from before ``updated_at`` existed count as last changed when
+    # they were created.
+    connection.exec_driver_sql(
+        "UPDATE stamps SET updated_at = COALESCE(created_at, strftime('%Y-%m-%d %H:%M:%f000', 'now')) "
+        "WHERE updated_at IS NULL"
+    )
+
+@contextmanager
+def session_scope(factory=None, read_only=False):
+    """Provide a session for one request or unit of work.
+
+    The session is committed on success, rolled back on error and always
+    closed, so connections go back to the pool and the identity map is
+    released.  Read-only scopes use ``expire_on_commit=False`` so returned
+    objects stay readable after the scope ends, never commit, and refuse to
+    flush.  *factory* defaults to :data:`Session`.
+
+        with session_scope(read_only=True) as session:
+            stamps = session.query(Stamp).all()
+    """
+    factory = factory or Session
+    if read_only:
+        session = factory(expire_on_commit=False, autoflush=False)
+        session.info["read_only"] = True
+    else:
+        session = factory()
     try:
-        # Process stamps in batches
-        batch_size = 100
-        offset = 0
-        while True:
-            stamps_without_hash = session.query(Stamp).filter(Stamp.file_hash.is_(None)).limit(batch_size).offset(offset).all()
-            if not stamps_without_hash:
-                break
-            for stamp in stamps_without_hash:
-                if stamp.image_path and os.path.exists(stamp.image_path):
-                    stamp.file_hash = get_file_hash(stamp.image_path)
+        yield session
+        # Read-only scopes just close: a rollback would expire the loaded
+        # objects, and close() releases the connection all the same.
+        if not read_only:
             session.commit()
-            offset += batch_size
-            print(f"✅ Updated {len(stamps_without_hash)} stamps with file hashes")
-    except Exception as e:
+    except Exception:
         session.rollback()
-        print(f"❌ Error populating hashes: {e}")
-        for stamp in stamps_without_hash:
-            if stamp.image_path and os.path.exists(stamp.image_path):
-                stamp.file_hash = get_file_hash(stamp.image_path)
-        session.commit()
-        print(f"✅ Updated {len(stamps_without_hash)} stamps with file hashes")
-Base.metadata.create_all(engine)
+        raise
+    finally:
+        session.close()
+
+
+@event.listens_for(OrmSession, "before_flush")
+def _reject_read_only_flush(session, flush_context, instances):
+    if session.info.get("read_only"):
+        raise RuntimeError("Attempted to write through a read-only session")
+
+
+# Leak detection ------------------------------------------------------------
+# Every session that holds a connection (i.e. has begun a transaction) is
+# recorded with where it was opened, and forgotten once that transaction
+# ends.  Anything left here for long is a session that was never closed.
+_open_sessions: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_open_sessions_lock = threading.Lock()
+
+
+def _session_origin() -> str:
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if "sqlalchemy" not in filename and "contextlib" not in filename and filename != __file__:
+            return f"{os.path.basename(filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+
+@event.listens_for(OrmSession, "after_begin")
+def _track_session(session, transaction, connection):
+    with _open_sessions_lock:
+        if session not in _open_sessions:
+            _open_sessions[session] = (time.monotonic(), _session_origin())
+
+
+@event.listens_for(OrmSession, "after_transaction_end")
+def _untrack_session(session, transaction):
+    if transaction.parent is None:
+        with _open_sessions_lock:
+            _open_sessions.pop(session, None)
+
+
+def open_sessions(min_age=0.0):
+    """Return ``[{"origin", "age"}]`` for sessions still holding a connection
+    for at least *min_age* seconds, oldest first."""
+    now = time.monotonic()
+    with _open_sessions_lock:
+        entries = list(_open_sessions.values())
+    leaks = [
+        {"origin": origin, "age": round(now - started, 3)}
+        for started, origin in entries
+        if now - started >= min_age
+    ]
+    return sorted(leaks, key=lambda leak: -leak["age"])
+
+
+def report_open_sessions(min_age=30.0):
+    """Log and return a summary of sessions open longer than *min_age*."""
+    leaks = open_sessions(min_age)
+    lines = [f"🔌 Pool connections checked out: {engine.pool.checkedout()}"]
+    if not leaks:
+        lines.append("✅ No sessions open longer than %ss" % min_age)
+    for leak in leaks:
+        lines.append(f"⚠️ Session open {leak['age']}s from {leak['origin']}")
+    report = "\n".join(lines)
+    if leaks:
+        logger.warning(report)
+    else:
+        logger.info(report)
+    return report
+
+
+# Sessions open longer than this are reported by the maintenance thread.
+LEAK_AGE = 30.0
+LEAK_CHECK_INTERVAL = 300
+
+
+def _check_sessions():
+    # Only worth a log line when something is actually leaking.
+    if open_sessions(LEAK_AGE):
+        report_open_sessions(LEAK_AGE)
+
+
+register_task("report_open_sessions", LEAK_CHECK_INTERVAL, _check_sessions)
+
+
+def init_db():
+    """Initializes the database and creates the table if not exists."""
+    import changes, facets, job_queue, metadata_resolver, ocr_utils, scan_jobs  # noqa: F401  register summary tables and triggers
+    Base.metadata.create_all(engine)
 
 def populate_missing_hashes():
     """Populate file_hash for existing records that don't have it."""
@@ -85,27 +224,21 @@ def populate_missing_hashes():
             if stamp.image_path and os.path.exists(stamp.image_path):
                 stamp.file_hash = get_file_hash(stamp.image_path)
         session.commit()
-        print(f"✅ Updated {len(stamps_without_hash)} stamps with file hashes")
+        logger.info("✅ Updated %d stamps with file hashes", len(stamps_without_hash))
     except SQLAlchemyError as e:
         session.rollback()
-        print(f"❌ Database error while populating hashes: {e}")
+        logger.error("❌ Database error while populating hashes: %s", e)
     except IOError as e:
         session.rollback()
-        print(f"❌ File I/O error while populating hashes: {e}")
+        logger.error("❌ File I/O error while populating hashes: %s", e)
     except Exception as e:
         session.rollback()
-        print(f"❌ Unexpected error while populating hashes: {e}")
-    finally:
-        session.close()
-
-if __name__ == "__main__":
-    init_db()
-        session.rollback()
-        print(f"❌ Error populating hashes: {e}")
+        logger.exception("❌ Unexpected error while populating hashes: %s", e)
     finally:
         session.close()
 
 if __name__ == "__main__":
+    setup_logging("db")
     init_db()
     populate_missing_hashes()
-    print("✅ Database initialized at", DB_PATH)
+    logger.info("✅ Database initialized at %s", DB_PATH)
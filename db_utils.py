@@ -12,6 +12,8 @@ from sqlalchemy.orm import sessionmaker
 from typing import Any, Dict, Iterable, List
 
 from config import DB_PATH
+from db import session_scope
+from metrics import instrument_engine
 
 Base = declarative_base()
 
@@ -47,6 +49,7 @@ class Stamp(Base):
 
 # Create engine and session
 engine = create_engine(f"sqlite:///{DB_PATH}")
+instrument_engine(engine)
 Session = sessionmaker(bind=engine)
 
 
@@ -55,50 +58,33 @@ def init_db() -> None:
 
 
 def insert_stamp(data: Dict[str, Any]) -> int:
-    session = Session()
-    try:
+    with session_scope(Session) as session:
         stamp = Stamp(**data)
         session.add(stamp)
-        session.commit()
+        session.flush()
         return stamp.id
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
 
 def insert_many(stamps: Iterable[Dict[str, Any]]) -> None:
-    session = Session()
-    try:
+    with session_scope(Session) as session:
         session.add_all([Stamp(**s) for s in stamps])
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
 
 def get_all_stamps() -> List[Stamp]:
-    session = Session()
-    try:
+    with session_scope(Session, read_only=True) as session:
         return session.query(Stamp).all()
-    finally:
-        session.close()
 
 
 def get_stamp(stamp_id: int) -> Stamp | None:
-    session = Session()
-    return session.query(Stamp).get(stamp_id)
+    with session_scope(Session, read_only=True) as session:
+        return session.get(Stamp, stamp_id)
 
 
 def update_stamp(stamp_id: int, **fields: Any) -> int:
-    session = Session()
-    stamp = session.query(Stamp).get(stamp_id)
-    if not stamp:
-        raise ValueError("Stamp not found")
-    for key, value in fields.items():
-        setattr(stamp, key, value)
-    session.commit()
+    with session_scope(Session) as session:
+        stamp = session.get(Stamp, stamp_id)
+        if not stamp:
+            raise ValueError("Stamp not found")
+        for key, value in fields.items():
+            setattr(stamp, key, value)
     return stamp_id
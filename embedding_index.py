@@ -0,0 +1,300 @@
+"""Local "looks like this" search for Stamp'd.
+
+Every catalogued image is reduced to a 256-dimensional descriptor: a joint
+HSV colour histogram plus a grid of gradient-orientation histograms for
+edges and texture.  Descriptors are stored as one contiguous float32 array
+in ``<db name>.embeddings.f32``, read through a memory map, so a top-k
+cosine query is a single matrix-vector product.  Rows are keyed by file
+hash (``.keys``), so duplicate files share a row and deleted or re-used
+stamp ids never point at a stale descriptor.  New images are appended when
+they are saved; the files are only rewritten by :func:`rebuild_index`.
+Searches never walk the catalogue -- :func:`sync_index` picks up anything
+missed and runs when the workers start or on demand.  Hashes of images that
+cannot be read are listed in ``.unreadable`` and skipped until a rebuild.
+
+Worker processes append concurrently, so every append holds an exclusive
+lock on ``.lock`` and first trims both files to the rows they have in
+common, which keeps keys and vectors aligned after a crash mid-append.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import event
+
+from db import DB_PATH, Base, Stamp, session_scope
+
+HSV_BINS = (8, 4, 4)      # hue, saturation, value
+EDGE_GRID = 4             # 4x4 cells ...
+EDGE_ORIENTATIONS = 8     # ... of 8 orientation bins
+DESCRIPTOR_SIZE = 64      # images are compared at 64x64
+EMBEDDING_DIM = int(np.prod(HSV_BINS)) + EDGE_GRID * EDGE_GRID * EDGE_ORIENTATIONS
+COLOUR_WEIGHT = 0.6       # share of the similarity given to colour
+
+INDEX_BASE = os.path.splitext(DB_PATH)[0] + ".embeddings"
+VECTORS_PATH = INDEX_BASE + ".f32"
+KEYS_PATH = INDEX_BASE + ".keys"
+LOCK_PATH = INDEX_BASE + ".lock"
+UNREADABLE_PATH = INDEX_BASE + ".unreadable"
+KEY_DTYPE = np.dtype("S32")  # hex MD5 from image_utils.get_file_hash
+
+_lock = threading.Lock()
+_cache: Dict[str, object] = {}
+
+
+def _unit(vec: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+def image_embedding(image_path: str) -> Optional[np.ndarray]:
+    """Return the unit-length float32 descriptor of *image_path*, or None."""
+    try:
+        with Image.open(image_path) as img:
+            img.draft("RGB", (DESCRIPTOR_SIZE * 2, DESCRIPTOR_SIZE * 2))
+            small = img.convert("RGB").resize((DESCRIPTOR_SIZE, DESCRIPTOR_SIZE), Image.BILINEAR)
+    except (OSError, ValueError):
+        return None
+
+    hsv = np.asarray(small.convert("HSV"), dtype=np.int32)
+    bins = np.array(HSV_BINS)
+    q = hsv * bins // 256
+    joint = (q[..., 0] * bins[1] + q[..., 1]) * bins[2] + q[..., 2]
+    colour = np.bincount(joint.ravel(), minlength=int(bins.prod())).astype(np.float32)
+    colour = _unit(np.sqrt(colour))  # Hellinger: damp dominant background bins
+
+    gray = np.asarray(small.convert("L"), dtype=np.float32)
+    gx = np.zeros_like(gray)
+    gy = np.zeros_like(gray)
+    gx[:, 1:-1] = gray[:, 2:] - gray[:, :-2]
+    gy[1:-1, :] = gray[2:, :] - gray[:-2, :]
+    magnitude = np.hypot(gx, gy)
+    orientation = (np.arctan2(gy, gx) % np.pi) / np.pi * EDGE_ORIENTATIONS
+    orientation = np.minimum(orientation.astype(np.int32), EDGE_ORIENTATIONS - 1)
+    cell = DESCRIPTOR_SIZE // EDGE_GRID
+    rows, cols = np.indices(gray.shape) // cell
+    index = (rows * EDGE_GRID + cols) * EDGE_ORIENTATIONS + orientation
+    edges = np.bincount(
+        index.ravel(), weights=magnitude.ravel(),
+        minlength=EDGE_GRID * EDGE_GRID * EDGE_ORIENTATIONS,
+    ).astype(np.float32)
+    edges = _unit(np.sqrt(edges))
+
+    vec = np.concatenate([
+        colour * np.sqrt(COLOUR_WEIGHT),
+        edges * np.sqrt(1 - COLOUR_WEIGHT),
+    ])
+    return _unit(vec).astype(np.float32)
+
+
+@contextmanager
+def _index_lock() -> Iterator[None]:
+    """Hold this process's lock and the cross-process lock on ``LOCK_PATH``."""
+    with _lock, open(LOCK_PATH, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # gave up after ~10 s; keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _row_count() -> int:
+    """Rows present in both files; trims a longer file left by a crash.
+    Call with :func:`_index_lock` held."""
+    if not (os.path.exists(VECTORS_PATH) and os.path.exists(KEYS_PATH)):
+        for path in (VECTORS_PATH, KEYS_PATH):
+            open(path, "ab").close()
+        return 0
+    count = min(
+        os.path.getsize(KEYS_PATH) // KEY_DTYPE.itemsize,
+        os.path.getsize(VECTORS_PATH) // (EMBEDDING_DIM * 4),
+    )
+    for path, row_bytes in ((KEYS_PATH, KEY_DTYPE.itemsize), (VECTORS_PATH, EMBEDDING_DIM * 4)):
+        if os.path.getsize(path) != count * row_bytes:
+            with open(path, "r+b") as f:
+                f.truncate(count * row_bytes)
+    return count
+
+
+def _load() -> Tuple[np.ndarray, np.ndarray]:
+    """Return ``(keys, vectors)`` memory-mapped from disk (cached by size)."""
+    if not (os.path.exists(VECTORS_PATH) and os.path.exists(KEYS_PATH)):
+        return np.zeros(0, dtype=KEY_DTYPE), np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    sizes = (os.path.getsize(KEYS_PATH), os.path.getsize(VECTORS_PATH))
+    if _cache.get("sizes") != sizes:
+        # A crash between the two appends leaves one file longer; only rows
+        # present in both are used.
+        count = min(sizes[0] // KEY_DTYPE.itemsize, sizes[1] // (EMBEDDING_DIM * 4))
+        keys = np.fromfile(KEYS_PATH, dtype=KEY_DTYPE, count=count)
+        if count == 0:
+            vectors = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        else:
+            vectors = np.memmap(
+                VECTORS_PATH, dtype=np.float32, mode="r", shape=(count, EMBEDDING_DIM)
+            )
+        _cache.update(sizes=sizes, keys=keys, vectors=vectors)
+    return _cache["keys"], _cache["vectors"]
+
+
+def indexed_hashes() -> set:
+    return {key.decode() for key in _load()[0]}
+
+
+def indexed_vectors(file_hashes: Iterable[str]) -> Dict[str, np.ndarray]:
+    """Return ``{file_hash: descriptor}`` for those of *file_hashes* that
+    are indexed, without reading any image."""
+    keys, vectors = _load()
+    wanted = np.array([h.encode() for h in set(file_hashes) if h], dtype=KEY_DTYPE)
+    if not len(wanted) or not len(keys):
+        return {}
+    rows = np.nonzero(np.isin(keys, wanted))[0]
+    return {keys[i].decode(): np.asarray(vectors[i]) for i in rows}
+
+
+def unreadable_hashes() -> set:
+    """Hashes whose image could not be read; they are not retried."""
+    if not os.path.exists(UNREADABLE_PATH):
+        return set()
+    with open(UNREADABLE_PATH, "r", encoding="ascii") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def add_to_index(images: Iterable[Tuple[str, str]]) -> int:
+    """Append descriptors for ``(file_hash, image_path)`` pairs not yet
+    indexed; return how many were added."""
+    with _index_lock():
+        _row_count()
+        # Including rows other processes appended.
+        known = indexed_hashes() | unreadable_hashes()
+        keys, vectors, unreadable = [], [], []
+        for file_hash, image_path in images:
+            if not file_hash or file_hash in known or not image_path:
+                continue
+            known.add(file_hash)
+            vec = image_embedding(image_path)
+            if vec is None:
+                unreadable.append(file_hash)
+                continue
+            keys.append(file_hash)
+            vectors.append(vec)
+        if unreadable:
+            with open(UNREADABLE_PATH, "a", encoding="ascii") as f:
+                f.writelines(h + "\n" for h in unreadable)
+        if keys:
+            with open(VECTORS_PATH, "ab") as f:
+                np.asarray(vectors, dtype=np.float32).tofile(f)
+            with open(KEYS_PATH, "ab") as f:
+                np.asarray(keys, dtype=KEY_DTYPE).tofile(f)
+        return len(keys)
+
+
+def sync_index() -> int:
+    """Index every catalogued image that has no descriptor yet."""
+    with session_scope(read_only=True) as session:
+        rows = (
+            session.query(Stamp.file_hash, Stamp.image_path)
+            .filter(Stamp.file_hash.isnot(None))
+            .group_by(Stamp.file_hash)
+            .all()
+        )
+    known = indexed_hashes() | unreadable_hashes()
+    return add_to_index((h, path) for h, path in rows if h not in known)
+
+
+def clear_index() -> None:
+    with _index_lock():
+        for path in (VECTORS_PATH, KEYS_PATH, UNREADABLE_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+        _cache.clear()
+
+
+def rebuild_index() -> int:
+    """Recompute the whole index, dropping images no stamp uses any more
+    and retrying ones that could not be read."""
+    clear_index()
+    return sync_index()
+
+
+@event.listens_for(Base.metadata, "after_drop")
+def _clear_on_drop(target, connection, **kw):
+    clear_index()
+
+
+def find_similar(
+    stamp_id: Optional[int] = None, image_path: Optional[str] = None, k: int = 10,
+    vector: Optional[np.ndarray] = None,
+) -> List[Tuple[int, float]]:
+    """Return up to *k* ``(stamp_id, cosine similarity)`` pairs most like
+    stamp *stamp_id*, the image at *image_path* or the descriptor *vector*
+    (from :func:`image_embedding`), best first.
+
+    Other stamps with the very same file score 1.0; the query stamp itself
+    is left out.  Only indexed images are searched.
+    """
+    keys, vectors = _load()
+    if stamp_id is not None:
+        with session_scope(read_only=True) as session:
+            stamp = session.get(Stamp, int(stamp_id))
+        if stamp is None:
+            raise ValueError(f"Stamp {stamp_id} not found")
+        hits = np.nonzero(keys == (stamp.file_hash or "").encode())[0]
+        if len(hits):
+            query = np.asarray(vectors[hits[0]])
+        else:
+            query = image_embedding(stamp.image_path) if stamp.image_path else None
+    elif vector is not None:
+        query = vector
+    elif image_path is not None:
+        query = image_embedding(image_path)
+    else:
+        raise ValueError("find_similar needs a stamp_id, an image_path or a vector")
+    if query is None:
+        raise ValueError("The stamp image cannot be read")
+    if len(keys) == 0:
+        return []
+
+    scores = vectors @ query
+    # Several stamps can share a file; over-fetch rows so k stamps remain
+    # after dropping the query stamp and rows no stamp uses any more.
+    fetch = min(len(keys), k + 8)
+    top = np.argpartition(-scores, fetch - 1)[:fetch]
+    score_by_hash = {keys[i].decode(): float(scores[i]) for i in top}
+
+    with session_scope(read_only=True) as session:
+        rows = (
+            session.query(Stamp.id, Stamp.file_hash)
+            .filter(Stamp.file_hash.in_(list(score_by_hash)))
+            .all()
+        )
+    matches = [
+        (sid, round(min(1.0, score_by_hash[file_hash]), 4))
+        for sid, file_hash in rows
+        if stamp_id is None or sid != int(stamp_id)
+    ]
+    matches.sort(key=lambda m: (-m[1], m[0]))
+    return matches[:k]
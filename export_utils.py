@@ -11,23 +11,28 @@ import os
 from datetime import datetime
 from typing import List
 
-from fpdf import FPDF
-from openpyxl import Workbook
-
+from db import session_scope
 from db_utils import Session, Stamp
 from config import BACKUP_DIR
+from metrics import timed
 
 
 def _timestamp() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
 
+def _all_stamps() -> List[Stamp]:
+    # Read-only scope: rows stay readable after the session is closed.
+    with session_scope(Session, read_only=True) as session:
+        return session.query(Stamp).all()
+
+
+@timed("export_csv")
 def export_csv() -> str:
     """Export all stamps to a CSV file and return the path."""
     import csv
 
-    session = Session()
-    stamps: List[Stamp] = session.query(Stamp).all()
+    stamps = _all_stamps()
     filepath = os.path.join(BACKUP_DIR, f"export_{_timestamp()}.csv")
     fields = [
         "id",
@@ -45,10 +50,12 @@ def export_csv() -> str:
     return filepath
 
 
+@timed("export_xlsx")
 def export_xlsx() -> str:
     """Export all stamps to an XLSX file and return the path."""
-    session = Session()
-    stamps: List[Stamp] = session.query(Stamp).all()
+    from openpyxl import Workbook
+
+    stamps = _all_stamps()
     wb = Workbook()
     ws = wb.active
     headers = [
@@ -76,10 +83,12 @@ def export_xlsx() -> str:
     return filepath
 
 
+@timed("export_pdf")
 def export_pdf() -> str:
     """Create a simple PDF catalogue with images and metadata."""
-    session = Session()
-    stamps: List[Stamp] = session.query(Stamp).all()
+    from fpdf import FPDF
+
+    stamps = _all_stamps()
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=15)
     for s in stamps:
@@ -0,0 +1,127 @@
+"""Faceted browsing support for Stamp'd.
+
+Counts per facet value (country, year, decade, collection, mint/used and
+listing status) are stored in the ``stamp_facets`` summary table.  SQLite
+triggers on ``stamps`` keep the counts up to date on every insert, update
+and delete, so the gallery can show filter counts without running a
+``GROUP BY`` over the whole collection on each click.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Column, Integer, String, event, literal_column
+
+from db import Base, Stamp, session_scope
+
+UNKNOWN = "Unknown"
+
+# Facet name -> (source column, SQL expression).  ``{col}`` is replaced with
+# the qualified column, e.g. ``NEW.year`` inside a trigger or ``stamps.year``
+# when filtering, so counts and filters always agree on bucketing.
+FACETS: Dict[str, Tuple[str, str]] = {
+    "country": ("country", "{col}"),
+    "year": ("year", "{col}"),
+    "decade": (
+        "year",
+        "CASE WHEN {col} GLOB '[12][0-9][0-9][0-9]*' "
+        "THEN substr({col}, 1, 3) || '0s' END",
+    ),
+    "collection": ("collection", "{col}"),
+    "mint_used": ("mint_used", "{col}"),
+    "listing_status": ("listing_status", "{col}"),
+}
+
+
+class StampFacet(Base):
+    __tablename__ = "stamp_facets"
+
+    facet = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+def facet_value_sql(facet: str, row: str = "stamps") -> str:
+    """Return the SQL expression bucketing *row* into a value of *facet*."""
+    column, expr = FACETS[facet]
+    bucket = expr.format(col=f"{row}.{column}")
+    return f"COALESCE(NULLIF(TRIM({bucket}), ''), '{UNKNOWN}')"
+
+
+def _bump_statements(row: str, delta: int) -> List[str]:
+    return [
+        "INSERT INTO stamp_facets (facet, value, count) "
+        f"VALUES ('{facet}', {facet_value_sql(facet, row)}, {delta}) "
+        f"ON CONFLICT(facet, value) DO UPDATE SET count = count + {delta};"
+        for facet in FACETS
+    ]
+
+
+def _trigger_ddl() -> List[str]:
+    columns = ", ".join(sorted({column for column, _ in FACETS.values()}))
+    insert_body = " ".join(_bump_statements("NEW", 1))
+    delete_body = " ".join(_bump_statements("OLD", -1))
+    return [
+        "CREATE TRIGGER IF NOT EXISTS stamp_facets_ai AFTER INSERT ON stamps "
+        f"BEGIN {insert_body} END",
+        "CREATE TRIGGER IF NOT EXISTS stamp_facets_ad AFTER DELETE ON stamps "
+        f"BEGIN {delete_body} END",
+        f"CREATE TRIGGER IF NOT EXISTS stamp_facets_au AFTER UPDATE OF {columns} "
+        f"ON stamps BEGIN {delete_body} {insert_body} END",
+    ]
+
+
+def rebuild_facets(connection) -> None:
+    """Recompute every facet count from ``stamps`` using *connection*.
+
+    Only needed once when the summary table is first created on an existing
+    database; afterwards the triggers keep the counts in sync.
+    """
+    connection.exec_driver_sql("DELETE FROM stamp_facets")
+    for facet in FACETS:
+        value = facet_value_sql(facet)
+        connection.exec_driver_sql(
+            "INSERT INTO stamp_facets (facet, value, count) "
+            f"SELECT '{facet}', {value}, COUNT(*) FROM stamps GROUP BY {value}"
+        )
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _install_facet_triggers(target, connection, tables=(), **kw):
+    for statement in _trigger_ddl():
+        connection.exec_driver_sql(statement)
+    if StampFacet.__table__ in tables:
+        rebuild_facets(connection)
+
+
+def facet_counts() -> Dict[str, List[Tuple[str, int]]]:
+    """Return ``{facet: [(value, count), ...]}`` ordered by descending count."""
+    with session_scope(read_only=True) as session:
+        rows = (
+            session.query(StampFacet)
+            .filter(StampFacet.count > 0)
+            .order_by(StampFacet.count.desc(), StampFacet.value)
+            .all()
+        )
+        counts: Dict[str, List[Tuple[str, int]]] = {name: [] for name in FACETS}
+        for row in rows:
+            if row.facet in counts:
+                counts[row.facet].append((row.value, row.count))
+        return counts
+
+
+def apply_facet_filters(q, filters: Dict[str, str]):
+    """Restrict query *q* on ``Stamp`` to rows matching the facet *filters*.
+
+    Uses the same bucketing expressions as the summary table so a stamp is
+    returned exactly when it is counted under the selected value.
+    """
+    for facet in FACETS:
+        value = filters.get(facet)
+        if not value:
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f"Facet filter '{facet}' must be a string")
+        q = q.filter(literal_column(facet_value_sql(facet, Stamp.__tablename__)) == value)
+    return q
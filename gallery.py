@@ -1,14 +1,22 @@
 
 from config import *
-from sqlalchemy import Table, Column, Integer, String, ForeignKey
-from sqlalchemy.orm import relationship, sessionmaker
-from db import Base, Session, Stamp
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, Index
+from sqlalchemy import event, func, intersect, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import relationship
+from db import Base, Session, Stamp, session_scope
+from facets import apply_facet_filters
+from query_cache import cached_query, frozen_rows, invalidates, normalize
 
 # Define Tag model and association table if not present
 tag_association = Table(
     'stamp_tags', Base.metadata,
-    Column('stamp_id', Integer, ForeignKey('stamps.id')),
-    Column('tag_id', Integer, ForeignKey('tags.id'))
+    Column('stamp_id', Integer, ForeignKey('stamps.id'), nullable=False),
+    Column('tag_id', Integer, ForeignKey('tags.id'), nullable=False),
+    Index('uq_stamp_tags', 'stamp_id', 'tag_id', unique=True),
+    Index('ix_stamp_tags_tag_stamp', 'tag_id', 'stamp_id'),
 )
 
 class Tag(Base):
@@ -19,22 +27,99 @@ class Tag(Base):
 
 Stamp.tags = relationship('Tag', secondary=tag_association, back_populates='stamps')
 
+TAG_MODES = ("any", "all")
+
+
+@event.listens_for(Base.metadata, "before_create")
+def _migrate_tag_association(target, connection, tables=(), **kw):
+    # Databases created before the unique index may hold duplicate pairs,
+    # which would stop db._add_missing_columns from creating it.  Once the
+    # index exists there is nothing to do, so the dedupe runs only once.
+    if tag_association in tables:
+        return
+    indexes = {row[1] for row in connection.exec_driver_sql("PRAGMA index_list(stamp_tags)")}
+    if "uq_stamp_tags" in indexes:
+        return
+    connection.exec_driver_sql(
+        "DELETE FROM stamp_tags WHERE rowid NOT IN "
+        "(SELECT MIN(rowid) FROM stamp_tags GROUP BY stamp_id, tag_id)"
+    )
+    connection.exec_driver_sql("DROP INDEX IF EXISTS uq_stamp_tags_pair")
+
+
+def _sanitize_tag(tag_name):
+    # Allow only alphanumeric characters, spaces, and hyphens
+    import re
+    return re.sub(r'[^\w\s\-]', '', tag_name.strip())
+
+
+def _tagged_stamp_ids(tag_names, mode="any"):
+    """Return a SELECT of stamp IDs carrying any/all of *tag_names*.
+
+    ``any`` is a single semi-join on the (tag_id, stamp_id) index; ``all``
+    INTERSECTs one such SELECT per tag, so no stamp is returned twice.
+    """
+    def ids_for(names):
+        return (
+            select(tag_association.c.stamp_id)
+            .join(Tag, Tag.id == tag_association.c.tag_id)
+            .where(Tag.name.in_(names))
+        )
+
+    if mode == "all" and len(tag_names) > 1:
+        return intersect(*(ids_for([name]) for name in tag_names))
+    return ids_for(tag_names)
+
 
+def _touch_stamps(session, stamp_ids):
+    # Tag changes touch the stamp rows so the change feed reports them.
+    session.execute(
+        Stamp.__table__.update()
+        .where(Stamp.id.in_(stamp_ids))
+        .values(updated_at=datetime.utcnow())
+    )
+
+
+def _get_or_create_tag_id(session, name):
+    session.execute(sqlite_insert(Tag).values(name=name).on_conflict_do_nothing())
+    return session.execute(select(Tag.id).where(Tag.name == name)).scalar_one()
+
+
+def _search_key(query="", filters={}):
+    # Text search uses ilike, so case and repeated whitespace do not matter.
+    if isinstance(query, str):
+        query = " ".join(query.lower().split())
+    return normalize(query), normalize(filters)
+
+
+def _search_scopes(query="", filters={}):
+    if isinstance(filters, dict) and filters.get("tags"):
+        return {"stamps", "tags"}
+    return {"stamps"}
+
+
+@cached_query("search_stamps", _search_scopes, key=_search_key)
 def search_stamps(query="", filters={}):
     """Search stamps by query string and filters.
     
     Args:
         query (str): Search term to match against country and description fields
-        filters (dict): Additional filters, currently supports 'tags' key with list of tag names
+        filters (dict): Additional filters. Supports a 'tags' key with a list of tag
+            names, matched according to 'tag_mode' ('any' by default or 'all'),
+            plus one value per facet in ``facets.FACETS`` (e.g. 'country',
+            'decade', 'listing_status') and an 'ids' list restricting the
+            result to those stamp IDs
         
     Returns:
-        list: List of Stamp objects matching the search criteria
+        list: Read-only rows (named tuples with the ``Stamp`` column names)
+            of the stamps matching the search criteria
         
     Note:
-        Uses parameterized queries to prevent SQL injection attacks.
+        Uses parameterized queries to prevent SQL injection attacks. Results
+        are cached in ``query_cache.gallery_cache`` until a write hook
+        invalidates them.
     """
-    session = Session()
-    try:
+    with session_scope(Session, read_only=True) as session:
         q = session.query(Stamp)
         if query:
             # Validate and sanitize the query input
@@ -62,21 +147,31 @@ def search_stamps(query="", filters={}):
             for tag in tags:
                 if not isinstance(tag, str):
                     raise ValueError("Each tag must be a string")
-                # Sanitize tag names - allow only alphanumeric characters, spaces, and hyphens
-                import re
-                sanitized_tag = re.sub(r'[^\w\s\-]', '', tag.strip())
+                sanitized_tag = _sanitize_tag(tag)
                 if sanitized_tag:  # Only add non-empty tags
                     validated_tags.append(sanitized_tag)
             
+            mode = filters.get("tag_mode", "any")
+            if mode not in TAG_MODES:
+                raise ValueError(f"Tag mode must be one of {TAG_MODES}")
+
             if validated_tags:
-                # Use SQLAlchemy's in_() method which properly handles parameterization
-                q = q.join(Stamp.tags).filter(Tag.name.in_(validated_tags))
-        
-        return q.all()
-    finally:
-        session.close()
+                # Set-based membership test, so a stamp matching several tags
+                # is still returned once
+                q = q.filter(Stamp.id.in_(_tagged_stamp_ids(validated_tags, mode)))
 
+        if filters.get("ids") is not None:
+            ids = filters["ids"]
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                raise ValueError("IDs filter must be a list of integers")
+            q = q.filter(Stamp.id.in_(ids))
 
+        q = apply_facet_filters(q, filters)
+
+        return frozen_rows(q.all())
+
+
+@invalidates(lambda stamp_id, tag_name: {"tags", f"stamp:{stamp_id}"})
 def add_tag(stamp_id, tag_name):
     """Add a tag to a stamp.
     
@@ -88,35 +183,103 @@ def add_tag(stamp_id, tag_name):
         ValueError: If inputs are invalid
         RuntimeError: If stamp is not found
     """
-    session = Session()
-    try:
+    with session_scope(Session) as session:
         # Validate inputs
         if not isinstance(stamp_id, int) or stamp_id <= 0:
             raise ValueError("Stamp ID must be a positive integer")
         if not isinstance(tag_name, str):
             raise ValueError("Tag name must be a string")
         
-        # Sanitize tag name
-        import re
-        sanitized_tag_name = re.sub(r'[^\w\s\-]', '', tag_name.strip())
+        sanitized_tag_name = _sanitize_tag(tag_name)
         if not sanitized_tag_name:
             raise ValueError("Tag name cannot be empty after sanitization")
         
-        # Get the stamp
-        stamp = session.query(Stamp).get(stamp_id)
-        if not stamp:
+        if not session.query(Stamp.id).filter(Stamp.id == stamp_id).first():
             raise RuntimeError(f"Stamp with ID {stamp_id} not found")
         
-        # Get or create the tag
-        tag = session.query(Tag).filter_by(name=sanitized_tag_name).first()
-        if not tag:
-            tag = Tag(name=sanitized_tag_name)
-            session.add(tag)
-            session.commit()  # Commit to get the tag ID
-        
-        # Add tag to stamp if not already present
-        if tag not in stamp.tags:
-            stamp.tags.append(tag)
-            session.commit()
-    finally:
-        session.close()
+        # Get or create the tag and link it in one transaction; the unique
+        # (stamp_id, tag_id) constraint makes re-tagging a no-op
+        tag_id = _get_or_create_tag_id(session, sanitized_tag_name)
+        session.execute(
+            sqlite_insert(tag_association)
+            .values(stamp_id=stamp_id, tag_id=tag_id)
+            .on_conflict_do_nothing()
+        )
+        _touch_stamps(session, [stamp_id])
+
+
+def _validate_bulk_args(stamp_ids, tag_name):
+    if not isinstance(stamp_ids, (list, tuple, set)) or not all(
+        isinstance(i, int) and i > 0 for i in stamp_ids
+    ):
+        raise ValueError("Stamp IDs must be a list of positive integers")
+    if not isinstance(tag_name, str):
+        raise ValueError("Tag name must be a string")
+    sanitized_tag_name = _sanitize_tag(tag_name)
+    if not sanitized_tag_name:
+        raise ValueError("Tag name cannot be empty after sanitization")
+    return list(set(stamp_ids)), sanitized_tag_name
+
+
+def _bulk_scopes(stamp_ids, tag_name):
+    ids = stamp_ids if isinstance(stamp_ids, (list, tuple, set)) else []
+    return {"tags", *(f"stamp:{i}" for i in ids)}
+
+
+@invalidates(_bulk_scopes)
+def bulk_tag(stamp_ids, tag_name):
+    """Add a tag to many stamps with a single INSERT ... SELECT.
+
+    IDs that do not exist are ignored. Returns the number of new links.
+    """
+    stamp_ids, sanitized_tag_name = _validate_bulk_args(stamp_ids, tag_name)
+    with session_scope(Session) as session:
+        tag_id = _get_or_create_tag_id(session, sanitized_tag_name)
+        result = session.execute(
+            sqlite_insert(tag_association)
+            .from_select(
+                ["stamp_id", "tag_id"],
+                select(Stamp.id, tag_id).where(Stamp.id.in_(stamp_ids)),
+            )
+            .on_conflict_do_nothing()
+        )
+        _touch_stamps(session, stamp_ids)
+        return result.rowcount
+
+
+@invalidates(_bulk_scopes)
+def bulk_untag(stamp_ids, tag_name):
+    """Remove a tag from many stamps with a single DELETE.
+
+    Returns the number of links removed.
+    """
+    stamp_ids, sanitized_tag_name = _validate_bulk_args(stamp_ids, tag_name)
+    with session_scope(Session) as session:
+        tag_id = select(Tag.id).where(Tag.name == sanitized_tag_name).scalar_subquery()
+        result = session.execute(
+            tag_association.delete().where(
+                tag_association.c.tag_id == tag_id,
+                tag_association.c.stamp_id.in_(stamp_ids),
+            )
+        )
+        _touch_stamps(session, stamp_ids)
+        return result.rowcount
+
+
+@cached_query("tag_counts", lambda: {"tags", "stamps"})
+def tag_counts():
+    """Return ``[(tag_name, stamp_count), ...]`` ordered by descending count.
+
+    Counted over the (tag_id, stamp_id) index and cached until a tag or
+    stamp write invalidates it.
+    """
+    with session_scope(Session, read_only=True) as session:
+        count = func.count(tag_association.c.stamp_id)
+        rows = session.execute(
+            select(Tag.name, count)
+            .join(tag_association, tag_association.c.tag_id == Tag.id)
+            .join(Stamp, Stamp.id == tag_association.c.stamp_id)
+            .group_by(Tag.id)
+            .order_by(count.desc(), Tag.name)
+        ).all()
+        return [(name, n) for name, n in rows]
@@ -0,0 +1,423 @@
+"""Priority scheduling of vision-model calls for Stamp'd.
+
+Ollama works through one generation at a time, so every model call takes a
+slot from the shared :data:`scheduler` first.  Waiting calls are granted in
+priority-class order -- ``interactive`` (a user waiting on one image) before
+``batch`` (uploads and scans) before ``backfill`` (background work) -- and,
+within a class, round-robin across owners so one large batch cannot starve
+another.  A call that waits longer than ``aging_seconds`` is promoted one
+class so backfill still makes progress under constant interactive load.
+
+Callers block in their own thread until granted; nothing runs on a
+scheduler thread, so generators can hold a slot while they stream::
+
+    with scheduler.slot("batch", owner=job_id) as ticket:
+        ...  # check ticket.cancel_event between steps
+
+The app and the worker processes all call the same model, so slots are
+admitted through a small SQLite database next to the collection,
+``<db name>_inference.db``: every waiting and running call has a row there,
+and a call starts only when it is first in line across all processes and
+fewer than ``max_concurrent`` rows are running.  Rows carry a lease that a
+background thread renews, so calls of a crashed process stop counting once
+it runs out.  It is a separate file so that waiters polling for a slot never
+hold up writes to the collection.  Per-class counters are kept there too, so
+:func:`scheduler_stats` covers batch work in the workers as well as the
+app's own calls.
+"""
+
+from __future__ import annotations
+
+import itertools
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+from sqlalchemy import Column, Float, Integer, String, create_engine, event, func, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from config import CONFIG, settings
+from db import DB_PATH, session_scope
+
+PRIORITIES = {"interactive": 0, "batch": 1, "backfill": 2}
+
+_inference_cfg = CONFIG.get("inference", {})
+MAX_CONCURRENT = _inference_cfg.get("max_concurrent", 1)
+AGING_SECONDS = _inference_cfg.get("aging_seconds", 30)
+# Waiters re-check the gate and their cancel event this often (seconds).
+POLL_INTERVAL = 0.25
+# Slot rows not renewed for this long belong to a dead process (seconds).
+SLOT_LEASE_SECONDS = 30
+
+INFERENCE_DB_PATH = os.environ.get(
+    "STAMPD_INFERENCE_DB_PATH", os.path.splitext(DB_PATH)[0] + "_inference.db"
+)
+
+gate_engine = create_engine(f"sqlite:///{INFERENCE_DB_PATH}", echo=False)
+GateBase = declarative_base()
+GateSession = sessionmaker(bind=gate_engine)
+
+
+@event.listens_for(gate_engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+
+class InferenceSlot(GateBase):
+    """A model call waiting for (``started_at`` unset) or holding a slot."""
+
+    __tablename__ = "inference_slots"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    process = Column(String, nullable=False, index=True)
+    owner = Column(String, nullable=False)
+    priority = Column(String, nullable=False)
+    submitted_at = Column(Float, nullable=False)
+    started_at = Column(Float)
+    lease_expires_at = Column(Float, nullable=False)
+
+
+class InferenceOwner(GateBase):
+    """When each owner was last granted a slot, for round-robin order."""
+
+    __tablename__ = "inference_owners"
+
+    owner = Column(String, primary_key=True)
+    granted_at = Column(Float, nullable=False)
+
+
+class InferenceStat(GateBase):
+    """Counters and latency totals per priority class, for all processes."""
+
+    __tablename__ = "inference_stats"
+
+    priority = Column(String, primary_key=True)
+    submitted = Column(Integer, nullable=False, default=0)
+    completed = Column(Integer, nullable=False, default=0)
+    cancelled = Column(Integer, nullable=False, default=0)
+    wait_total = Column(Float, nullable=False, default=0.0)
+    max_wait = Column(Float, nullable=False, default=0.0)
+    run_total = Column(Float, nullable=False, default=0.0)
+
+
+_gate_ready = False
+
+
+def init_gate_db() -> None:
+    """Create the gate tables, once per process."""
+    global _gate_ready
+    if not _gate_ready:
+        GateBase.metadata.create_all(gate_engine)
+        _gate_ready = True
+
+
+class InferenceTicket:
+    """One model call waiting for, or holding, a scheduler slot."""
+
+    _seq = itertools.count()
+
+    def __init__(self, priority: str, owner: Hashable, cancel: Optional[threading.Event]):
+        self.priority = priority
+        self.owner = owner
+        self.cancel_event = cancel if cancel is not None else threading.Event()
+        self.seq = next(self._seq)
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.slot_id: Optional[int] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+
+class InferenceScheduler:
+    """Grants at most *max_concurrent* slots at a time across every process
+    sharing the gate database; see module docs."""
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT, aging_seconds: float = AGING_SECONDS):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.max_concurrent = max_concurrent
+        self.aging_seconds = aging_seconds
+        # Identifies this scheduler's rows in the gate database.
+        self.process = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._cond = threading.Condition()
+        self._waiting: List[InferenceTicket] = []
+        self._running: List[InferenceTicket] = []
+        self._renewer: Optional[threading.Thread] = None
+
+    def reconfigure(self, max_concurrent: Optional[int] = None,
+                    aging_seconds: Optional[float] = None) -> None:
+        """Change the limits of a running scheduler; waiters see a higher
+        *max_concurrent* at once, running calls are never interrupted."""
+        if max_concurrent is not None and max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        with self._cond:
+            if max_concurrent is not None:
+                self.max_concurrent = max_concurrent
+            if aging_seconds is not None:
+                self.aging_seconds = aging_seconds
+            self._cond.notify_all()
+
+    # Gate database -----------------------------------------------------------
+
+    def _class(self, priority: str, submitted: float, now: float) -> int:
+        promoted = int((now - submitted) / self.aging_seconds) if self.aging_seconds else 0
+        return max(0, PRIORITIES[priority] - promoted)
+
+    @staticmethod
+    def _count(session, priority: str, **deltas: float) -> None:
+        """Add *deltas* to the class counters (``max_wait`` keeps the max)."""
+        insert = sqlite_insert(InferenceStat).values(priority=priority, **deltas)
+        session.execute(insert.on_conflict_do_update(
+            index_elements=["priority"],
+            set_={
+                name: (
+                    func.max(InferenceStat.max_wait, insert.excluded.max_wait)
+                    if name == "max_wait"
+                    else getattr(InferenceStat, name) + insert.excluded[name]
+                )
+                for name in deltas
+            },
+        ))
+
+    def _register(self, ticket: InferenceTicket) -> None:
+        with session_scope(GateSession) as session:
+            self._count(session, ticket.priority, submitted=1)
+            row = InferenceSlot(
+                process=self.process,
+                owner=str(ticket.owner),
+                priority=ticket.priority,
+                submitted_at=ticket.submitted,
+                lease_expires_at=ticket.submitted + SLOT_LEASE_SECONDS,
+            )
+            session.add(row)
+            session.flush()
+            ticket.slot_id = row.id
+
+    def _unregister(self, ticket: InferenceTicket, **deltas: float) -> None:
+        with session_scope(GateSession) as session:
+            session.query(InferenceSlot).filter(InferenceSlot.id == ticket.slot_id).delete()
+            deltas = {name: value for name, value in deltas.items() if value}
+            if deltas:
+                self._count(session, ticket.priority, **deltas)
+
+    def _try_start(self, ticket: InferenceTicket) -> bool:
+        """Take a slot for *ticket* if it is first in line everywhere."""
+        now = time.time()
+        with session_scope(GateSession, read_only=True) as session:
+            rows = (
+                session.query(InferenceSlot)
+                .filter(InferenceSlot.lease_expires_at >= now)
+                .all()
+            )
+            running = sum(1 for row in rows if row.started_at is not None)
+            waiting = [row for row in rows if row.started_at is None]
+            if running >= self.max_concurrent or not waiting:
+                return False
+            last_grant = dict(
+                session.query(InferenceOwner.owner, InferenceOwner.granted_at)
+                .filter(InferenceOwner.owner.in_({row.owner for row in waiting}))
+                .all()
+            )
+        first = min(
+            waiting,
+            key=lambda row: (
+                self._class(row.priority, row.submitted_at, now),
+                last_grant.get(row.owner, 0.0),
+                row.id,
+            ),
+        )
+        if first.id != ticket.slot_id:
+            return False
+        # Re-checked in the UPDATE so two processes never overfill the gate.
+        running_now = (
+            select(func.count(InferenceSlot.id))
+            .where(InferenceSlot.started_at.isnot(None), InferenceSlot.lease_expires_at >= now)
+            .scalar_subquery()
+        )
+        with session_scope(GateSession) as session:
+            granted = session.execute(
+                update(InferenceSlot)
+                .where(
+                    InferenceSlot.id == ticket.slot_id,
+                    InferenceSlot.started_at.is_(None),
+                    running_now < self.max_concurrent,
+                )
+                .values(started_at=now, lease_expires_at=now + SLOT_LEASE_SECONDS)
+            ).rowcount
+            if granted:
+                session.execute(
+                    sqlite_insert(InferenceOwner)
+                    .values(owner=str(ticket.owner), granted_at=now)
+                    .on_conflict_do_update(index_elements=["owner"], set_={"granted_at": now})
+                )
+                wait = now - ticket.submitted
+                self._count(session, ticket.priority, wait_total=wait, max_wait=wait)
+                ticket.started = now
+        return bool(granted)
+
+    def _renew(self) -> None:
+        """Keep this process's rows alive while it has calls in the gate,
+        and clear rows whose process stopped renewing them."""
+        while True:
+            with self._cond:
+                ids = [t.slot_id for t in self._waiting + self._running if t.slot_id is not None]
+                if not ids:
+                    self._renewer = None
+                    return
+            now = time.time()
+            with session_scope(GateSession) as session:
+                session.query(InferenceSlot).filter(InferenceSlot.id.in_(ids)).update(
+                    {"lease_expires_at": now + SLOT_LEASE_SECONDS}, synchronize_session=False
+                )
+                session.query(InferenceSlot).filter(
+                    InferenceSlot.lease_expires_at < now
+                ).delete(synchronize_session=False)
+            time.sleep(SLOT_LEASE_SECONDS / 3)
+
+    def _start_renewer(self) -> None:
+        if self._renewer is None:
+            self._renewer = threading.Thread(
+                target=self._renew, name="inference-gate", daemon=True
+            )
+            self._renewer.start()
+
+    # Slots -------------------------------------------------------------------
+
+    @contextmanager
+    def slot(
+        self,
+        priority: str = "interactive",
+        owner: Optional[Hashable] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> Iterator[InferenceTicket]:
+        """Block until a slot is granted and hold it for the ``with`` body.
+
+        *owner* groups calls for round-robin sharing and defaults to the
+        calling thread.  Raises ``concurrent.futures.CancelledError`` if
+        *cancel* (or :meth:`cancel` for the owner) fires while waiting;
+        once running, the body should watch ``ticket.cancel_event``.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}'")
+        ticket = InferenceTicket(
+            priority,
+            f"{self.process}:{threading.get_ident()}" if owner is None else owner,
+            cancel,
+        )
+        init_gate_db()
+        self._register(ticket)
+        with self._cond:
+            self._waiting.append(ticket)
+            self._start_renewer()
+        try:
+            while True:
+                if ticket.cancelled:
+                    raise CancelledError(f"{priority} inference cancelled while queued")
+                if self._try_start(ticket):
+                    break
+                with self._cond:
+                    self._cond.wait(POLL_INTERVAL)
+        except BaseException as e:
+            with self._cond:
+                self._waiting.remove(ticket)
+            self._unregister(ticket, cancelled=int(isinstance(e, CancelledError)))
+            with self._cond:
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._waiting.remove(ticket)
+            self._running.append(ticket)
+        try:
+            yield ticket
+        finally:
+            self._unregister(ticket, completed=1, run_total=time.time() - ticket.started)
+            with self._cond:
+                self._running.remove(ticket)
+                self._cond.notify_all()
+
+    def run(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        priority: str = "interactive",
+        owner: Optional[Hashable] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """Call ``fn(*args, **kwargs)`` once a *priority* slot is free."""
+        with self.slot(priority, owner):
+            return fn(*args, **kwargs)
+
+    def cancel(self, owner: Hashable) -> int:
+        """Cancel every queued or running call of *owner* in this process;
+        return how many."""
+        with self._cond:
+            tickets = [t for t in self._waiting + self._running if t.owner == owner]
+            for ticket in tickets:
+                ticket.cancel_event.set()
+            self._cond.notify_all()
+        return len(tickets)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth and per-class wait/run latency for every
+        process using the gate."""
+        init_gate_db()
+        now = time.time()
+        with session_scope(GateSession, read_only=True) as session:
+            rows = (
+                session.query(InferenceSlot)
+                .filter(InferenceSlot.lease_expires_at >= now)
+                .all()
+            )
+            totals = {stat.priority: stat for stat in session.query(InferenceStat)}
+        classes = {}
+        for priority in PRIORITIES:
+            stat = totals.get(priority) or InferenceStat(
+                submitted=0, completed=0, cancelled=0, wait_total=0.0, max_wait=0.0, run_total=0.0
+            )
+            waiting = sum(1 for r in rows if r.priority == priority and r.started_at is None)
+            running = sum(1 for r in rows if r.priority == priority and r.started_at is not None)
+            started = stat.completed + running
+            classes[priority] = {
+                "waiting": waiting,
+                "running": running,
+                "submitted": stat.submitted,
+                "completed": stat.completed,
+                "cancelled": stat.cancelled,
+                "avg_wait_ms": round(stat.wait_total / started * 1000, 1) if started else 0.0,
+                "max_wait_ms": round(stat.max_wait * 1000, 1),
+                "avg_run_ms": (
+                    round(stat.run_total / stat.completed * 1000, 1) if stat.completed else 0.0
+                ),
+            }
+        return {
+            "queue_depth": sum(1 for r in rows if r.started_at is None),
+            "running": sum(1 for r in rows if r.started_at is not None),
+            "max_concurrent": self.max_concurrent,
+            "processes": len({r.process for r in rows}),
+            "classes": classes,
+        }
+
+
+scheduler = InferenceScheduler()
+
+
+@settings.bind("inference")
+def _load_settings(section: Dict[str, Any]) -> None:
+    scheduler.reconfigure(section.get("max_concurrent", 1), section.get("aging_seconds", 30))
+
+
+def scheduler_stats() -> Dict[str, Any]:
+    """Return :meth:`InferenceScheduler.stats`: the gate as seen by all
+    processes, not just this one."""
+    return scheduler.stats()
@@ -0,0 +1,270 @@
+"""SQLite-backed job queue for Stamp'd.
+
+The web process only enqueues work and polls for its progress; worker
+processes (see :mod:`worker_pool`) claim jobs, run them and write the
+result back.  A claimed job carries a lease that its worker renews while
+it runs.  If the worker dies the lease runs out, and
+:func:`recover_expired` puts the job back in the queue (or fails it once
+``max_attempts`` is used up), so crashed work is never silently lost.
+
+Priorities use the class names of :mod:`inference_scheduler`
+(``interactive`` before ``batch`` before ``backfill``), oldest first.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import Column, DateTime, Index, Integer, String, Text, func, select, update
+
+from config import settings
+from db import Base, session_scope
+from inference_scheduler import PRIORITIES
+from log_utils import request_id
+from maintenance import register_task
+
+
+@settings.bind("job_queue")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global LEASE_SECONDS, MAX_ATTEMPTS, JOB_RETENTION
+    LEASE_SECONDS = section.get("lease_seconds", 60)
+    MAX_ATTEMPTS = section.get("max_attempts", 3)
+    # Finished jobs (and their results) are dropped after this many days.
+    JOB_RETENTION = timedelta(days=section.get("retention_days", 7))
+
+
+JOB_STATES = ("queued", "running", "done", "failed")
+# Seconds between prune_jobs runs of the maintenance thread.
+PRUNE_INTERVAL = 6 * 60 * 60
+
+
+class QueuedJob(Base):
+    __tablename__ = "job_queue"
+    __table_args__ = (Index("ix_job_queue_claim", "status", "job_type", "priority", "id"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_type = Column(String, nullable=False)
+    payload = Column(Text, nullable=False, default="{}")
+    status = Column(String, nullable=False, default="queued")
+    priority = Column(Integer, nullable=False, default=PRIORITIES["batch"])
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    worker = Column(String)
+    lease_expires_at = Column(DateTime)
+    progress = Column(Text)
+    result = Column(Text)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+def _as_dict(job: QueuedJob) -> Dict[str, Any]:
+    return {
+        "id": job.id,
+        "job_type": job.job_type,
+        "payload": json.loads(job.payload or "{}"),
+        "status": job.status,
+        "attempts": job.attempts,
+        "worker": job.worker,
+        "progress": json.loads(job.progress) if job.progress else None,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+    }
+
+
+def enqueue(
+    job_type: str,
+    payload: Optional[Dict[str, Any]] = None,
+    priority: str = "batch",
+    max_attempts: Optional[int] = None,
+) -> int:
+    """Queue a *job_type* job with JSON-serialisable *payload*; return its id.
+
+    When called while handling a request, the request ID is stored as
+    ``payload["_request_id"]`` so the worker's log records carry it too.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{priority}'")
+    payload = dict(payload or {})
+    if request_id.get():
+        payload["_request_id"] = request_id.get()
+    with session_scope() as session:
+        job = QueuedJob(
+            job_type=job_type,
+            payload=json.dumps(payload),
+            priority=PRIORITIES[priority],
+            max_attempts=MAX_ATTEMPTS if max_attempts is None else max_attempts,
+        )
+        session.add(job)
+        session.flush()
+        return job.id
+
+
+def get_job(job_id: int) -> Dict[str, Any]:
+    with session_scope(read_only=True) as session:
+        job = session.get(QueuedJob, int(job_id))
+        if job is None:
+            raise ValueError(f"Queued job {job_id} not found")
+        return _as_dict(job)
+
+
+def claim(
+    job_types: Iterable[str], worker: str, lease_seconds: Optional[float] = None
+) -> Optional[Dict[str, Any]]:
+    """Atomically take the next queued job of *job_types* for *worker*."""
+    now = datetime.utcnow()
+    lease_seconds = LEASE_SECONDS if lease_seconds is None else lease_seconds
+    next_id = (
+        select(QueuedJob.id)
+        .where(QueuedJob.status == "queued", QueuedJob.job_type.in_(list(job_types)))
+        .order_by(QueuedJob.priority, QueuedJob.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    with session_scope() as session:
+        # A single UPDATE ... RETURNING, so two workers never get one job.
+        job_id = session.execute(
+            update(QueuedJob)
+            .where(QueuedJob.id == next_id, QueuedJob.status == "queued")
+            .values(
+                status="running",
+                worker=worker,
+                attempts=QueuedJob.attempts + 1,
+                started_at=now,
+                lease_expires_at=now + timedelta(seconds=lease_seconds),
+            )
+            .returning(QueuedJob.id)
+        ).scalar()
+    return get_job(job_id) if job_id is not None else None
+
+
+def _owned(session, job_id: int, worker: str):
+    return session.query(QueuedJob).filter(
+        QueuedJob.id == job_id, QueuedJob.worker == worker, QueuedJob.status == "running"
+    )
+
+
+def heartbeat(
+    job_id: int,
+    worker: str,
+    progress: Optional[Dict[str, Any]] = None,
+    payload: Optional[Dict[str, Any]] = None,
+    lease_seconds: Optional[float] = None,
+) -> bool:
+    """Renew *worker*'s lease, storing *progress* and an updated *payload*
+    if given; ``False`` means the job was taken away, e.g. after the lease
+    expired."""
+    lease_seconds = LEASE_SECONDS if lease_seconds is None else lease_seconds
+    values: Dict[str, Any] = {
+        "lease_expires_at": datetime.utcnow() + timedelta(seconds=lease_seconds)
+    }
+    if progress is not None:
+        values["progress"] = json.dumps(progress)
+    if payload is not None:
+        values["payload"] = json.dumps(payload)
+    with session_scope() as session:
+        return _owned(session, job_id, worker).update(values, synchronize_session=False) > 0
+
+
+def complete(job_id: int, worker: str, result: Any = None) -> bool:
+    with session_scope() as session:
+        return _owned(session, job_id, worker).update(
+            {"status": "done", "result": json.dumps(result), "error": None,
+             "finished_at": datetime.utcnow(), "lease_expires_at": None},
+            synchronize_session=False,
+        ) > 0
+
+
+def fail(job_id: int, worker: str, error: str) -> bool:
+    """Record a failed attempt; the job is queued again while attempts remain."""
+    with session_scope() as session:
+        job = _owned(session, job_id, worker).first()
+        if job is None:
+            return False
+        job.error = str(error)[:1000]
+        job.lease_expires_at = None
+        if job.attempts < job.max_attempts:
+            job.status = "queued"
+        else:
+            job.status, job.finished_at = "failed", datetime.utcnow()
+        return True
+
+
+def release(job_id: int, worker: str) -> bool:
+    """Return a job to the queue without counting the attempt (shutdown)."""
+    with session_scope() as session:
+        # claim() counted this attempt; take it back so that restarts do
+        # not use up max_attempts for work that never failed.
+        return _owned(session, job_id, worker).update(
+            {"status": "queued", "attempts": QueuedJob.attempts - 1, "lease_expires_at": None},
+            synchronize_session=False,
+        ) > 0
+
+
+def recover_expired() -> int:
+    """Requeue (or fail, once out of attempts) running jobs whose worker
+    stopped renewing the lease; return how many were recovered."""
+    now = datetime.utcnow()
+    with session_scope() as session:
+        expired = (
+            session.query(QueuedJob)
+            .filter(QueuedJob.status == "running", QueuedJob.lease_expires_at < now)
+            .all()
+        )
+        for job in expired:
+            job.error = f"worker {job.worker} stopped responding"
+            job.lease_expires_at = None
+            if job.attempts < job.max_attempts:
+                job.status = "queued"
+            else:
+                job.status, job.finished_at = "failed", now
+    return len(expired)
+
+
+def prune_jobs(retention: Optional[timedelta] = None) -> int:
+    """Delete done and failed jobs that finished more than *retention*
+    (default ``JOB_RETENTION``) ago; return how many."""
+    cutoff = datetime.utcnow() - (JOB_RETENTION if retention is None else retention)
+    with session_scope() as session:
+        return (
+            session.query(QueuedJob)
+            .filter(QueuedJob.status.in_(("done", "failed")), QueuedJob.finished_at < cutoff)
+            .delete(synchronize_session=False)
+        )
+
+
+def _prune_task() -> Optional[str]:
+    pruned = prune_jobs()
+    return f"Pruned {pruned} finished queue jobs" if pruned else None
+
+
+register_task("prune_jobs", PRUNE_INTERVAL, _prune_task)
+
+
+def wait_for(job_id: int, timeout: float = 60.0, poll: float = 0.2) -> Dict[str, Any]:
+    """Poll until *job_id* is done or failed, or *timeout* seconds pass;
+    return the last :func:`get_job` result either way."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = get_job(job_id)
+        if job["status"] in ("done", "failed") or time.monotonic() >= deadline:
+            return job
+        time.sleep(poll)
+
+
+def queue_stats() -> Dict[str, Dict[str, int]]:
+    """Return ``{job_type: {state: count}}``."""
+    with session_scope(read_only=True) as session:
+        rows = (
+            session.query(QueuedJob.job_type, QueuedJob.status, func.count())
+            .group_by(QueuedJob.job_type, QueuedJob.status)
+            .all()
+        )
+    stats: Dict[str, Dict[str, int]] = {}
+    for job_type, status, count in rows:
+        stats.setdefault(job_type, {state: 0 for state in JOB_STATES})[status] = count
+    return stats
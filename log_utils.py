@@ -0,0 +1,252 @@
+"""Structured, asynchronous logging for Stamp'd.
+
+Modules log through :func:`get_logger`::
+
+    logger = get_logger("scan_jobs")
+    logger.warning("Scan job %s: chunk failed: %s", job_id, e, extra={"job": job_id})
+
+Records are handed to a queue in the calling thread, which costs about
+as much as appending to a list; a listener thread started by
+:func:`setup_logging` formats them and writes them out:
+
+* as JSON lines to ``LOGS_DIR/<process>.jsonl``, rotated by size, one
+  object per record with the time, level, subsystem, message, process and
+  thread, the correlation IDs and any ``extra`` fields;
+* as the plain message to the console, as the old ``print`` calls did.
+
+Levels are set per subsystem in ``config.json``::
+
+    "logging": {"level": "INFO", "levels": {"db": "WARNING", "image_utils": "DEBUG"}}
+
+Edits apply without a restart: levels at once, and a change of
+``max_bytes``, ``backup_count`` or ``console`` rebuilds the handlers.
+
+Correlation IDs tie records to the request or job that caused them:
+:func:`correlation` sets ``request_id`` and/or ``job_id`` for a block,
+:func:`with_request_id` gives every call of a Gradio handler a fresh
+``request_id``, and :mod:`job_queue` carries the request ID into the
+worker process that runs the job.
+
+Until :func:`setup_logging` is called (e.g. in tests and one-off
+scripts), only warnings and errors are shown, by Python's default handler.
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from config import LOGS_DIR, settings
+
+ROOT_LOGGER = "stampd"
+
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+job_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("job_id", default=None)
+
+# LogRecord attributes that are not ``extra`` fields.
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "request_id", "job_id",
+}
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+# Arguments of the active setup_logging call, and the file and console
+# settings its handlers were built with.
+_setup_args: Optional[Tuple[str, Optional[str], Optional[bool]]] = None
+_handler_settings: Optional[Tuple[Any, ...]] = None
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Return the logger of *subsystem* (``stampd.<subsystem>``)."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def correlation(request: Optional[str] = None, job: Optional[str] = None) -> Iterator[None]:
+    """Tag records logged inside the block with *request* and/or *job*."""
+    tokens = []
+    if request is not None:
+        tokens.append((request_id, request_id.set(request)))
+    if job is not None:
+        tokens.append((job_id, job_id.set(job)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def with_request_id(fn: Callable) -> Callable:
+    """Run every call of handler *fn* under a new ``request_id``.
+
+    Generator handlers stay generator functions; the ID is set around each
+    step, since Gradio may run the steps on different threads.
+    """
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def gen_wrapper(*args, **kwargs):
+            rid = new_request_id()
+            with correlation(request=rid):
+                steps = fn(*args, **kwargs)
+            try:
+                while True:
+                    with correlation(request=rid):
+                        try:
+                            update = next(steps)
+                        except StopIteration:
+                            return
+                    yield update
+            finally:
+                with correlation(request=rid):
+                    steps.close()
+
+        return gen_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with correlation(request=new_request_id()):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+class _CorrelationFilter(logging.Filter):
+    """Copies the correlation IDs onto the record in the logging thread,
+    before the record crosses to the listener thread."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.job_id = job_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key in ("request_id", "job_id"):
+            value = getattr(record, key, None)
+            if value:
+                entry[key] = value
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:  # formatted by _QueueHandler.prepare
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock handler formats the message into the record here; keep
+        # the arguments instead so formatting happens on the listener thread.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def _apply_levels(level: str, levels: Dict[str, str]) -> None:
+    logging.getLogger(ROOT_LOGGER).setLevel(level)
+    for name, logger in list(logging.root.manager.loggerDict.items()):
+        if name.startswith(ROOT_LOGGER + ".") and isinstance(logger, logging.Logger):
+            logger.setLevel(logging.NOTSET)  # subsystems dropped from the config
+    for subsystem, subsystem_level in levels.items():
+        get_logger(subsystem).setLevel(subsystem_level)
+
+
+@settings.bind("logging")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global LOG_LEVEL, SUBSYSTEM_LEVELS, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_TO_CONSOLE
+    global _handler_settings
+    LOG_LEVEL = section.get("level", "INFO")
+    SUBSYSTEM_LEVELS = section.get("levels", {})
+    LOG_MAX_BYTES = section.get("max_bytes", 5 * 1024 * 1024)
+    LOG_BACKUP_COUNT = section.get("backup_count", 5)
+    LOG_TO_CONSOLE = section.get("console", True)
+    if _setup_args is None:
+        return
+    if (LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_TO_CONSOLE) != _handler_settings:
+        setup_logging(*_setup_args)  # rebuilds the handlers
+    else:
+        _apply_levels(LOG_LEVEL, SUBSYSTEM_LEVELS)
+
+
+def setup_logging(process: str = "app", directory: Optional[str] = None,
+                  console: Optional[bool] = None) -> logging.handlers.QueueListener:
+    """Send ``stampd.*`` records through a queue to ``<directory>/<process>.jsonl``
+    (default ``LOGS_DIR``) and the console; return the listener.
+
+    Calling it again replaces the previous setup.  Each process needs its
+    own *process* name, because a rotating file cannot be shared.
+    """
+    global _listener, _queue_handler, _setup_args, _handler_settings
+    shutdown_logging()
+    _setup_args = (process, directory, console)
+    _handler_settings = (LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_TO_CONSOLE)
+    directory = directory or LOGS_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(directory, f"{process}.jsonl"),
+        maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8",
+    )
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if LOG_TO_CONSOLE if console is None else console:
+        handlers.append(logging.StreamHandler())  # plain message, like print
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    _queue_handler = _QueueHandler(records)
+    _queue_handler.addFilter(_CorrelationFilter())
+    root = logging.getLogger(ROOT_LOGGER)
+    root.addHandler(_queue_handler)
+    root.propagate = False
+    _apply_levels(LOG_LEVEL, SUBSYSTEM_LEVELS)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and close the log files."""
+    global _listener, _queue_handler, _setup_args
+    _setup_args = None
+    root = logging.getLogger(ROOT_LOGGER)
+    if _queue_handler is not None:
+        root.removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    root.propagate = True
+
+
+atexit.register(shutdown_logging)
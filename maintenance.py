@@ -0,0 +1,67 @@
+"""Periodic housekeeping for Stamp'd.
+
+Modules register small recurring tasks -- pruning the change log, reporting
+leaked sessions, dropping old finished jobs -- with :func:`register_task`
+when they are imported.  The app runs them all from one background thread
+(:func:`start`); worker processes do not, so each task runs once per
+installation rather than once per process.  A failing task is logged and
+retried at its next interval; it never stops the others.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from log_utils import get_logger
+
+logger = get_logger("maintenance")
+
+# How often the thread looks for due tasks (seconds).
+POLL_INTERVAL = 60
+
+# name -> (interval in seconds, fn); fn returns an optional log message.
+Task = Callable[[], Optional[str]]
+TASKS: Dict[str, Tuple[float, Task]] = {}
+
+
+def register_task(name: str, interval: float, fn: Task) -> None:
+    """Run *fn* every *interval* seconds once :func:`start` is called."""
+    TASKS[name] = (interval, fn)
+
+
+def run_due(last_run: Dict[str, float]) -> List[str]:
+    """Run every task whose interval has passed since its time in
+    *last_run* (never run counts as due), updating *last_run*; return the
+    names of the tasks run."""
+    ran = []
+    for name, (interval, fn) in list(TASKS.items()):
+        now = time.monotonic()
+        if name in last_run and now - last_run[name] < interval:
+            continue
+        try:
+            message = fn()
+            if message:
+                logger.info("🧹 %s", message)
+        except Exception as e:
+            logger.exception("⚠️ Maintenance task %s failed: %s", name, e)
+        last_run[name] = time.monotonic()
+        ran.append(name)
+    return ran
+
+
+def start(stop: Optional[threading.Event] = None, poll: float = POLL_INTERVAL) -> threading.Thread:
+    """Run due tasks every *poll* seconds until *stop* is set."""
+    stop = stop or threading.Event()
+    last_run: Dict[str, float] = {}
+
+    def run():
+        while True:
+            run_due(last_run)
+            if stop.wait(poll):
+                return
+
+    thread = threading.Thread(target=run, name="maintenance", daemon=True)
+    thread.start()
+    return thread
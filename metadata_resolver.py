@@ -0,0 +1,361 @@
+"""Tiered metadata resolver for Stamp'd.
+
+Country, denomination and year are looked up from the cheapest signal that
+answers them, and only images nothing else can identify reach the vision
+model:
+
+1. ``hash``   -- an identical file is already catalogued; copy its fields.
+2. ``phash``  -- a near-duplicate (re-scan, re-encode) is catalogued.
+3. ``text``   -- OCR of the printed lettering, then the file name.
+4. ``vision`` -- the local Ollama vision model.
+
+Every tier returns a confidence; resolution stops at the first tier whose
+answer reaches ``RESOLVER_MIN_CONFIDENCE``, otherwise the best answer seen
+wins.  Per-tier counters are kept for diagnostics.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import Column, DateTime, String, event, func, literal_column
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from ai_utils import generate_metadata
+from changes import change_token
+from config import settings
+from db import Base, Stamp, session_scope
+from image_utils import get_file_hash, get_perceptual_hash, hamming_distances, phash_array
+from metrics import incr, timed
+from ocr_utils import ocr_images
+from parsing_utils import parse_ocr_text, parse_title
+
+TIERS = ("hash", "phash", "text", "vision")
+# Further Stamp columns carried along when a tier knows them.
+DETAIL_FIELDS = ("stamp_name", "catalog_number", "color", "perforation", "format", "mint_used")
+
+
+@settings.bind("resolver")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global RESOLVER_MIN_CONFIDENCE, PHASH_MAX_DISTANCE
+    RESOLVER_MIN_CONFIDENCE = section.get("min_confidence", 0.7)
+    PHASH_MAX_DISTANCE = section.get("phash_max_distance", 6)  # of 64 bits
+
+
+# Catalogued images without a signature are hashed a batch at a time by
+# the workers' startup backfill, never while resolving an upload.
+SIGNATURE_BACKFILL_BATCH = 200
+
+_stats: Counter = Counter()
+_stats_lock = threading.Lock()
+# (token, stamp ids, packed phashes) of the catalogue; see catalogue_phashes.
+_phash_cache: Dict[str, Any] = {}
+_phash_lock = threading.Lock()
+
+
+class ImageSignature(Base):
+    """Perceptual hash per file content (joined to stamps on ``file_hash``)."""
+
+    __tablename__ = "image_signatures"
+
+    file_hash = Column(String, primary_key=True)
+    phash = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+@event.listens_for(Base.metadata, "after_create")
+@event.listens_for(Base.metadata, "after_drop")
+def _clear_on_schema_change(target, connection, **kw):
+    _phash_cache.clear()
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+    # Also exported, so tiers run in worker processes show up in /metrics.
+    tier, _, outcome = key.partition(".")
+    incr(f"resolver_{outcome}", tier=tier)
+
+
+def resolver_stats() -> Dict[str, Dict[str, int]]:
+    """Return ``{tier: {"attempts", "resolved"}}`` since process start."""
+    with _stats_lock:
+        return {
+            tier: {
+                "attempts": _stats[f"{tier}.attempts"],
+                "resolved": _stats[f"{tier}.resolved"],
+            }
+            for tier in TIERS
+        }
+
+
+def reset_resolver_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def _result(tier, confidence, year="", country="", denom="", description="", **extra):
+    return {
+        "tier": tier,
+        "confidence": round(float(confidence), 2),
+        "year": year or "",
+        "country": country or "",
+        "denomination": denom or "",
+        "description": description or "",
+        **{field: "" for field in DETAIL_FIELDS},
+        **extra,
+    }
+
+
+def _from_stamp(tier, confidence, stamp, **extra):
+    return _result(
+        tier,
+        confidence,
+        stamp.year,
+        stamp.country,
+        stamp.denomination,
+        stamp.description or stamp.notes,
+        match_id=stamp.id,
+        **{field: getattr(stamp, field) or "" for field in DETAIL_FIELDS},
+        **extra,
+    )
+
+
+def _text_answer(tier, base, parsed, description):
+    """Score a ``(year, country, denomination)`` parse by how much it found.
+
+    Without a year or denomination the country is only ``parse_title``'s
+    first-word guess, so such answers carry no fields at all.
+    """
+    year, country, denom = parsed
+    if not (year or denom):
+        return _result(tier, 0.0, description=description)
+    if country and denom:
+        confidence = base + (0.1 if year else 0.0)
+    else:
+        confidence = base / 2
+    return _result(tier, confidence, year, country, denom, description)
+
+
+def store_signatures(signatures: Dict[str, Optional[str]]) -> None:
+    """Record ``{file_hash: phash}`` pairs, ignoring ones already known.
+
+    An empty phash marks an unreadable image so it is not hashed again.
+    """
+    rows = [
+        {"file_hash": h, "phash": p}
+        for h, p in signatures.items()
+        if h and p is not None
+    ]
+    if rows:
+        with session_scope() as session:
+            session.execute(
+                sqlite_insert(ImageSignature).values(rows).on_conflict_do_nothing()
+            )
+
+
+def catalogue_phashes() -> Tuple[np.ndarray, np.ndarray]:
+    """Return ``(stamp_ids, phashes)`` of every catalogued stamp with a
+    perceptual hash, by stamp id; phashes are packed by
+    :func:`image_utils.phash_array`.
+
+    Cached until a stamp or signature is written by any process, which
+    :func:`changes.change_token` and the newest signature row tell.
+    """
+    with session_scope(read_only=True) as session:
+        newest = session.query(func.max(literal_column("rowid"))).select_from(ImageSignature).scalar()
+    token = (change_token(), newest)
+    with _phash_lock:
+        if _phash_cache.get("token") != token:
+            with session_scope(read_only=True) as session:
+                rows = (
+                    session.query(Stamp.id, ImageSignature.phash)
+                    .join(ImageSignature, ImageSignature.file_hash == Stamp.file_hash)
+                    .filter(ImageSignature.phash != "")
+                    .order_by(Stamp.id)
+                    .all()
+                )
+            _phash_cache.update(
+                token=token,
+                ids=np.array([sid for sid, _ in rows], dtype=np.int64),
+                phashes=phash_array([phash for _, phash in rows]),
+            )
+        return _phash_cache["ids"], _phash_cache["phashes"]
+
+
+def backfill_signatures(limit: int = SIGNATURE_BACKFILL_BATCH) -> int:
+    """Compute perceptual hashes for up to *limit* catalogued images that do
+    not have one yet; return how many were added."""
+    with session_scope(read_only=True) as session:
+        missing = (
+            session.query(Stamp.file_hash, Stamp.image_path)
+            .outerjoin(ImageSignature, ImageSignature.file_hash == Stamp.file_hash)
+            .filter(Stamp.file_hash.isnot(None), ImageSignature.file_hash.is_(None))
+            .group_by(Stamp.file_hash)
+            .limit(limit)
+            .all()
+        )
+    store_signatures({
+        file_hash: (get_perceptual_hash(image_path) if image_path else None) or ""
+        for file_hash, image_path in missing
+    })
+    return len(missing)
+
+
+def _merge(best, other):
+    """Return the more confident answer with its blanks filled from *other*."""
+    if other is None:
+        return best
+    if other["confidence"] > best["confidence"]:
+        best, other = other, best
+    for field in ("year", "country", "denomination", *DETAIL_FIELDS):
+        best[field] = best[field] or other[field]
+    return best
+
+
+@timed("resolve_hash")
+def _resolve_by_hash(pending, hashes, results):
+    known = {hashes[p] for p in pending if hashes[p]}
+    if not known:
+        return
+    with session_scope(read_only=True) as session:
+        stamps = (
+            session.query(Stamp)
+            .filter(Stamp.file_hash.in_(known))
+            .order_by(Stamp.id)
+            .all()
+        )
+    by_hash: Dict[str, Stamp] = {}
+    for stamp in stamps:
+        by_hash.setdefault(stamp.file_hash, stamp)
+    for path in pending:
+        stamp = by_hash.get(hashes[path])
+        if stamp is not None:
+            results[path] = _from_stamp("hash", 1.0, stamp)
+
+
+@timed("resolve_phash")
+def _resolve_by_phash(pending, phashes, results):
+    ids, catalogue = catalogue_phashes()
+    if len(ids) == 0:
+        return
+    matches = {}  # path -> (stamp id, distance)
+    for path in pending:
+        if not phashes[path]:
+            continue
+        distances = hamming_distances(phashes[path], catalogue)
+        best = int(distances.argmin())
+        distance = int(distances[best])
+        if distance <= PHASH_MAX_DISTANCE:
+            matches[path] = (int(ids[best]), distance)
+    if not matches:
+        return
+    with session_scope(read_only=True) as session:
+        stamps = {
+            stamp.id: stamp
+            for stamp in session.query(Stamp).filter(
+                Stamp.id.in_({sid for sid, _ in matches.values()})
+            )
+        }
+    for path, (sid, distance) in matches.items():
+        stamp = stamps.get(sid)
+        if stamp is None:  # deleted since the hashes were read
+            continue
+        confidence = 0.95 - 0.25 * distance / max(1, PHASH_MAX_DISTANCE)
+        results[path] = _from_stamp("phash", confidence, stamp, distance=distance)
+
+
+@timed("resolve_text")
+def _resolve_by_text(pending, results):
+    texts = ocr_images(pending)
+    for path in pending:
+        text = texts.get(path, "")
+        answer = _text_answer(
+            "text", 0.8, parse_ocr_text(text),
+            "OCR: " + " ".join(text.split()) if text else "",
+        )
+        # File names such as "Canada_1967_5c.jpg" only count when they
+        # carry all three fields; camera names like IMG_0001 parse to junk.
+        stem = os.path.splitext(os.path.basename(path))[0].replace("_", " ")
+        year, country, denom = parse_title(stem)
+        if year and country and denom and answer["confidence"] < 0.6:
+            answer = _result("text", 0.6, year, country, denom, f"From file name: {stem}")
+        results[path] = _merge(answer, results.get(path))
+
+
+@timed("resolve_vision")
+def _resolve_by_vision(pending, results, priority):
+    for path in pending:
+        metadata = generate_metadata(path, priority=priority)
+        # Fields come from named JSON keys rather than a free-text guess,
+        # so a country counts even without a year or denomination.
+        found = [f for f in ("year", "country", "denomination") if metadata[f]]
+        if not found:
+            confidence = 0.0
+        elif metadata["country"] and metadata["denomination"]:
+            confidence = 0.7 + (0.1 if metadata["year"] else 0.0)
+        else:
+            confidence = 0.35
+        answer = _result(
+            "vision", confidence, metadata["year"], metadata["country"],
+            metadata["denomination"], metadata["description"],
+            **{field: metadata[field] for field in DETAIL_FIELDS},
+        )
+        results[path] = _merge(answer, results.get(path))
+
+
+def resolve_many(
+    paths: Iterable[str], priority: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Resolve metadata for every image in *paths*.
+
+    Returns ``{path: {"tier", "confidence", "year", "country",
+    "denomination", "description", *DETAIL_FIELDS, ...}}``.  Each tier runs once for the
+    whole batch over the images still unresolved.  Model calls are queued
+    with *priority* (see :mod:`inference_scheduler`), by default
+    ``interactive`` for a single image and ``batch`` otherwise.
+    """
+    paths = [p for p in dict.fromkeys(paths) if p]
+    if priority is None:
+        priority = "interactive" if len(paths) == 1 else "batch"
+    hashes = {p: get_file_hash(p) for p in paths}
+    phashes = {p: get_perceptual_hash(p) for p in paths}
+    store_signatures({hashes[p]: phashes[p] for p in paths})
+
+    results: Dict[str, Dict[str, Any]] = {}
+    steps = (
+        ("hash", lambda pending: _resolve_by_hash(pending, hashes, results)),
+        ("phash", lambda pending: _resolve_by_phash(pending, phashes, results)),
+        ("text", lambda pending: _resolve_by_text(pending, results)),
+        ("vision", lambda pending: _resolve_by_vision(pending, results, priority)),
+    )
+    for tier, step in steps:
+        pending = _unresolved(paths, results)
+        if not pending:
+            break
+        for _ in pending:
+            _count(f"{tier}.attempts")
+        step(pending)
+    for path in paths:
+        # An answer without any confidence (e.g. an empty model reply)
+        # resolved nothing.
+        if results[path]["confidence"] > 0:
+            _count(f"{results[path]['tier']}.resolved")
+    return results
+
+
+def _unresolved(paths: List[str], results) -> List[str]:
+    return [
+        p for p in paths
+        if results.get(p, {}).get("confidence", 0.0) < RESOLVER_MIN_CONFIDENCE
+    ]
+
+
+def resolve(image_path: str) -> Optional[Dict[str, Any]]:
+    """Resolve metadata for a single image (see :func:`resolve_many`)."""
+    return resolve_many([image_path]).get(image_path)
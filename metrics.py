@@ -0,0 +1,371 @@
+"""Timing histograms and counters for Stamp'd.
+
+Hot paths are wrapped with :func:`timed` (a decorator or context manager)
+and bump counters with :func:`incr`::
+
+    @timed("hash_file")
+    def get_file_hash(filepath): ...
+
+    with timed("export_csv"):
+        ...
+
+Durations go into fixed, log-spaced buckets, so histograms from several
+processes can be added together; p50/p95/p99 are interpolated from the
+buckets as Prometheus does.  Worker processes write their numbers to
+``LOGS_DIR/metrics/<pid>.json`` every ``snapshot_interval`` seconds and the
+web process merges them into :func:`collect`, which feeds the
+``/metrics`` endpoint (:func:`serve_metrics`) and the Diagnostics tab.
+
+With ``metrics.enabled`` false in ``config.json``, :func:`timed` and the
+database listeners skip the clock and record nothing, so instrumentation
+costs one flag check.  The flag is read on every call, so turning metrics
+on or off applies without a restart.
+"""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import LOGS_DIR, settings
+from log_utils import get_logger
+
+logger = get_logger("metrics")
+
+
+@settings.bind("metrics")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global ENABLED, METRICS_HOST, METRICS_PORT, SNAPSHOT_INTERVAL
+    ENABLED = section.get("enabled", True)
+    # The endpoint binds once: restart to move it.
+    METRICS_HOST = section.get("host", "127.0.0.1")
+    METRICS_PORT = section.get("port", 9464)
+    SNAPSHOT_INTERVAL = section.get("snapshot_interval", 10)
+
+
+SNAPSHOT_DIR = os.path.join(LOGS_DIR, "metrics")
+
+# Upper bounds in milliseconds; the last bucket catches everything slower.
+BUCKETS_MS: Tuple[float, ...] = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+    1000, 2500, 5000, 10000, 30000, 60000, float("inf"),
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+# stage -> [bucket counts..., total ms]
+_histograms: Dict[str, List[float]] = {}
+# "name" or "name{label=value,...}" -> count
+_counters: Dict[str, float] = {}
+_NOOP = nullcontext()
+
+
+def _counter_key(name: str, labels: Dict[str, Any]) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={labels[k]}" for k in sorted(labels)) + "}"
+
+
+def observe(stage: str, ms: float) -> None:
+    """Record one *stage* that took *ms* milliseconds."""
+    if not ENABLED:
+        return
+    index = bisect.bisect_left(BUCKETS_MS, ms)
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = [0.0] * (len(BUCKETS_MS) + 1)
+        hist[index] += 1
+        hist[-1] += ms
+
+
+def incr(name: str, value: float = 1, **labels: Any) -> None:
+    """Add *value* to the counter *name* with *labels*."""
+    if not ENABLED:
+        return
+    key = _counter_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.stage, (time.perf_counter() - self.start) * 1000)
+        if exc_type is not None:
+            incr("errors", stage=self.stage)
+        return False
+
+
+class timed:
+    """Time a block (``with timed("stage"):``) or every call of a function
+    (``@timed("stage")``) into the *stage* histogram.  Exceptions are also
+    counted under ``errors{stage=...}``."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._timer: Any = None
+
+    def __call__(self, fn: Callable) -> Callable:
+        stage = self.stage
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _Timer(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        self._timer = _Timer(self.stage) if ENABLED else _NOOP
+        return self._timer.__enter__()
+
+    def __exit__(self, *exc):
+        return self._timer.__exit__(*exc)
+
+
+def instrument_engine(engine) -> None:
+    """Time every SQL statement run through *engine* as ``db_query``."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        if ENABLED:
+            conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _stop(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("metrics_start")
+        if starts:
+            observe("db_query", (time.perf_counter() - starts.pop()) * 1000)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        starts = context.connection.info.get("metrics_start") if context.connection else None
+        if starts:
+            starts.pop()
+        incr("errors", stage="db_query")
+
+
+# -------------------------
+# Snapshots and aggregation
+# -------------------------
+
+
+def snapshot() -> Dict[str, Any]:
+    """Return this process's raw numbers (mergeable with :func:`merge`)."""
+    with _lock:
+        return {
+            "histograms": {stage: list(h) for stage, h in _histograms.items()},
+            "counters": dict(_counters),
+        }
+
+
+def reset_metrics() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def merge(*snapshots: Dict[str, Any]) -> Dict[str, Any]:
+    """Add several :func:`snapshot` results together."""
+    total: Dict[str, Any] = {"histograms": {}, "counters": {}}
+    for snap in snapshots:
+        for stage, hist in snap.get("histograms", {}).items():
+            into = total["histograms"].setdefault(stage, [0.0] * len(hist))
+            for i, value in enumerate(hist):
+                into[i] += value
+        for key, value in snap.get("counters", {}).items():
+            total["counters"][key] = total["counters"].get(key, 0) + value
+    return total
+
+
+def write_snapshot(directory: str = SNAPSHOT_DIR) -> str:
+    """Write this process's snapshot to ``<directory>/<pid>.json``."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+    return path
+
+
+def clear_snapshots(directory: str = SNAPSHOT_DIR) -> None:
+    """Forget other processes' numbers, e.g. when a new worker pool starts."""
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def start_snapshot_thread(stop: Optional[threading.Event] = None,
+                          interval: Optional[float] = None) -> threading.Thread:
+    """Every *interval* seconds (default ``SNAPSHOT_INTERVAL``)
+    :func:`write_snapshot` while metrics are enabled, until *stop* is set.
+    Used by worker processes, which write a last snapshot as they exit."""
+    stop = stop or threading.Event()
+
+    def run():
+        while not stop.wait(SNAPSHOT_INTERVAL if interval is None else interval):
+            if ENABLED:
+                write_snapshot()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def collect(directory: str = SNAPSHOT_DIR) -> Dict[str, Any]:
+    """Merge this process's numbers with the snapshots other processes wrote."""
+    others = []
+    own = f"{os.getpid()}.json"
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        if os.path.basename(path) == own:
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                others.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # being replaced right now
+    return merge(snapshot(), *others)
+
+
+def quantile(hist: List[float], q: float) -> float:
+    """Estimate the *q* quantile in ms from bucket counts, interpolating
+    linearly inside the bucket (the open last bucket reports its floor)."""
+    counts = hist[:len(BUCKETS_MS)]
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0.0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = BUCKETS_MS[i - 1] if i else 0.0
+            upper = BUCKETS_MS[i]
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return BUCKETS_MS[-2]
+
+
+def summary(snap: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Return one row per stage: count, mean and p50/p95/p99 in ms,
+    slowest total first."""
+    snap = collect() if snap is None else snap
+    rows = []
+    for stage, hist in snap["histograms"].items():
+        count = sum(hist[:len(BUCKETS_MS)])
+        if not count:
+            continue
+        rows.append({
+            "stage": stage,
+            "count": int(count),
+            "total_ms": round(hist[-1], 1),
+            "mean_ms": round(hist[-1] / count, 2),
+            **{f"p{int(q * 100)}_ms": round(quantile(hist, q), 2) for q in QUANTILES},
+        })
+    return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+
+# -------------------------
+# Prometheus endpoint
+# -------------------------
+
+
+def _labels(key: str) -> Tuple[str, str]:
+    name, _, rest = key.partition("{")
+    if not rest:
+        return name, ""
+    pairs = [pair.split("=", 1) for pair in rest.rstrip("}").split(",")]
+    return name, ",".join(f'{k}="{v}"' for k, v in pairs)
+
+
+def render_prometheus(snap: Optional[Dict[str, Any]] = None) -> str:
+    """Render *snap* (default :func:`collect`) in the Prometheus text format."""
+    snap = collect() if snap is None else snap
+    lines = [
+        "# HELP stampd_stage_duration_seconds Time spent per pipeline stage.",
+        "# TYPE stampd_stage_duration_seconds histogram",
+    ]
+    for stage in sorted(snap["histograms"]):
+        hist = snap["histograms"][stage]
+        cumulative = 0.0
+        for bound, count in zip(BUCKETS_MS, hist):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound / 1000)
+            lines.append(f'stampd_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative:g}')
+        lines.append(f'stampd_stage_duration_seconds_sum{{stage="{stage}"}} {hist[-1] / 1000:g}')
+        lines.append(f'stampd_stage_duration_seconds_count{{stage="{stage}"}} {cumulative:g}')
+    lines += [
+        "# HELP stampd_stage_duration_quantile_seconds Estimated p50/p95/p99 per stage.",
+        "# TYPE stampd_stage_duration_quantile_seconds gauge",
+    ]
+    for stage in sorted(snap["histograms"]):
+        for q in QUANTILES:
+            value = quantile(snap["histograms"][stage], q) / 1000
+            lines.append(f'stampd_stage_duration_quantile_seconds{{stage="{stage}",quantile="{q}"}} {value:g}')
+    by_name: Dict[str, List[Tuple[str, float]]] = {}
+    for key, value in sorted(snap["counters"].items()):
+        name, labels = _labels(key)
+        by_name.setdefault(name, []).append((labels, value))
+    for name, series in by_name.items():
+        lines.append(f"# TYPE stampd_{name}_total counter")
+        for labels, value in series:
+            lines.append(f"stampd_{name}_total{{{labels}}} {value:g}" if labels else f"stampd_{name}_total {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # noqa: A002 - scrapes are not news
+        pass
+
+
+def serve_metrics(host: Optional[str] = None, port: Optional[int] = None) -> Optional[ThreadingHTTPServer]:
+    """Serve ``/metrics`` on *host*:*port* from a daemon thread; return the
+    server, or ``None`` when metrics are disabled or the port is taken."""
+    if not ENABLED:
+        return None
+    host = METRICS_HOST if host is None else host
+    port = METRICS_PORT if port is None else port
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning("⚠️ Metrics endpoint not started on %s:%s: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("📈 Metrics at http://%s:%s/metrics", host, server.server_address[1])
+    return server
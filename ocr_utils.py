@@ -0,0 +1,223 @@
+"""OCR stage for Stamp'd.
+
+Country names and face values printed on a stamp are read with Tesseract
+before the (much slower) vision model is asked.  Images are binarized and
+upscaled first, batches run in a process pool that is started on first
+use and kept for the life of the process, and results are cached in
+the ``ocr_cache`` table keyed by the file hash, so re-importing or
+re-scanning the same image never runs Tesseract twice.
+"""
+
+from __future__ import annotations
+
+import atexit
+import functools
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+from sqlalchemy import Column, DateTime, String, Text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import settings
+from db import Base, session_scope
+from image_utils import get_file_hash
+from log_utils import get_logger
+
+logger = get_logger("ocr_utils")
+
+# Sparse-text mode: stamp lettering is scattered around the design.
+TESSERACT_CONFIG = "--psm 11"
+OCR_MIN_SIDE = 1200       # upscale until the short side is at least this
+OCR_MAX_UPSCALE = 4.0
+OCR_BORDER_INSET = 0.04   # trim perforations/background before reading
+# Bump when preprocessing changes so stale cache entries are not reused.
+OCR_ENGINE = f"tesseract{TESSERACT_CONFIG.replace(' ', '')}:v1"
+
+
+@settings.bind("ocr")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global OCR_WORKERS
+    OCR_WORKERS = section.get("workers") or min(4, os.cpu_count() or 1)
+
+
+class OcrResult(Base):
+    __tablename__ = "ocr_cache"
+
+    file_hash = Column(String, primary_key=True)
+    engine = Column(String, primary_key=True)
+    text = Column(Text, nullable=False, default="")
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+@functools.lru_cache(maxsize=1)
+def ocr_available() -> bool:
+    """Return True when pytesseract and the tesseract binary are installed."""
+    try:
+        import pytesseract
+    except ImportError:
+        return False
+    return shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Return the Otsu threshold of an 8-bit grayscale array."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight = hist.cumsum()
+    mean = (hist * np.arange(256)).cumsum()
+    total_weight, total_mean = weight[-1], mean[-1]
+    background = weight[:-1]
+    foreground = total_weight - background
+    valid = (background > 0) & (foreground > 0)
+    between = np.zeros(255)
+    mu_b = mean[:-1][valid] / background[valid]
+    mu_f = (total_mean - mean[:-1][valid]) / foreground[valid]
+    between[valid] = background[valid] * foreground[valid] * (mu_b - mu_f) ** 2
+    return int(between.argmax())
+
+
+def preprocess_for_ocr(image_path: str) -> Image.Image:
+    """Return a black-on-white, upscaled binary image ready for Tesseract."""
+    with Image.open(image_path) as img:
+        gray = ImageOps.autocontrast(img.convert("L"))
+    w, h = gray.size
+    dx, dy = int(w * OCR_BORDER_INSET), int(h * OCR_BORDER_INSET)
+    gray = gray.crop((dx, dy, w - dx, h - dy))
+
+    factor = min(OCR_MAX_UPSCALE, OCR_MIN_SIDE / max(1, min(gray.size)))
+    if factor > 1:
+        size = (round(gray.width * factor), round(gray.height * factor))
+        gray = gray.resize(size, Image.BICUBIC)
+
+    arr = np.asarray(gray)
+    binary = arr > otsu_threshold(arr)
+    # Tesseract expects dark text on a light page; flip light-on-dark designs.
+    if binary.mean() < 0.5:
+        binary = ~binary
+    return Image.fromarray((binary * 255).astype(np.uint8))
+
+
+# Shared pool of OCR processes; see _get_pool.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _ocr_worker(image_path: str) -> str:
+    """Preprocess and OCR one image; runs inside pool workers."""
+    import pytesseract
+
+    return pytesseract.image_to_string(
+        preprocess_for_ocr(image_path), config=TESSERACT_CONFIG
+    ).strip()
+
+
+def ocr_images(paths: Iterable[str], workers: Optional[int] = None) -> Dict[str, str]:
+    """Return ``{path: text}`` for *paths*, using the cache where possible.
+
+    Uncached images are OCR'd in a pool of *workers* processes (default
+    ``OCR_WORKERS``); identical
+    files are only read once.  Images that cannot be read, or all images
+    when Tesseract is not installed, map to an empty string.
+    """
+    paths = [p for p in dict.fromkeys(paths) if p]
+    hashes = {p: get_file_hash(p) for p in paths}
+
+    known = {h for h in hashes.values() if h}
+    cached: Dict[str, str] = {}
+    if known:
+        with session_scope(read_only=True) as session:
+            rows = session.query(OcrResult.file_hash, OcrResult.text).filter(
+                OcrResult.engine == OCR_ENGINE, OcrResult.file_hash.in_(known)
+            )
+            cached = dict(rows.all())
+
+    todo: Dict[str, str] = {}  # hash -> one path holding that content
+    for path, file_hash in hashes.items():
+        if file_hash and file_hash not in cached:
+            todo.setdefault(file_hash, path)
+
+    if todo and not ocr_available():
+        logger.warning("⚠️ Tesseract not installed; skipping OCR")
+    elif todo:
+        fresh = _run_ocr(list(todo.values()), OCR_WORKERS if workers is None else workers)
+        rows = [
+            {"file_hash": file_hash, "engine": OCR_ENGINE, "text": fresh[path]}
+            for file_hash, path in todo.items()
+            if path in fresh
+        ]
+        if rows:
+            with session_scope() as session:
+                session.execute(
+                    sqlite_insert(OcrResult).values(rows).on_conflict_do_nothing()
+                )
+            cached.update((row["file_hash"], row["text"]) for row in rows)
+
+    return {path: cached.get(file_hash, "") for path, file_hash in hashes.items()}
+
+
+def _ocr_or_error(image_path: str):
+    try:
+        return _ocr_worker(image_path), None
+    except Exception as e:
+        return None, e
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Return the shared pool, started on first use and restarted when
+    *workers* changes (e.g. after an ``ocr.workers`` edit)."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)  # batches already queued still finish
+            _pool, _pool_workers = ProcessPoolExecutor(max_workers=workers), workers
+        return _pool
+
+
+def shutdown_pool(pool: Optional[ProcessPoolExecutor] = None) -> None:
+    """Stop the OCR worker processes (only if they are still *pool*, when
+    given); the next batch starts new ones."""
+    global _pool
+    with _pool_lock:
+        if pool is not None and pool is not _pool:
+            return
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+atexit.register(shutdown_pool)
+
+
+def _run_ocr(paths, workers):
+    """OCR *paths*; failed images are left out of the returned dict."""
+    if workers <= 1 or len(paths) == 1:
+        outcomes = [_ocr_or_error(path) for path in paths]
+    else:
+        pool = _get_pool(workers)
+        try:
+            outcomes = list(pool.map(_ocr_or_error, paths))
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); start afresh next time.
+            logger.warning("⚠️ OCR pool broke (%s); reading this batch in-process", e)
+            shutdown_pool(pool)
+            outcomes = [_ocr_or_error(path) for path in paths]
+    texts: Dict[str, str] = {}
+    for path, (text, error) in zip(paths, outcomes):
+        if error is not None:
+            logger.error("❌ OCR failed for %s: %s", path, error)
+        else:
+            texts[path] = text
+    return texts
+
+
+def ocr_image(image_path: str) -> str:
+    """OCR a single image (cached)."""
+    return ocr_images([image_path]).get(image_path, "")
@@ -52,12 +52,7 @@ def parse_title(title: str):
                 if len(result_words) >= 3:
                     break
             if result_words:
-denom = denom_match.group(0).strip() if denom_match else ""
-
-    # Guess country using words around the year/denomination
-    country = extract_country(title, year_match, denom_match)
-
-    if not country:
+                country = " ".join(result_words)
     elif denom_match:
         before = title[: denom_match.start()]
         before_words = [
@@ -85,3 +80,33 @@ denom = denom_match.group(0).strip() if denom_match else ""
             country = tokens[0]
 
     return year, country.title(), denom
+
+
+# Words printed on stamps that say nothing about country or value.
+OCR_NOISE_WORDS = {
+    "postage", "postes", "poste", "post", "posta", "porto", "correos",
+    "stamp", "stamps", "usps", "revenue", "airmail", "air", "mail",
+}
+
+
+def parse_ocr_text(text: str):
+    """Extract probable year, country and denomination from OCR output.
+
+    Stray OCR fragments and generic words such as "POSTAGE" are dropped
+    before the remaining tokens go through :func:`parse_title`.
+    """
+    if not text:
+        return "", "", ""
+    tokens = []
+    for raw in text.split():
+        token = raw.strip(",;:'\"|-_()[]{}").replace("¢", "c")
+        if re.fullmatch(r"(?:[A-Za-z]\.)+[A-Za-z]?", token):
+            token = token.replace(".", "")  # U.S. -> US
+        token = token.strip(".")
+        if not token or token.lower() in OCR_NOISE_WORDS:
+            continue
+        # Single letters are almost always OCR noise; keep numbers and ¢/$.
+        if len(token) == 1 and not (token.isdigit() or token in "¢$€£"):
+            continue
+        tokens.append(token)
+    return parse_title(" ".join(tokens))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Opt-in profiling of slow requests for Stamp'd.
+
+Gradio handlers wrapped with :func:`profiled` are profiled when either
+
+* ``profiling.enabled`` is true in ``config.json`` and the call takes
+  longer than ``profiling.threshold_ms``, or
+* a profile was asked for with :func:`request_profile` (the Diagnostics
+  tab's "Profile next request" button), whatever the duration.
+
+Two capture modes exist (``profiling.mode``): ``"sample"`` (default) polls
+the handler's stack every ``sample_interval_ms`` from a side thread, which
+costs little enough to leave on; ``"cprofile"`` traces every call with
+:mod:`cProfile` for exact counts at a much higher cost.  Generator
+handlers are profiled across all their steps, whichever thread runs them.
+
+Each capture is saved to ``LOGS_DIR/profiles`` as ``<stamp>_<handler>.json``
+holding the handler name, its parameters, the duration and the function
+table (cProfile mode also writes the raw ``.prof`` for ``snakeviz`` and
+friends).  View them with::
+
+    python profiling.py              # list saved profiles
+    python profiling.py PROFILE      # top functions by cumulative time
+"""
+
+from __future__ import annotations
+
+import argparse
+import cProfile
+import functools
+import glob
+import inspect
+import json
+import os
+import pstats
+import reprlib
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from config import LOGS_DIR, settings
+from log_utils import get_logger
+
+logger = get_logger("profiling")
+
+PROFILE_DIR = os.path.join(LOGS_DIR, "profiles")
+MODES = ("sample", "cprofile")
+
+
+@settings.bind("profiling")
+def _load_settings(section: Dict[str, Any]) -> None:
+    """Every profiling setting applies to the next request, without a restart."""
+    global PROFILING_ENABLED, THRESHOLD_MS, PROFILE_MODE, SAMPLE_INTERVAL_MS, MAX_PROFILES
+    PROFILING_ENABLED = section.get("enabled", False)
+    THRESHOLD_MS = section.get("threshold_ms", 2000)
+    PROFILE_MODE = section.get("mode", "sample")
+    SAMPLE_INTERVAL_MS = section.get("sample_interval_ms", 5)
+    MAX_PROFILES = section.get("max_profiles", 50)
+
+
+_lock = threading.Lock()
+_requested = 0
+_params_repr = reprlib.Repr()
+_params_repr.maxstring = _params_repr.maxother = 200
+# The capture running on this thread, if any; nested handlers are not
+# profiled separately (two cProfile profilers cannot share a thread).
+_active = threading.local()
+
+
+def request_profile(count: int = 1) -> int:
+    """Profile the next *count* handler calls regardless of their duration;
+    return how many are now pending."""
+    global _requested
+    with _lock:
+        _requested += count
+        return _requested
+
+
+def _take_request() -> bool:
+    global _requested
+    if not _requested:  # unlocked fast path for the common case
+        return False
+    with _lock:
+        if _requested:
+            _requested -= 1
+            return True
+        return False
+
+
+def _where(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+class _Sampler:
+    """Counts the functions on one thread's stack every *interval_ms*."""
+
+    def __init__(self, interval_ms: Optional[float] = None):
+        self.interval = (SAMPLE_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+        self.samples = 0
+        self.cumulative: Counter = Counter()
+        self.own: Counter = Counter()
+        self.thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._runner = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._runner.start()
+
+    def resume(self) -> None:
+        self.thread = threading.get_ident()
+
+    def pause(self) -> None:
+        self.thread = None
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._runner.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread) if self.thread else None
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[_where(frame.f_code)] += 1
+            seen = set()
+            while frame is not None:
+                where = _where(frame.f_code)
+                if where not in seen:  # recursion counts once per sample
+                    seen.add(where)
+                    self.cumulative[where] += 1
+                frame = frame.f_back
+
+    def table(self) -> List[Dict[str, Any]]:
+        ms = self.interval * 1000
+        return [
+            {"function": where, "calls": None, "cumulative_ms": round(count * ms, 1),
+             "own_ms": round(self.own[where] * ms, 1)}
+            for where, count in self.cumulative.most_common()
+        ]
+
+
+class _Capture:
+    """One profile, possibly spanning several generator steps."""
+
+    def __init__(self, mode: str):
+        if mode not in MODES:
+            raise ValueError(f"Profile mode must be one of {MODES}")
+        self.mode = mode
+        self.profiler = cProfile.Profile() if mode == "cprofile" else None
+        self.sampler = _Sampler() if mode == "sample" else None
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def resume(self) -> None:
+        _active.capture = self
+        if self.profiler is not None:
+            self.profiler.enable()
+        else:
+            self.sampler.resume()
+
+    def pause(self) -> None:
+        _active.capture = None
+        if self.profiler is not None:
+            self.profiler.disable()
+        else:
+            self.sampler.pause()
+
+    def finish(self) -> List[Dict[str, Any]]:
+        if self.sampler is not None:
+            self.sampler.stop()
+            return self.sampler.table()
+        stats = pstats.Stats(self.profiler)
+        rows = [
+            {"function": f"{os.path.basename(file)}:{line}({name})", "calls": calls,
+             "cumulative_ms": round(cumulative * 1000, 2), "own_ms": round(own * 1000, 2)}
+            for (file, line, name), (_, calls, own, cumulative, _) in stats.stats.items()
+        ]
+        return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)
+
+
+def _save(name: str, capture: _Capture, elapsed_ms: float, args, kwargs,
+          forced: bool, directory: Optional[str] = None) -> str:
+    directory = directory or PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"{datetime.now():%Y%m%d_%H%M%S_%f}_{name}")
+    functions = capture.finish()
+    if capture.profiler is not None:
+        capture.profiler.dump_stats(base + ".prof")
+    record = {
+        "handler": name,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "elapsed_ms": round(elapsed_ms, 1),
+        "threshold_ms": THRESHOLD_MS,
+        "forced": forced,
+        "mode": capture.mode,
+        "params": {
+            "args": [_params_repr.repr(a) for a in args],
+            "kwargs": {k: _params_repr.repr(v) for k, v in kwargs.items()},
+        },
+        "functions": functions[:500],
+    }
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=1)
+    _prune(directory)
+    logger.info("🐢 %s took %.0f ms; profile saved to %s.json", name, elapsed_ms, base,
+                extra={"handler": name, "elapsed_ms": round(elapsed_ms, 1)})
+    return base + ".json"
+
+
+def _prune(directory: str) -> None:
+    for path in list_profiles(directory)[MAX_PROFILES:]:
+        for stale in (path, path[:-len(".json")] + ".prof"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+
+def _start(name: str) -> Optional[Dict[str, Any]]:
+    if getattr(_active, "capture", None) is not None:
+        return None  # called from a handler already being profiled
+    forced = _take_request()
+    if not (forced or PROFILING_ENABLED):
+        return None
+    return {"capture": _Capture(PROFILE_MODE), "forced": forced, "start": time.perf_counter()}
+
+
+def _finish(name: str, state: Dict[str, Any], args, kwargs) -> None:
+    elapsed_ms = (time.perf_counter() - state["start"]) * 1000
+    if state["forced"] or elapsed_ms >= THRESHOLD_MS:
+        try:
+            _save(name, state["capture"], elapsed_ms, args, kwargs, state["forced"])
+            return
+        except OSError as e:
+            logger.warning("⚠️ Could not save profile for %s: %s", name, e)
+    state["capture"].finish()
+
+
+def profiled(name: Optional[str] = None) -> Callable[[Callable], Callable]:
+    """Decorate a Gradio handler so slow or requested calls are profiled.
+
+    Generator handlers stay generator functions (Gradio streams them) and
+    are measured from the first step to the last.
+    """
+
+    def decorate(fn: Callable) -> Callable:
+        label = name or fn.__name__
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def gen_wrapper(*args, **kwargs):
+                state = _start(label)
+                if state is None:
+                    yield from fn(*args, **kwargs)
+                    return
+                steps = fn(*args, **kwargs)
+                try:
+                    while True:
+                        state["capture"].resume()
+                        try:
+                            update = next(steps)
+                        except StopIteration:
+                            return
+                        finally:
+                            state["capture"].pause()
+                        yield update
+                finally:
+                    steps.close()
+                    _finish(label, state, args, kwargs)
+
+            return gen_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            state = _start(label)
+            if state is None:
+                return fn(*args, **kwargs)
+            state["capture"].resume()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                state["capture"].pause()
+                _finish(label, state, args, kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# -------------------------
+# Viewer
+# -------------------------
+
+
+def list_profiles(directory: Optional[str] = None) -> List[str]:
+    """Saved profiles, newest first."""
+    directory = directory or PROFILE_DIR
+    return sorted(glob.glob(os.path.join(directory, "*.json")), reverse=True)
+
+
+def load_profile(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def top_functions(path: str, limit: int = 25) -> List[Dict[str, Any]]:
+    """The *limit* functions of the profile at *path* with the highest
+    cumulative time."""
+    return load_profile(path)["functions"][:limit]
+
+
+def format_profile(path: str, limit: int = 25) -> str:
+    """Render a saved profile as a header plus its top functions."""
+    record = load_profile(path)
+    lines = [
+        f"{record['handler']} took {record['elapsed_ms']:.0f} ms at {record['created']}"
+        f" ({record['mode']}{', requested' if record['forced'] else ''})",
+        f"params: {record['params']}",
+        "",
+        f"{'cumulative ms':>14} {'own ms':>10} {'calls':>8}  function",
+    ]
+    for row in top_functions(path, limit):
+        calls = "" if row["calls"] is None else row["calls"]
+        lines.append(f"{row['cumulative_ms']:14.1f} {row['own_ms']:10.1f} {calls:>8}  {row['function']}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Show profiles of slow Stamp'd requests")
+    parser.add_argument("profile", nargs="?", help="profile file (default: list them)")
+    parser.add_argument("--limit", type=int, default=25)
+    args = parser.parse_args(argv)
+    if args.profile:
+        print(format_profile(args.profile, args.limit))
+        return
+    paths = list_profiles()
+    if not paths:
+        print(f"No profiles in {PROFILE_DIR}")
+    for path in paths:
+        record = load_profile(path)
+        print(f"{record['elapsed_ms']:10.0f} ms  {record['handler']:<24} {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""In-process result cache for gallery reads.
+
+Read functions are wrapped with :func:`cached_query`; each cached entry
+records the *scopes* it depends on (``"stamps"`` for any stamp row,
+``"tags"`` for tag membership, ``"stamp:<id>"`` for a single record).
+Write functions are wrapped with :func:`invalidates`, which drops only the
+entries depending on the scopes the write touched.  Writes by other
+processes (scan workers) bypass those hooks, so :data:`gallery_cache`
+compares :func:`changes.change_token` with the last one it saw, at most
+every ``cache_check_interval`` seconds, and drops its ``"stamps"`` entries
+when it moved; entries that depend on stamp rows therefore always list
+``"stamps"`` among their scopes.  Entries also expire after ``ttl`` seconds
+as a safety net for writes made outside both.
+
+Cached values are shared by every caller, so cache plain immutable data:
+:func:`frozen_rows` turns ORM objects into named tuples.
+"""
+
+from __future__ import annotations
+
+import functools
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, inspect
+
+from changes import change_token
+from config import settings
+from db import Base
+
+
+def normalize(value: Any) -> Hashable:
+    """Return a hashable, order-insensitive form of *value* for cache keys.
+
+    Strings are stripped, dictionaries drop empty values and sort their
+    keys, and lists become sorted tuples of unique items.
+    """
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, dict):
+        return tuple(
+            sorted((k, normalize(v)) for k, v in value.items() if v not in (None, "", [], {}))
+        )
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted({normalize(v) for v in value}, key=repr))
+    return value
+
+
+_row_types: Dict[type, Any] = {}
+
+
+def frozen_rows(objects: Iterable[Any]) -> List[Any]:
+    """Return the column values of ORM *objects* as named tuples with the
+    same attribute names, safe to share between callers."""
+    rows = []
+    for obj in objects:
+        row_type = _row_types.get(type(obj))
+        if row_type is None:
+            names = [attr.key for attr in inspect(type(obj)).column_attrs]
+            row_type = _row_types[type(obj)] = namedtuple(f"{type(obj).__name__}Row", names)
+        rows.append(row_type(*(getattr(obj, name) for name in row_type._fields)))
+    return rows
+
+
+class QueryCache:
+    """Thread-safe LRU cache with scope-based invalidation and hit metrics.
+
+    With *version*, a callable returning a token of the underlying data,
+    lookups invalidate *version_scopes* if the token changed; it is read at
+    most every *check_interval* seconds, so hits rarely touch the database.
+    Writes through :func:`invalidates` move the token too; they adopt the
+    new one so only their own scopes are dropped.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: float = 300.0,
+        version: Optional[Callable[[], Hashable]] = None,
+        version_scopes: Iterable[str] = ("stamps",),
+        check_interval: float = 1.0,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = version
+        self.version_scopes = frozenset(version_scopes)
+        self.check_interval = check_interval
+        self._seen_version: Hashable = None
+        self._checked = float("-inf")
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any, frozenset]]" = OrderedDict()
+        self._scopes: Dict[str, Set[Hashable]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        if self.version is not None and time.monotonic() - self._checked >= self.check_interval:
+            self._check_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key: Hashable, value: Any, scopes: Iterable[str]) -> None:
+        scopes = frozenset(scopes)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), value, scopes)
+            for scope in scopes:
+                self._scopes.setdefault(scope, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, scopes: Iterable[str]) -> int:
+        """Drop every entry depending on any of *scopes*; return the count."""
+        with self._lock:
+            keys = set()
+            for scope in scopes:
+                keys |= self._scopes.get(scope, set())
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def reconfigure(self, maxsize: int, ttl: float, check_interval: Optional[float] = None) -> None:
+        """Change the size limit and lifetime; extra entries are evicted."""
+        with self._lock:
+            self.maxsize, self.ttl = maxsize, ttl
+            if check_interval is not None:
+                self.check_interval = check_interval
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def adopt_version(self, before: Hashable) -> None:
+        """Take the current token as seen if *before*, read just ahead of a
+        local write, was already seen -- no other writer came in between."""
+        current = self.version()
+        with self._lock:
+            if self._seen_version == before:
+                self._seen_version = current
+                self._checked = time.monotonic()
+
+    def _check_version(self) -> None:
+        current = self.version()
+        with self._lock:
+            changed = current != self._seen_version
+            self._seen_version = current
+            self._checked = time.monotonic()
+        if changed:
+            self.invalidate(self.version_scopes)
+
+    def _drop(self, key: Hashable) -> None:
+        _, _, scopes = self._entries.pop(key)
+        for scope in scopes:
+            keys = self._scopes.get(scope)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._scopes[scope]
+
+
+gallery_cache = QueryCache(version=change_token)
+
+
+@settings.bind("gallery")
+def _load_settings(section: Dict[str, Any]) -> None:
+    gallery_cache.reconfigure(
+        section.get("cache_size", 256),
+        section.get("cache_ttl", 300.0),
+        section.get("cache_check_interval", 1.0),
+    )
+
+
+@event.listens_for(Base.metadata, "after_create")
+@event.listens_for(Base.metadata, "after_drop")
+def _clear_on_schema_change(target, connection, **kw):
+    gallery_cache.clear()
+
+
+def cached_query(
+    name: str,
+    scopes: Callable[..., Iterable[str]],
+    key: Callable[..., Hashable] | None = None,
+    cache: QueryCache = gallery_cache,
+):
+    """Cache the decorated read function in *cache*.
+
+    *scopes* receives the call arguments and returns the scopes the result
+    depends on.  *key* normalizes the arguments; by default every argument
+    goes through :func:`normalize`.  The undecorated function stays
+    available as ``.uncached`` for callers that need a fresh read.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if key is not None:
+                cache_key = (name, key(*args, **kwargs))
+            else:
+                cache_key = (name, tuple(normalize(a) for a in args), normalize(kwargs))
+            found, entry = cache.get(cache_key)
+            if not found:
+                value = fn(*args, **kwargs)
+                # Lists are stored as tuples; each caller gets its own list.
+                entry = (True, tuple(value)) if isinstance(value, list) else (False, value)
+                cache.put(cache_key, entry, scopes(*args, **kwargs))
+            is_list, value = entry
+            return list(value) if is_list else value
+
+        wrapper.uncached = fn
+        return wrapper
+
+    return decorator
+
+
+def invalidates(
+    scopes: Callable[..., Iterable[str]], cache: QueryCache = gallery_cache
+):
+    """Invalidate *scopes* in *cache* after the decorated write function.
+
+    Invalidation also runs when the write raises, since it may have been
+    partially committed.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            before = cache.version() if cache.version is not None else None
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                cache.invalidate(scopes(*args, **kwargs))
+                if cache.version is not None:
+                    cache.adopt_version(before)
+
+        return wrapper
+
+    return decorator
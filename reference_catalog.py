@@ -0,0 +1,333 @@
+"""Reference catalog store for Stamp'd.
+
+Reference data (catalog numbers, issue years, denominations and reference
+images) lives in its own SQLite database, ``<db name>_reference.db``, so
+large imported catalogs never bloat or lock the collection database.
+
+Catalogs are bulk-imported from CSV or JSON-lines files.  During import the
+file hash, perceptual hash, embedding and thumbnail of every reference
+image are computed in a process pool, so lookups by catalog number,
+country + year or image similarity never touch the images again.
+
+    python reference_catalog.py import scott_us.csv --catalog Scott --images scans/
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, LargeBinary, String, Text, UniqueConstraint,
+    create_engine, event, func,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from db import DB_PATH, session_scope
+from embedding_index import EMBEDDING_DIM, image_embedding
+from image_utils import THUMB_SIZE, get_file_hash, get_perceptual_hash, hamming_distances
+from log_utils import get_logger, setup_logging
+
+logger = get_logger("reference_catalog")
+
+REFERENCE_DB_PATH = os.environ.get(
+    "STAMPD_REFERENCE_DB_PATH", os.path.splitext(DB_PATH)[0] + "_reference.db"
+)
+REFERENCE_THUMBS_DIR = os.path.splitext(REFERENCE_DB_PATH)[0] + "_thumbs"
+IMPORT_BATCH = 500
+# Columns accepted from import files; anything else is ignored.
+IMPORT_FIELDS = (
+    "catalog", "catalog_number", "country", "year", "denomination",
+    "title", "description", "image",
+)
+
+ref_engine = create_engine(f"sqlite:///{REFERENCE_DB_PATH}", echo=False)
+RefBase = declarative_base()
+RefSession = sessionmaker(bind=ref_engine)
+
+_matrix_cache: Dict[str, Any] = {}
+# Set once the tables exist, so lookups skip create_all.
+_initialised = False
+
+
+class ReferenceStamp(RefBase):
+    __tablename__ = "reference_stamps"
+    __table_args__ = (
+        UniqueConstraint("catalog", "catalog_number", name="uq_reference_number"),
+        Index("ix_reference_country_year", "country", "year"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    catalog = Column(String, nullable=False, default="")
+    catalog_number = Column(String, nullable=False, index=True)
+    country = Column(String)
+    year = Column(String)
+    denomination = Column(String)
+    title = Column(String)
+    description = Column(Text)
+    image_path = Column(String)
+    thumbnail_path = Column(String)
+    file_hash = Column(String, index=True)
+    phash = Column(String)
+    embedding = Column(LargeBinary)  # float32 x EMBEDDING_DIM
+    imported_at = Column(DateTime, default=datetime.utcnow)
+
+
+def init_reference_db() -> None:
+    """Create the reference tables, once per process."""
+    global _initialised
+    if not _initialised:
+        RefBase.metadata.create_all(ref_engine)
+        _initialised = True
+
+
+@event.listens_for(RefBase.metadata, "after_drop")
+def _forget_tables(target, connection, **kw):
+    global _initialised
+    _initialised = False
+
+
+def _read_rows(path: str) -> Iterable[Dict[str, str]]:
+    """Yield records from a CSV file or a JSON-lines file."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson", ".json")):
+            for number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path}:{number}: invalid JSON ({e})") from e
+        else:
+            yield from csv.DictReader(f)
+
+
+def image_features(image_path: str, thumbs_dir: str = REFERENCE_THUMBS_DIR) -> Dict[str, Any]:
+    """Compute the stored features of one reference image.
+
+    Runs inside import workers; returns an empty dict for unreadable images.
+    """
+    if not image_path or not os.path.exists(image_path):
+        return {}
+    vector = image_embedding(image_path)
+    if vector is None:
+        return {}
+    file_hash = get_file_hash(image_path)
+    thumb = os.path.join(thumbs_dir, f"{file_hash}.jpg")
+    if not os.path.exists(thumb):
+        with Image.open(image_path) as img:
+            img = img.convert("RGB")
+            img.thumbnail(THUMB_SIZE)
+            img.save(thumb, "JPEG", quality=85)
+    return {
+        "file_hash": file_hash,
+        "phash": get_perceptual_hash(image_path),
+        "embedding": vector.tobytes(),
+        "thumbnail_path": thumb,
+    }
+
+
+def _normalize(record: Dict[str, Any], catalog: Optional[str], images_dir: str) -> Optional[Dict[str, Any]]:
+    row = {k: str(record.get(k) or "").strip() for k in IMPORT_FIELDS}
+    if not row["catalog_number"]:
+        return None
+    row["catalog"] = catalog or row["catalog"]
+    image = row.pop("image")
+    row["image_path"] = os.path.join(images_dir, image) if image else ""
+    return row
+
+
+def import_catalog(
+    path: str,
+    catalog: Optional[str] = None,
+    images_dir: Optional[str] = None,
+    workers: Optional[int] = None,
+) -> Dict[str, int]:
+    """Bulk-import a CSV or JSON-lines catalog file.
+
+    Each record needs ``catalog_number``; ``image`` is resolved relative to
+    *images_dir* (default: the file's folder).  Re-importing a number of the
+    same catalog updates it.  Returns ``{"imported", "skipped",
+    "missing_images"}``.
+    """
+    if not os.path.exists(path):
+        raise ValueError(f"Catalog file not found: {path}")
+    images_dir = images_dir or os.path.dirname(os.path.abspath(path))
+    init_reference_db()
+    os.makedirs(REFERENCE_THUMBS_DIR, exist_ok=True)
+
+    stats = {"imported": 0, "skipped": 0, "missing_images": 0}
+    batch: List[Dict[str, Any]] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for record in _read_rows(path):
+            row = _normalize(record, catalog, images_dir)
+            if row is None:
+                stats["skipped"] += 1
+                continue
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH:
+                _import_batch(batch, pool, stats)
+                batch = []
+        if batch:
+            _import_batch(batch, pool, stats)
+    _matrix_cache.clear()
+    logger.info(
+        "📚 Imported %d reference stamps from %s", stats["imported"], os.path.basename(path),
+        extra=stats,
+    )
+    return stats
+
+
+def _import_batch(batch, pool, stats) -> None:
+    features = pool.map(image_features, [row["image_path"] for row in batch], chunksize=16)
+    empty = {"thumbnail_path": None, "file_hash": None, "phash": None, "embedding": None}
+    rows = []
+    for row, feature in zip(batch, features):
+        if row["image_path"] and not feature:
+            stats["missing_images"] += 1
+        rows.append({**empty, **row, **feature, "imported_at": datetime.utcnow()})
+    # An upsert may touch each row once per statement: the last record wins.
+    rows = list({(r["catalog"], r["catalog_number"]): r for r in rows}.values())
+    text_columns = [c for c in IMPORT_FIELDS if c not in ("catalog", "catalog_number", "image")]
+    text_columns.append("image_path")
+    feature_columns = ["thumbnail_path", "file_hash", "phash", "embedding"]
+    table = ReferenceStamp.__table__
+    with session_scope(RefSession) as session:
+        stmt = sqlite_insert(ReferenceStamp).values(rows)
+        # Fields missing from a re-import keep their stored values.
+        update = {c: func.coalesce(func.nullif(stmt.excluded[c], ""), table.c[c]) for c in text_columns}
+        update.update({c: func.coalesce(stmt.excluded[c], table.c[c]) for c in feature_columns})
+        update["imported_at"] = stmt.excluded.imported_at
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["catalog", "catalog_number"], set_=update
+        )
+        session.execute(stmt)
+    stats["imported"] += len(rows)
+
+
+def _as_dict(ref: ReferenceStamp) -> Dict[str, Any]:
+    return {
+        "id": ref.id,
+        "catalog": ref.catalog,
+        "catalog_number": ref.catalog_number,
+        "country": ref.country or "",
+        "year": ref.year or "",
+        "denomination": ref.denomination or "",
+        "title": ref.title or f"{ref.catalog} {ref.catalog_number}".strip(),
+        "description": ref.description or "",
+        "image_path": ref.image_path or "",
+        "thumbnail_path": ref.thumbnail_path or "",
+    }
+
+
+def lookup_number(catalog_number: str, catalog: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Return reference stamps with *catalog_number* (in *catalog* if given)."""
+    init_reference_db()
+    with session_scope(RefSession, read_only=True) as session:
+        q = session.query(ReferenceStamp).filter(
+            ReferenceStamp.catalog_number == catalog_number.strip()
+        )
+        if catalog:
+            q = q.filter(ReferenceStamp.catalog == catalog)
+        return [_as_dict(r) for r in q.order_by(ReferenceStamp.catalog)]
+
+
+def lookup_country_year(country: str, year: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Return reference stamps of *country* (issued in *year* if given)."""
+    init_reference_db()
+    with session_scope(RefSession, read_only=True) as session:
+        q = session.query(ReferenceStamp).filter(ReferenceStamp.country == country.strip())
+        if year:
+            q = q.filter(ReferenceStamp.year == str(year).strip())
+        return [_as_dict(r) for r in q.order_by(ReferenceStamp.year, ReferenceStamp.catalog_number)]
+
+
+def _feature_matrix():
+    """Return ``(ids, phashes, vectors)`` for all reference images.
+
+    Cached until the row count or newest import changes.
+    """
+    with session_scope(RefSession, read_only=True) as session:
+        key = session.query(
+            func.count(ReferenceStamp.id), func.max(ReferenceStamp.imported_at)
+        ).filter(ReferenceStamp.embedding.isnot(None)).one()
+        if _matrix_cache.get("key") != tuple(key):
+            rows = (
+                session.query(ReferenceStamp.id, ReferenceStamp.phash, ReferenceStamp.embedding)
+                .filter(ReferenceStamp.embedding.isnot(None))
+                .order_by(ReferenceStamp.id)
+                .all()
+            )
+            vectors = np.frombuffer(b"".join(r.embedding for r in rows), dtype=np.float32)
+            _matrix_cache.update(
+                key=tuple(key),
+                ids=np.array([r.id for r in rows], dtype=np.int64),
+                phashes=[r.phash or "0" * 16 for r in rows],
+                vectors=vectors.reshape(-1, EMBEDDING_DIM),
+            )
+    return _matrix_cache["ids"], _matrix_cache["phashes"], _matrix_cache["vectors"]
+
+
+def similar_references(
+    phash: Optional[str], vector: Optional[np.ndarray], k: int = 5, max_distance: int = 16
+) -> List[Dict[str, Any]]:
+    """Return reference stamps close to an image's *phash* / *vector*.
+
+    Candidates are the top ``3k`` by cosine similarity plus anything within
+    *max_distance* hash bits; each result carries ``cosine`` and
+    ``distance`` for the caller to score.
+    """
+    init_reference_db()
+    ids, phashes, vectors = _feature_matrix()
+    if len(ids) == 0 or (phash is None and vector is None):
+        return []
+    cosines = vectors @ vector if vector is not None else np.zeros(len(ids), dtype=np.float32)
+    distances = hamming_distances(phash, phashes) if phash else np.full(len(ids), 64)
+
+    fetch = min(len(ids), k * 3)
+    picked = set(np.argpartition(-cosines, fetch - 1)[:fetch].tolist())
+    picked |= set(np.nonzero(distances <= max_distance)[0].tolist())
+    by_id = {int(ids[i]): (float(cosines[i]), int(distances[i])) for i in picked}
+
+    with session_scope(RefSession, read_only=True) as session:
+        refs = session.query(ReferenceStamp).filter(ReferenceStamp.id.in_(list(by_id))).all()
+    results = []
+    for ref in refs:
+        cosine, distance = by_id[ref.id]
+        results.append({**_as_dict(ref), "cosine": cosine, "distance": distance})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stamp'd reference catalog")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="bulk-import a CSV or JSON-lines catalog")
+    imp.add_argument("path")
+    imp.add_argument("--catalog", help="catalog name, e.g. Scott (overrides the file)")
+    imp.add_argument("--images", help="folder holding the reference images")
+    imp.add_argument("--workers", type=int)
+    num = sub.add_parser("number", help="look up a catalog number")
+    num.add_argument("catalog_number")
+    num.add_argument("--catalog")
+    args = parser.parse_args(argv)
+    setup_logging("reference_catalog")
+
+    if args.command == "import":
+        print(import_catalog(args.path, args.catalog, args.images, args.workers))
+    else:
+        for ref in lookup_number(args.catalog_number, args.catalog):
+            print(f"{ref['catalog']} {ref['catalog_number']}: {ref['title']} "
+                  f"({ref['country']} {ref['year']} {ref['denomination']})")
+
+
+if __name__ == "__main__":
+    main()
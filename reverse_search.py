@@ -1,2 +1,202 @@
-# reverse_search.py
-# TODO: Add reverse image search functions here
+"""Reverse image lookup for Stamp'd.
+
+Lookups are answered locally first: every registered match source (our own
+collection, and any imported reference catalogs) ranks candidates by
+perceptual-hash distance and embedding similarity.  A remote service such
+as TinEye is only asked when it is configured under ``reverse_lookup`` in
+``config.json`` and the best local match is below ``min_local_confidence``.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from config import settings
+from db import Stamp, session_scope
+from embedding_index import find_similar, image_embedding, indexed_vectors
+from image_utils import get_perceptual_hash, hamming_distances
+from log_utils import get_logger
+from metadata_resolver import catalogue_phashes
+from reference_catalog import similar_references
+
+logger = get_logger("reverse_search")
+
+
+@settings.bind("reverse_lookup")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global MIN_LOCAL_CONFIDENCE, TINEYE_API_URL, TINEYE_API_KEY, REMOTE_TIMEOUT
+    MIN_LOCAL_CONFIDENCE = section.get("min_local_confidence", 0.85)
+    TINEYE_API_URL = section.get("tineye_api_url", "")
+    TINEYE_API_KEY = section.get("tineye_api_key", "")
+    REMOTE_TIMEOUT = section.get("remote_timeout", 20)
+
+
+# Hashes further apart than this are not treated as the same design.
+PHASH_MATCH_DISTANCE = 16
+
+# name -> fn(query, k) returning match dicts; see :func:`register_source`.
+MATCH_SOURCES: Dict[str, Callable[[Dict[str, Any], int], List[Dict[str, Any]]]] = {}
+
+
+def register_source(name: str, fn: Callable[[Dict[str, Any], int], List[Dict[str, Any]]]) -> None:
+    """Register a local match source.
+
+    *fn* receives the query ``{"image_path", "phash", "vector"}`` and *k*,
+    and returns up to *k* dicts with at least ``score`` (0..1), ``title``
+    and whatever of ``country``, ``denomination``, ``year``,
+    ``catalog_number`` and ``image_path`` it knows.
+    """
+    MATCH_SOURCES[name] = fn
+
+
+def match_score(cosine: float, distance: Optional[int]) -> float:
+    """Blend embedding cosine and perceptual-hash distance into 0..1.
+
+    Colour/texture descriptors of different stamps are often 0.7-0.85
+    alike, so the hash term is what separates "same design" from "similar".
+    """
+    hash_term = 0.0 if distance is None else max(0.0, 1.0 - distance / PHASH_MATCH_DISTANCE)
+    return round(0.5 * max(0.0, cosine) + 0.5 * hash_term, 4)
+
+
+def _collection_source(query: Dict[str, Any], k: int) -> List[Dict[str, Any]]:
+    """Match against stamps already in our own catalogue."""
+    vector = query["vector"]
+    cosines = dict(find_similar(vector=vector, k=k * 3)) if vector is not None else {}
+
+    distances: Dict[int, int] = {}
+    ids, phashes = catalogue_phashes()
+    if len(ids) and query["phash"]:
+        dist = hamming_distances(query["phash"], phashes)
+        for sid, d in zip(ids.tolist(), dist.tolist()):
+            if d <= PHASH_MATCH_DISTANCE or sid in cosines:
+                distances[sid] = d
+
+    candidates = set(cosines) | set(distances)
+    if not candidates:
+        return []
+    with session_scope(read_only=True) as session:
+        stamps = session.query(Stamp).filter(Stamp.id.in_(candidates)).all()
+    # Hash-only candidates are scored from their indexed descriptors; only
+    # images missing from the index are read from disk.
+    indexed = indexed_vectors(
+        stamp.file_hash for stamp in stamps if stamp.id not in cosines
+    ) if vector is not None else {}
+    matches = []
+    for stamp in stamps:
+        cosine = cosines.get(stamp.id)
+        if cosine is None and vector is not None:
+            other = indexed.get(stamp.file_hash)
+            if other is None and stamp.image_path:
+                other = image_embedding(stamp.image_path)
+            cosine = float(other @ vector) if other is not None else 0.0
+        matches.append({
+            "score": match_score(cosine or 0.0, distances.get(stamp.id)),
+            "id": stamp.id,
+            "title": f"Collection #{stamp.id}",
+            "country": stamp.country or "",
+            "denomination": stamp.denomination or "",
+            "year": stamp.year or "",
+            "catalog_number": stamp.catalog_number or "",
+            "image_path": stamp.image_path or "",
+        })
+    matches.sort(key=lambda m: -m["score"])
+    return matches[:k]
+
+
+register_source("collection", _collection_source)
+
+
+def _reference_source(query: Dict[str, Any], k: int) -> List[Dict[str, Any]]:
+    """Match against imported reference catalogs."""
+    matches = [
+        {**ref, "score": match_score(ref["cosine"], ref["distance"])}
+        for ref in similar_references(query["phash"], query["vector"], k, PHASH_MATCH_DISTANCE)
+    ]
+    matches.sort(key=lambda m: -m["score"])
+    return matches[:k]
+
+
+register_source("reference", _reference_source)
+
+
+def _remote_lookup(image_path: str) -> List[Dict[str, Any]]:
+    """Ask TinEye; returns its result list, or [] when not configured."""
+    if not (TINEYE_API_URL and TINEYE_API_KEY):
+        return []
+    import requests
+
+    try:
+        with open(image_path, "rb") as image_file:
+            response = requests.post(
+                TINEYE_API_URL,
+                auth=(TINEYE_API_KEY, ""),
+                files={"image": image_file},
+                timeout=REMOTE_TIMEOUT,
+            )
+        if response.status_code == 200:
+            return response.json().get("results", [])
+    except Exception as e:
+        logger.warning("⚠️ TinEye lookup failed: %s", e, extra={"image": image_path})
+    return []
+
+
+def reverse_lookup(image_path: str, k: int = 5) -> Dict[str, Any]:
+    """Find the stamp in *image_path* among local sources, escalating to
+    remote services only when configured and local confidence is low.
+
+    Returns ``{"matches", "confidence", "remote", "escalated", "elapsed_ms"}``
+    where ``matches`` holds the best *k* local matches over all sources,
+    each tagged with its ``source``.
+    """
+    if not image_path or not os.path.exists(image_path):
+        raise ValueError("No valid image found")
+    start = time.perf_counter()
+    query = {
+        "image_path": image_path,
+        "phash": get_perceptual_hash(image_path),
+        "vector": image_embedding(image_path),
+    }
+    matches: List[Dict[str, Any]] = []
+    for name, source in MATCH_SOURCES.items():
+        try:
+            for match in source(query, k):
+                matches.append({"source": name, **match})
+        except Exception as e:
+            logger.warning("⚠️ Match source '%s' failed: %s", name, e)
+    matches.sort(key=lambda m: -m["score"])
+    matches = matches[:k]
+    confidence = matches[0]["score"] if matches else 0.0
+
+    remote: List[Dict[str, Any]] = []
+    escalated = confidence < MIN_LOCAL_CONFIDENCE and bool(TINEYE_API_URL and TINEYE_API_KEY)
+    if escalated:
+        remote = _remote_lookup(image_path)
+    return {
+        "matches": matches,
+        "confidence": confidence,
+        "remote": remote,
+        "escalated": escalated,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+
+def format_lookup(result: Dict[str, Any]) -> str:
+    """Render a :func:`reverse_lookup` result as text for the UI."""
+    lines = []
+    for match in result["matches"]:
+        details = " ".join(
+            v for v in (match.get("country"), match.get("year"), match.get("denomination"),
+                        match.get("catalog_number")) if v
+        )
+        lines.append(f"{match['score']:.2f}  {match['title']}  {details}".rstrip())
+    if not lines:
+        lines.append("🔍 No local match found.")
+    for item in result["remote"]:
+        lines.append(f"🌐 {item.get('backlink') or item.get('image_url') or item}")
+    if result["escalated"] and not result["remote"]:
+        lines.append("🌐 Remote lookup found nothing.")
+    lines.append(f"({result['elapsed_ms']} ms)")
+    return "\n".join(lines)
@@ -0,0 +1,417 @@
+"""Resumable batch scan jobs for Stamp'd.
+
+A scan job is a list of images to identify and catalogue.  The job and
+every item's status live in the ``scan_jobs`` and ``scan_items`` tables,
+and the images are copied into the job's own folder when it is created,
+so nothing depends on the browser tab or on Gradio's temporary uploads:
+
+* each chunk of items is resolved and its stamps are saved in the same
+  transaction that marks the items done, so finished work is never lost
+  or catalogued twice;
+* a job can be paused, and is also paused when its runner goes away, and
+  picks up at the first unfinished item when run again;
+* items that failed can be retried without touching the rest;
+* answers below the resolver's confidence bar are catalogued anyway but
+  tagged ``needs-review`` (``REVIEW_TAG``) for the owner to check;
+* a runner holds a lease on its job and renews it while it works; a job
+  whose lease ran out (its runner died) can be taken over, and only then
+  are its mid-flight items returned to the queue, so a second runner
+  never redoes or resets work that is still in progress.
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, func, or_
+
+from config import IMAGES_DIR, settings
+from db import Base, Stamp, session_scope
+from embedding_index import add_to_index
+from gallery import bulk_tag
+from image_utils import get_file_hash, segment_sheet
+from log_utils import get_logger
+import metadata_resolver
+from metadata_resolver import DETAIL_FIELDS, resolve_many
+
+logger = get_logger("scan_jobs")
+
+
+@settings.bind("scan_jobs")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global JOBS_DIR, SCAN_CHUNK_SIZE, LEASE_SECONDS
+    JOBS_DIR = section.get("storage_dir", os.path.join(IMAGES_DIR, "scan_jobs"))
+    # Items resolved per transaction; also how far a pause may lag.
+    SCAN_CHUNK_SIZE = section.get("chunk_size", 8)
+    # A runner renews its lease on the job every third of this.
+    LEASE_SECONDS = section.get("lease_seconds", 60)
+
+
+JOB_STATUSES = ("pending", "running", "paused", "completed")
+ITEM_STATUSES = ("pending", "running", "done", "review", "duplicate", "failed")
+# Tag of stamps catalogued from a low-confidence answer.
+REVIEW_TAG = "needs-review"
+
+
+class ScanJob(Base):
+    __tablename__ = "scan_jobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False, default="")
+    status = Column(String, nullable=False, default="pending", index=True)
+    split_sheets = Column(Boolean, nullable=False, default=False)
+    upload_key = Column(String, index=True)  # names the folder of copies
+    runner = Column(String)
+    lease_expires_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+
+class ScanItem(Base):
+    __tablename__ = "scan_items"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(Integer, ForeignKey("scan_jobs.id"), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    source_path = Column(String, nullable=False)   # the file as uploaded
+    image_path = Column(String, nullable=False)    # durable copy or sheet segment
+    status = Column(String, nullable=False, default="pending", index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    stamp_id = Column(Integer)
+    error = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+def create_job(
+    paths: Iterable[str], split_sheets: bool = False, name: str = "",
+    upload_key: Optional[str] = None,
+) -> int:
+    """Create a pending job for the images at *paths*; return its id.
+
+    Files are copied into ``JOBS_DIR/<upload_key>``; with *split_sheets*
+    each file is cut into its stamps (see :func:`image_utils.segment_sheet`)
+    and every stamp becomes an item.  The job and its items are written in
+    one transaction, so a crash leaves either no job or a complete one; if
+    a job with *upload_key* exists already, its id is returned instead.
+    """
+    paths = [p for p in paths if p]
+    if not paths:
+        raise ValueError("A scan job needs at least one image")
+    upload_key = upload_key or uuid.uuid4().hex
+    with session_scope(read_only=True) as session:
+        existing = session.query(ScanJob.id).filter(ScanJob.upload_key == upload_key).first()
+    if existing:
+        return existing[0]
+
+    folder = os.path.join(JOBS_DIR, upload_key)
+    os.makedirs(folder, exist_ok=True)
+    images = []  # (source_path, image_path)
+    for index, source in enumerate(paths):
+        copy = os.path.join(folder, f"{index:05d}_{os.path.basename(source)}")
+        shutil.copy2(source, copy)
+        segments = segment_sheet(copy, output_dir=folder) if split_sheets else []
+        images.extend((source, image_path) for image_path in [s["path"] for s in segments] or [copy])
+    with session_scope() as session:
+        job = ScanJob(
+            name=name or f"{len(paths)} images", split_sheets=split_sheets, upload_key=upload_key,
+        )
+        session.add(job)
+        session.flush()
+        session.add_all(
+            ScanItem(job_id=job.id, position=position, source_path=source, image_path=image_path)
+            for position, (source, image_path) in enumerate(images)
+        )
+        return job.id
+
+
+def _set_job_status(job_id: int, status: str, only_from: Optional[Iterable[str]] = None) -> bool:
+    with session_scope() as session:
+        query = session.query(ScanJob).filter(ScanJob.id == job_id)
+        if only_from is not None:
+            query = query.filter(ScanJob.status.in_(list(only_from)))
+        values = {"status": status, "updated_at": datetime.utcnow()}
+        if status == "completed":
+            values["finished_at"] = datetime.utcnow()
+        return query.update(values, synchronize_session=False) > 0
+
+
+def pause_job(job_id: int) -> bool:
+    """Ask a job to stop after its current chunk; return whether it was
+    pending or running."""
+    return _set_job_status(job_id, "paused", only_from=("pending", "running"))
+
+
+def retry_failed(job_id: int) -> int:
+    """Queue the failed items of *job_id* again; return how many."""
+    with session_scope() as session:
+        count = (
+            session.query(ScanItem)
+            .filter(ScanItem.job_id == job_id, ScanItem.status == "failed")
+            .update({"status": "pending", "error": None}, synchronize_session=False)
+        )
+    if count:
+        _set_job_status(job_id, "pending", only_from=("completed", "paused"))
+    return count
+
+
+def _lease_expired(now: datetime):
+    return or_(ScanJob.lease_expires_at.is_(None), ScanJob.lease_expires_at < now)
+
+
+def recover_jobs(job_id: Optional[int] = None) -> int:
+    """Pause running jobs whose runner stopped renewing its lease and
+    return their mid-flight items to ``pending``; return how many items
+    were recovered.  Jobs with a live runner are left alone.
+    """
+    now = datetime.utcnow()
+    with session_scope() as session:
+        jobs = session.query(ScanJob.id).filter(ScanJob.status == "running", _lease_expired(now))
+        if job_id is not None:
+            jobs = jobs.filter(ScanJob.id == job_id)
+        ids = [stale_id for (stale_id,) in jobs.all()]
+        if not ids:
+            return 0
+        count = (
+            session.query(ScanItem)
+            .filter(ScanItem.job_id.in_(ids), ScanItem.status == "running")
+            .update({"status": "pending"}, synchronize_session=False)
+        )
+        session.query(ScanJob).filter(ScanJob.id.in_(ids)).update(
+            {"status": "paused", "runner": None, "lease_expires_at": None}, synchronize_session=False
+        )
+    return count
+
+
+def _take_job(job_id: int, runner: str) -> bool:
+    """Start *job_id* for *runner* unless it is completed or another
+    runner's lease is live; items the previous runner left mid-flight go
+    back to ``pending``."""
+    now = datetime.utcnow()
+    with session_scope() as session:
+        taken = session.query(ScanJob).filter(
+            ScanJob.id == job_id,
+            ScanJob.status.in_(("pending", "running", "paused")),
+            _lease_expired(now),
+        ).update(
+            {"status": "running", "runner": runner, "updated_at": now,
+             "lease_expires_at": now + timedelta(seconds=LEASE_SECONDS)},
+            synchronize_session=False,
+        ) > 0
+        if taken:
+            session.query(ScanItem).filter(
+                ScanItem.job_id == job_id, ScanItem.status == "running"
+            ).update({"status": "pending"}, synchronize_session=False)
+    return taken
+
+
+def _renew(job_id: int, runner: str, release: bool = False) -> bool:
+    expires = None if release else datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+    values = {"lease_expires_at": expires}
+    if release:
+        values["runner"] = None
+    with session_scope() as session:
+        return session.query(ScanJob).filter(
+            ScanJob.id == job_id, ScanJob.runner == runner
+        ).update(values, synchronize_session=False) > 0
+
+
+def job_status(job_id: int) -> Dict[str, Any]:
+    """Return ``{"id", "name", "status", "total", "counts", "errors"}``;
+    ``counts`` maps every item status to its number of items."""
+    with session_scope(read_only=True) as session:
+        job = session.get(ScanJob, int(job_id))
+        if job is None:
+            raise ValueError(f"Scan job {job_id} not found")
+        counts = dict(
+            session.query(ScanItem.status, func.count())
+            .filter(ScanItem.job_id == job.id)
+            .group_by(ScanItem.status)
+            .all()
+        )
+        errors = (
+            session.query(ScanItem.source_path, ScanItem.error)
+            .filter(ScanItem.job_id == job.id, ScanItem.status == "failed")
+            .order_by(ScanItem.position)
+            .limit(5)
+            .all()
+        )
+    return {
+        "id": job.id,
+        "name": job.name,
+        "status": job.status,
+        "total": sum(counts.values()),
+        "counts": {status: counts.get(status, 0) for status in ITEM_STATUSES},
+        "errors": [(os.path.basename(path), error) for path, error in errors],
+    }
+
+
+def list_jobs(limit: int = 20) -> List[Dict[str, Any]]:
+    """Return :func:`job_status` for the newest *limit* jobs."""
+    with session_scope(read_only=True) as session:
+        ids = [
+            job_id for (job_id,) in
+            session.query(ScanJob.id).order_by(ScanJob.id.desc()).limit(limit).all()
+        ]
+    return [job_status(job_id) for job_id in ids]
+
+
+def _claim_chunk(job_id: int, runner: str) -> List[ScanItem]:
+    """Mark the next pending items running, unless the job was paused or
+    *runner* lost its lease."""
+    with session_scope() as session:
+        job = session.get(ScanJob, job_id)
+        if job is None or job.status != "running" or job.runner != runner:
+            return []
+        items = (
+            session.query(ScanItem)
+            .filter(ScanItem.job_id == job_id, ScanItem.status == "pending")
+            .order_by(ScanItem.position)
+            .limit(SCAN_CHUNK_SIZE)
+            .all()
+        )
+        for item in items:
+            item.status = "running"
+            item.attempts += 1
+        session.flush()
+        session.expunge_all()
+    return items
+
+
+def _notes(resolved: Dict[str, Any]) -> str:
+    return f"{resolved['description']}\n[{resolved['tier']}, confidence {resolved['confidence']:.2f}]"
+
+
+def _save_chunk(items: List[ScanItem], resolved: Dict[str, Dict[str, Any]]) -> None:
+    """Catalogue resolved items and mark them done in one transaction.
+
+    Answers below ``RESOLVER_MIN_CONFIDENCE`` are catalogued too, but
+    their items are marked ``review`` and the stamps tagged ``REVIEW_TAG``.
+    """
+    saved, review = [], []
+    with session_scope() as session:
+        for item in items:
+            row = session.get(ScanItem, item.id)
+            answer = resolved.get(item.image_path)
+            if answer is None or answer["confidence"] <= 0:
+                row.status, row.error = "failed", "metadata could not be resolved"
+                continue
+            file_hash = get_file_hash(item.image_path)
+            existing = file_hash and session.query(Stamp.id).filter_by(file_hash=file_hash).first()
+            if existing:
+                row.status, row.stamp_id = "duplicate", existing[0]
+                continue
+            stamp = Stamp(
+                image_path=item.image_path,
+                file_hash=file_hash,
+                country=answer["country"],
+                denomination=answer["denomination"],
+                year=answer["year"],
+                notes=_notes(answer),
+                **{field: answer[field] for field in DETAIL_FIELDS},
+            )
+            session.add(stamp)
+            session.flush()
+            row.stamp_id, row.error = stamp.id, None
+            if answer["confidence"] < metadata_resolver.RESOLVER_MIN_CONFIDENCE:
+                row.status = "review"
+                review.append(stamp.id)
+            else:
+                row.status = "done"
+            saved.append((file_hash, item.image_path))
+    # The items' status is the durable record; the tag is how the gallery
+    # shows them.  The app's gallery cache notices both via the change feed.
+    if review:
+        bulk_tag(review, REVIEW_TAG)
+    if saved:
+        add_to_index(saved)
+
+
+def _fail_chunk(items: List[ScanItem], error: Exception) -> None:
+    with session_scope() as session:
+        session.query(ScanItem).filter(ScanItem.id.in_([i.id for i in items])).update(
+            {"status": "failed", "error": str(error)[:500]}, synchronize_session=False
+        )
+
+
+def run_job(job_id: int, cancel: Optional[threading.Event] = None) -> Iterator[Dict[str, Any]]:
+    """Process the unfinished items of *job_id*, yielding :func:`job_status`
+    after every chunk.
+
+    Stops early when the job is paused (from anywhere, via the database) or
+    *cancel* is set.  If the consumer stops iterating, the job is paused so
+    it can be resumed later.  A job that is completed, or held by another
+    runner whose lease is live, is left alone: its status is yielded once.
+    """
+    runner = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if not _take_job(job_id, runner):
+        yield job_status(job_id)  # raises for unknown jobs
+        return
+    done = threading.Event()
+
+    def renew():
+        while not done.wait(LEASE_SECONDS / 3):
+            if not _renew(job_id, runner):
+                return
+
+    keeper = threading.Thread(target=renew, name=f"scan-job-{job_id}", daemon=True)
+    keeper.start()
+    finished = False
+    try:
+        while not (cancel is not None and cancel.is_set()):
+            items = _claim_chunk(job_id, runner)
+            if not items:
+                break
+            try:
+                resolved = resolve_many([item.image_path for item in items], priority="batch")
+                _save_chunk(items, resolved)
+            except Exception as e:
+                logger.warning("⚠️ Scan job %s: chunk failed: %s", job_id, e, extra={"scan_job": job_id})
+                _fail_chunk(items, e)
+            yield job_status(job_id)
+        finished = not (cancel is not None and cancel.is_set())
+    finally:
+        done.set()
+        keeper.join()
+        with session_scope() as session:
+            held = session.query(ScanJob.id).filter(
+                ScanJob.id == job_id, ScanJob.runner == runner
+            ).first()
+            if held:
+                # Items of an abandoned chunk go back to the queue.
+                session.query(ScanItem).filter(
+                    ScanItem.job_id == job_id, ScanItem.status == "running"
+                ).update({"status": "pending"}, synchronize_session=False)
+                pending = (
+                    session.query(ScanItem.id)
+                    .filter(ScanItem.job_id == job_id, ScanItem.status == "pending")
+                    .first()
+                )
+        # A runner that lost its lease leaves the job to its new runner.
+        if held:
+            if finished and pending is None:
+                _set_job_status(job_id, "completed", only_from=("running",))
+            else:
+                _set_job_status(job_id, "paused", only_from=("running",))
+            _renew(job_id, runner, release=True)
+    yield job_status(job_id)
+
+
+def format_job(status: Dict[str, Any]) -> str:
+    """Render a :func:`job_status` result as one progress line for the UI."""
+    counts = status["counts"]
+    done = counts["done"] + counts["review"] + counts["duplicate"]
+    line = (
+        f"Job #{status['id']} {status['status']}: {done}/{status['total']} done"
+        f", {counts['duplicate']} duplicates, {counts['failed']} failed"
+    )
+    if counts["review"]:
+        line += f"\n👀 {counts['review']} saved with low confidence, tagged '{REVIEW_TAG}' for review"
+    for name, error in status["errors"]:
+        line += f"\n❌ {name}: {error}"
+    return line
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""Offline stand-ins for Ollama and marketplace search for Stamp'd.
+
+:class:`StandinServer` is a small threaded HTTP server that answers
+
+* ``POST /api/generate`` like Ollama, streaming NDJSON chunks or (with
+  ``"stream": false``) one JSON object, and honouring ``"format": "json"``
+  with a canned metadata object.  Latency before the first token, jitter,
+  token rate, an injected error rate and the number of parallel slots
+  (Ollama's ``OLLAMA_NUM_PARALLEL``; extra requests queue) are all set
+  per server;
+* ``GET /sch/i.html?_nkw=...`` with an eBay-like sold-listings page whose
+  ``.s-item__price`` values depend only on the query.
+
+Point the real clients at it with ``OLLAMA_URL`` and ``MARKETPLACE_URL``::
+
+    python standin_server.py serve --port 11434 --latency 800 --slots 2
+    python standin_server.py load --target metadata --concurrency 8 --requests 200
+
+``load`` starts its own server unless ``--url`` is given and drives
+:func:`ai_utils.generate_metadata`, :func:`ai_utils.generate_description`
+or :func:`valuation.get_valuation` from a thread pool, then prints the
+latency percentiles together with the client and server statistics.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+COUNTRIES = ["Canada", "Peru", "France", "Germany", "Japan", "Brazil", "India", "Kenya"]
+DENOMINATIONS = ["1c", "5c", "10c", "25c", "2p", "50 centimes"]
+SUBJECTS = ["Queen Elizabeth II", "a steam locomotive", "a mountain lake", "a hummingbird"]
+LISTINGS_PER_PAGE = 12
+
+
+def _rng(text: str) -> random.Random:
+    return random.Random(hashlib.md5(text.encode()).hexdigest())
+
+
+def canned_metadata(seed: str) -> Dict[str, str]:
+    """Return a plausible metadata answer that depends only on *seed*."""
+    rng = _rng(seed)
+    country, year = rng.choice(COUNTRIES), str(rng.randrange(1850, 2020))
+    denomination, subject = rng.choice(DENOMINATIONS), rng.choice(SUBJECTS)
+    return {
+        "stamp_name": f"{country} {year} {subject}",
+        "country": country,
+        "denomination": denomination,
+        "year": year,
+        "catalog_number": f"SG{rng.randrange(1, 3000)}",
+        "color": rng.choice(["red", "blue", "green", "brown"]),
+        "perforation": rng.choice(["12", "13½", "imperforate"]),
+        "format": "Single",
+        "mint_used": rng.choice(["Mint", "Used"]),
+        "description": f"{country} {year} {denomination} showing {subject}",
+    }
+
+
+def canned_listing_prices(query: str) -> List[float]:
+    """Sold prices shown for *query*; stable across calls."""
+    rng = _rng(query.lower())
+    base = rng.uniform(0.5, 40.0)
+    return [round(base * rng.uniform(0.6, 1.6), 2) for _ in range(LISTINGS_PER_PAGE)]
+
+
+def listing_page(query: str) -> str:
+    items = "\n".join(
+        f'<li class="s-item"><div class="s-item__title">{query} #{i}</div>'
+        f'<span class="s-item__price">${price:,.2f}</span></li>'
+        for i, price in enumerate(canned_listing_prices(query))
+    )
+    return f"<html><body><ul class=\"srp-results\">\n{items}\n</ul></body></html>"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_HTTPServer"
+
+    def log_message(self, format, *args):  # noqa: A002 - quiet by default
+        if self.server.standin.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            return self._send_json(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            return self._send_json(400, {"error": "invalid JSON"})
+        self.server.standin._generate(self, request)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/api/tags":
+            return self._send_json(200, {"models": [{"name": "standin"}]})
+        if url.path != "/sch/i.html":
+            return self._send_json(404, {"error": "not found"})
+        self.server.standin._marketplace(self, parse_qs(url.query).get("_nkw", [""])[0])
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    standin: "StandinServer"
+
+
+class StandinServer:
+    """Ollama and marketplace stand-in; see the module docs.
+
+    *latency_ms* is the delay before the first token (or page), *jitter_ms*
+    the width of a uniform random spread around it, *tokens_per_sec* the
+    streaming rate and *error_rate* the fraction of requests answered with
+    HTTP 500.  At most *slots* generations run at once.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 200.0,
+        jitter_ms: float = 0.0,
+        tokens_per_sec: float = 200.0,
+        error_rate: float = 0.0,
+        slots: int = 1,
+        seed: int = 0,
+        verbose: bool = False,
+    ):
+        if slots < 1:
+            raise ValueError("slots must be at least 1")
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.slots = slots
+        self.verbose = verbose
+        self._rng = random.Random(seed)
+        self._slots = threading.BoundedSemaphore(slots)
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Any] = {}
+        self.reset_stats()
+        self._httpd = _HTTPServer((host, port), _Handler)
+        self._httpd.standin = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandinServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "StandinServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    # -- statistics -------------------------------------------------------
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {
+                "generate": 0, "marketplace": 0, "errors": 0, "disconnects": 0,
+                "in_flight": 0, "max_in_flight": 0, "queued": 0, "max_queued": 0,
+                "queue_wait_ms": 0.0,
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        """Return request counts, injected errors, client disconnects, peak
+        concurrency and the average wait for a generation slot."""
+        with self._lock:
+            stats = dict(self._stats)
+        waited = stats.pop("queue_wait_ms")
+        stats["avg_queue_wait_ms"] = round(waited / stats["generate"], 1) if stats["generate"] else 0.0
+        return stats
+
+    def _bump(self, key: str, delta: float = 1) -> None:
+        with self._lock:
+            self._stats[key] += delta
+            for name in ("in_flight", "queued"):
+                self._stats[f"max_{name}"] = max(self._stats[f"max_{name}"], self._stats[name])
+
+    def _delay(self) -> Tuple[float, bool]:
+        with self._lock:
+            spread = self._rng.uniform(-0.5, 0.5) * self.jitter_ms
+            failing = self._rng.random() < self.error_rate
+        return max(0.0, (self.latency_ms + spread) / 1000.0), failing
+
+    # -- handlers ---------------------------------------------------------
+
+    def _generate(self, handler: _Handler, request: Dict[str, Any]) -> None:
+        self._bump("generate")
+        self._bump("queued")
+        waited = time.perf_counter()
+        with self._slots:
+            self._bump("queued", -1)
+            self._bump("queue_wait_ms", (time.perf_counter() - waited) * 1000)
+            self._bump("in_flight")
+            try:
+                self._answer(handler, request)
+            except (BrokenPipeError, ConnectionResetError):
+                self._bump("disconnects")  # client cancelled mid-stream
+            finally:
+                self._bump("in_flight", -1)
+
+    def _answer(self, handler: _Handler, request: Dict[str, Any]) -> None:
+        delay, failing = self._delay()
+        time.sleep(delay)
+        if failing:
+            self._bump("errors")
+            return handler._send_json(500, {"error": "stand-in: injected failure"})
+        seed = (request.get("images") or [""])[0][:64] + request.get("prompt", "")
+        metadata = canned_metadata(seed)
+        text = json.dumps(metadata) if request.get("format") == "json" else metadata["description"]
+        pieces = [text[i:i + 4] for i in range(0, len(text), 4)]
+        step = 1.0 / self.tokens_per_sec if self.tokens_per_sec else 0.0
+        final = {
+            "model": request.get("model", "standin"), "done": True,
+            "eval_count": len(pieces), "eval_duration": int(len(pieces) * step * 1e9),
+        }
+        if request.get("stream", True) is False:
+            time.sleep(step * len(pieces))
+            return handler._send_json(200, {**final, "response": text})
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/x-ndjson")
+        handler.end_headers()  # no length: the body ends when we close
+        for piece in pieces:
+            handler.wfile.write(json.dumps({"response": piece, "done": False}).encode() + b"\n")
+            handler.wfile.flush()
+            time.sleep(step)
+        handler.wfile.write(json.dumps({**final, "response": ""}).encode() + b"\n")
+
+    def _marketplace(self, handler: _Handler, query: str) -> None:
+        self._bump("marketplace")
+        delay, failing = self._delay()
+        time.sleep(delay)
+        if failing:
+            self._bump("errors")
+            return handler._send_json(503, {"error": "stand-in: injected failure"})
+        data = listing_page(query).encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html; charset=utf-8")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+# -------------------------
+# Load testing
+# -------------------------
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_load(
+    url: str,
+    target: str = "metadata",
+    requests_total: int = 50,
+    concurrency: int = 4,
+    client_slots: Optional[int] = None,
+    work_dir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Call the real client for *target* (``metadata``, ``description`` or
+    ``valuation``) *requests_total* times from *concurrency* threads against
+    the stand-in at *url*; return latency percentiles and throughput.
+
+    *client_slots* overrides the inference scheduler's ``max_concurrent``
+    for the run, to see how the client limit and the server slots interact.
+    """
+    import ai_utils
+    import valuation
+    from inference_scheduler import scheduler
+
+    if target not in ("metadata", "description", "valuation"):
+        raise ValueError(f"Unknown load target '{target}'")
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        images = []
+        for i in range(min(requests_total, 16)):
+            path = os.path.join(tmp, f"load_{i}.png")
+            Image.new("RGB", (64, 80), (i * 15 % 256, 90, 160)).save(path)
+            images.append(path)
+
+        def call(i: int):
+            image = images[i % len(images)]
+            start = time.perf_counter()
+            if target == "metadata":
+                ok = bool(ai_utils.generate_metadata(image, priority="batch")["country"])
+            elif target == "description":
+                ok = not ai_utils.generate_description(image, priority="batch").startswith("Stamp from")
+            else:
+                ok = valuation.get_valuation(f"{COUNTRIES[i % len(COUNTRIES)]} stamp") > 0
+            return (time.perf_counter() - start) * 1000, ok
+
+        saved = (ai_utils.OLLAMA_URL, valuation.MARKETPLACE_URL, scheduler.max_concurrent)
+        ai_utils.OLLAMA_URL = valuation.MARKETPLACE_URL = url
+        if client_slots:
+            scheduler.max_concurrent = client_slots
+        ai_utils.reset_generation_stats()
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes = list(pool.map(call, range(requests_total)))
+            elapsed = time.perf_counter() - start
+        finally:
+            ai_utils.OLLAMA_URL, valuation.MARKETPLACE_URL, scheduler.max_concurrent = saved
+
+    latencies = [ms for ms, _ in outcomes]
+    return {
+        "target": target,
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "ok": sum(ok for _, ok in outcomes),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(requests_total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(_percentile(latencies, 0.95), 1),
+        "max_ms": round(max(latencies), 1),
+        "generation": ai_utils.generation_stats() if target != "valuation" else None,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "load"):
+        p = sub.add_parser(name)
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--port", type=int, default=11434 if name == "serve" else 0)
+        p.add_argument("--latency", type=float, default=200.0, help="ms before the first token")
+        p.add_argument("--jitter", type=float, default=0.0, help="ms of uniform spread")
+        p.add_argument("--tokens-per-sec", type=float, default=200.0)
+        p.add_argument("--error-rate", type=float, default=0.0)
+        p.add_argument("--slots", type=int, default=1, help="parallel generations")
+        p.add_argument("--seed", type=int, default=0)
+        p.add_argument("--verbose", action="store_true")
+    load = sub.choices["load"]
+    load.add_argument("--url", help="use a running stand-in instead of starting one")
+    load.add_argument("--target", choices=("metadata", "description", "valuation"), default="metadata")
+    load.add_argument("--requests", type=int, default=50)
+    load.add_argument("--concurrency", type=int, default=4)
+    load.add_argument("--client-slots", type=int, help="override the inference scheduler limit")
+    args = parser.parse_args(argv)
+
+    server = StandinServer(
+        args.host, args.port, args.latency, args.jitter, args.tokens_per_sec,
+        args.error_rate, args.slots, args.seed, args.verbose,
+    ) if args.command == "serve" or not args.url else None
+
+    if args.command == "serve":
+        print(f"🧪 Stand-in Ollama and marketplace listening on {server.url}")
+        print(f"   export OLLAMA_URL={server.url} MARKETPLACE_URL={server.url}")
+        try:
+            server._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server._httpd.server_close()
+            print(f"📊 {server.stats()}")
+        return
+
+    if server is not None:
+        server.start()
+    try:
+        result = run_load(args.url or server.url, args.target, args.requests,
+                          args.concurrency, args.client_slots)
+    finally:
+        if server is not None:
+            server.stop()
+    if server is not None:
+        result["server"] = server.stats()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+"""Shared pytest setup.
+
+``db`` binds its engine to ``STAMPD_DB_PATH`` the first time it is imported,
+so the path is pinned to a throwaway database before any test module loads.
+Test modules that need their own file still override it explicitly.
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault(
+    "STAMPD_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="stampd-tests-"), "stampd.db")
+)
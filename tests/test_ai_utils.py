@@ -0,0 +1,174 @@
+"""Tests for the Ollama vision helpers: streaming and structured metadata."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import requests
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_utils  # noqa: E402
+from ai_utils import (  # noqa: E402
+    METADATA_FIELDS, generate_description, generate_metadata, generation_stats,
+    repair_json, reset_generation_stats, stream_description, stream_ollama_vision,
+    validate_metadata,
+)
+
+
+class FakeStream:
+    """Stands in for a streaming ``requests`` response."""
+
+    def __init__(self, pieces, final=None):
+        self.lines = [json.dumps({"response": p, "done": False}).encode() for p in pieces]
+        self.lines.append(json.dumps({"response": "", "done": True, **(final or {})}).encode())
+        self.sent = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        for line in self.lines:
+            self.sent += 1
+            yield line
+
+
+class TestStreaming(unittest.TestCase):
+    """Tokens, early fields, cancellation and TTFT/throughput metrics."""
+
+    PIECES = ["Canada ", "1961 ", "5c ", "blue ", "Queen ", "Elizabeth"]
+
+    def setUp(self):
+        reset_generation_stats()
+        self.tmp = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp, "stamp.png")
+        Image.new("RGB", (40, 50), "red").save(self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_tokens_and_server_metrics(self):
+        stream = FakeStream(self.PIECES, {"eval_count": 12, "eval_duration": 2_000_000_000})
+        with patch("requests.post", return_value=stream) as post:
+            text = "".join(stream_ollama_vision(self.image, "describe"))
+        self.assertEqual(text, "".join(self.PIECES))
+        self.assertTrue(post.call_args.kwargs["stream"])
+        self.assertTrue(post.call_args.kwargs["json"]["stream"])
+        stats = generation_stats()
+        self.assertEqual((stats["generations"], stats["tokens_per_sec"]), (1, 6.0))
+        self.assertIsNotNone(stats["last"]["ttft_ms"])
+        self.assertTrue(stream.closed)
+
+    def test_fields_appear_before_the_response_ends(self):
+        with patch("requests.post", return_value=FakeStream(self.PIECES)):
+            updates = list(stream_description(self.image))
+        first_year = next(i for i, u in enumerate(updates) if u["fields"].get("year"))
+        self.assertLess(first_year, len(self.PIECES) - 1)
+        self.assertEqual(updates[first_year]["fields"]["year"], "1961")
+        self.assertEqual(updates[-1]["fields"]["denomination"], "5c")
+        self.assertTrue(updates[-1]["done"])
+        # A half-received word is never reported as a field.
+        self.assertEqual(ai_utils._settled_fields("Canad"), {})
+
+    def test_cancel_closes_the_connection(self):
+        stream = FakeStream(self.PIECES)
+        cancel = threading.Event()
+        with patch("requests.post", return_value=stream):
+            for update in stream_description(self.image, cancel):
+                cancel.set()
+        self.assertTrue(stream.closed)
+        self.assertLess(stream.sent, len(stream.lines))
+        self.assertEqual(update["done"], False)
+
+        stream = FakeStream(self.PIECES)
+        with patch("requests.post", return_value=stream):
+            gen = stream_ollama_vision(self.image, "describe")
+            next(gen)
+            gen.close()
+        self.assertTrue(stream.closed)
+        self.assertEqual(generation_stats()["cancelled"], 2)
+
+    def test_fallback_when_server_is_down(self):
+        with patch("requests.post", side_effect=requests.ConnectionError):
+            self.assertEqual(generate_description(self.image), "Stamp from stamp")
+            updates = list(stream_description(self.image))
+        self.assertEqual(updates, [{"text": "Stamp from stamp", "fields": {}, "done": True}])
+        self.assertEqual(generation_stats()["failed"], 2)
+
+
+class TestStructuredMetadata(unittest.TestCase):
+    """JSON mode, schema validation and local repair."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp, "IMG_0001.png")
+        Image.new("RGB", (40, 50), "red").save(self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_one_call_fills_every_field(self):
+        reply = json.dumps({
+            "stamp_name": "Centennial", "country": "Canada", "denomination": "5c",
+            "year": 1967, "catalog_number": "Scott 453", "color": "blue",
+            "perforation": "12", "format": "single", "mint_used": "MNH",
+            "description": "Canada 1967 5c Centennial, blue",
+        })
+        pieces = [reply[i:i + 7] for i in range(0, len(reply), 7)]
+        with patch("requests.post", return_value=FakeStream(pieces)) as post:
+            metadata = generate_metadata(self.image)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(post.call_args.kwargs["json"]["format"], "json")
+        self.assertEqual(tuple(metadata), METADATA_FIELDS)
+        self.assertEqual(metadata["year"], "1967")
+        self.assertEqual((metadata["format"], metadata["mint_used"]), ("Single", "Mint"))
+        self.assertEqual(metadata["catalog_number"], "Scott 453")
+
+    def test_truncated_and_wrapped_output_is_repaired(self):
+        self.assertEqual(
+            repair_json('```json\n{"country": "Peru", "year": "1950",}\n```'),
+            {"country": "Peru", "year": "1950"},
+        )
+        self.assertEqual(
+            repair_json('Here you go: {"country": "Peru", "colour": ["red", "gre'),
+            {"country": "Peru", "colour": ["red", "gre"]},
+        )
+        self.assertEqual(repair_json('{"country": "Peru", "year"'), {"country": "Peru"})
+        self.assertEqual(repair_json("no json here"), {})
+
+    def test_validation_blanks_bad_values_and_recovers_from_description(self):
+        metadata = validate_metadata({
+            "Country": "Unknown", "Face Value": "twenty", "year": "MCMLX",
+            "condition": "maybe", "description": "France 1960 20c Marianne",
+            "price": 4.5,
+        })
+        self.assertNotIn("price", metadata)
+        self.assertEqual(metadata["mint_used"], "")
+        self.assertEqual(
+            (metadata["country"], metadata["denomination"], metadata["year"]),
+            ("France", "20c", "1960"),
+        )
+
+    def test_fallback_without_model(self):
+        with patch("requests.post", side_effect=requests.ConnectionError):
+            metadata = generate_metadata(self.image)
+        self.assertEqual(metadata["stamp_name"], "IMG_0001")
+        self.assertEqual(metadata["description"], "Stamp from IMG_0001")
+        self.assertEqual(metadata["country"], "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Tests for database snapshots, image deltas and restore."""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup import (  # noqa: E402
+    copy_database,
+    create_snapshot,
+    list_snapshots,
+    load_manifest,
+    restore_snapshot,
+    verify_snapshot,
+)
+
+
+class TestBackup(unittest.TestCase):
+    """Snapshots of a WAL database and an images folder in a temp dir."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, "live.db")
+        self.images = os.path.join(self.tmp, "images")
+        self.snapshots = os.path.join(self.tmp, "snapshots")
+        os.makedirs(os.path.join(self.images, "scan_jobs", "1"))
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE stamps (id INTEGER PRIMARY KEY, country TEXT)")
+        conn.executemany("INSERT INTO stamps (country) VALUES (?)", [("Canada",)] * 500)
+        conn.commit()
+        conn.close()
+        for name in ("a.jpg", "scan_jobs/1/b.jpg"):
+            self.add_image(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def add_image(self, name, data=b"stamp"):
+        with open(os.path.join(self.images, name), "wb") as f:
+            f.write(data + name.encode())
+
+    def rows(self, path=None):
+        conn = sqlite3.connect(path or self.db_path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM stamps").fetchone()[0]
+        finally:
+            conn.close()
+
+    def snapshot(self, **kwargs):
+        return create_snapshot(self.db_path, self.images, self.snapshots, **kwargs)
+
+    def test_paced_copy_is_consistent_while_writing(self):
+        stop = threading.Event()
+
+        def writer():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            while not stop.is_set():
+                conn.execute("INSERT INTO stamps (country) VALUES ('Peru')")
+                conn.commit()
+            conn.close()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            target = os.path.join(self.tmp, "copy.db")
+            copy_database(self.db_path, target, pages=1, sleep_ms=1)
+        finally:
+            stop.set()
+            thread.join()
+        conn = sqlite3.connect(target)
+        self.assertEqual(conn.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        self.assertGreaterEqual(conn.execute("SELECT COUNT(*) FROM stamps").fetchone()[0], 500)
+        conn.close()
+
+    def test_images_are_archived_incrementally(self):
+        first = self.snapshot()
+        self.add_image("c.jpg")
+        second = self.snapshot()
+        third = self.snapshot()
+        self.assertEqual(list_snapshots(self.snapshots), [first, second, third])
+        added = [load_manifest(n, self.snapshots)["images"]["added"] for n in (first, second, third)]
+        self.assertEqual(added, [2, 1, 0])
+        self.assertIsNone(load_manifest(third, self.snapshots)["images"]["archive"])
+        self.assertEqual(load_manifest(third, self.snapshots)["db"]["tables"], {"stamps": 500})
+
+    def test_pruning_keeps_every_snapshot_restorable(self):
+        self.snapshot(keep=2)
+        self.add_image("c.jpg")
+        self.snapshot(keep=2, include_images=False)
+        os.remove(os.path.join(self.images, "a.jpg"))
+        last = self.snapshot(keep=2)
+        self.assertEqual(len(list_snapshots(self.snapshots)), 2)
+
+        # b.jpg only ever went into the pruned first snapshot.
+        verify_snapshot(last, self.snapshots)
+        target_db = os.path.join(self.tmp, "restored.db")
+        target_images = os.path.join(self.tmp, "restored_images")
+        result = restore_snapshot(last, target_db, target_images, self.snapshots)
+        self.assertEqual(result["images"], 2)
+        self.assertTrue(os.path.exists(os.path.join(target_images, "scan_jobs", "1", "b.jpg")))
+        self.assertTrue(os.path.exists(os.path.join(target_images, "c.jpg")))
+        self.assertFalse(os.path.exists(os.path.join(target_images, "a.jpg")))  # deleted before
+        self.assertEqual(self.rows(target_db), 500)
+
+    def test_restore_replaces_the_live_database(self):
+        name = self.snapshot()
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("DELETE FROM stamps WHERE id > 10")
+        conn.commit()
+        conn.close()
+        restore_snapshot(name, self.db_path, self.images, self.snapshots)
+        self.assertEqual(self.rows(), 500)
+        self.assertEqual(self.rows(self.db_path + ".pre-restore"), 10)
+
+    def test_damaged_snapshots_are_refused(self):
+        name = self.snapshot()
+        with open(os.path.join(self.snapshots, name, "stampd.db"), "r+b") as f:
+            f.seek(4096)
+            f.write(b"\0" * 64)
+        with self.assertRaises(RuntimeError):
+            restore_snapshot(name, self.db_path, self.images, self.snapshots)
+        self.assertEqual(self.rows(), 500)
+        with self.assertRaises(ValueError):
+            verify_snapshot("19990101_000000", self.snapshots)
+
+
+if __name__ == "__main__":
+    unittest.main()
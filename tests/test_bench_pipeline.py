@@ -0,0 +1,56 @@
+"""Tests for the pipeline benchmark suite."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_pipeline import compare_results, measure, run_scale, synthetic_stamp  # noqa: E402
+from db import Base, engine  # noqa: E402
+
+
+def _run(per_item):
+    return {"environment": {"commit": "x"}, "scales": {"1000": {
+        name: {"per_item_ms": ms} for name, ms in per_item.items()
+    }}}
+
+
+class TestBenchPipeline(unittest.TestCase):
+    """Result bookkeeping and a miniature end-to-end run."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        Base.metadata.drop_all(engine)
+
+    def test_compare_flags_only_real_slowdowns(self):
+        base = _run({"search_text": 1.0, "export_csv": 2.0, "gone": 1.0})
+        new = _run({"search_text": 1.1, "export_csv": 3.0, "added": 1.0})
+        rows = {row["benchmark"]: row for row in compare_results(base, new, threshold=0.15)}
+        self.assertEqual(set(rows), {"search_text", "export_csv"})
+        self.assertFalse(rows["search_text"]["regressed"])
+        self.assertTrue(rows["export_csv"]["regressed"])
+        self.assertEqual(rows["export_csv"]["ratio"], 1.5)
+
+    def test_measure_reports_per_item_cost(self):
+        calls = []
+        result = measure(lambda: calls.append(1), repeat=4, items=10)
+        self.assertEqual(len(calls), 5)  # one warm-up
+        self.assertEqual((result["runs"], result["items"]), (4, 10))
+        self.assertLessEqual(result["median_ms"], result["p95_ms"])
+
+    def test_every_benchmark_runs_at_small_scale(self):
+        corpus = [synthetic_stamp(os.path.join(self.tmp, f"s{i}.jpg"), i) for i in range(3)]
+        results = run_scale(50, corpus, self.tmp, repeat=1, ollama_latency=0)
+        self.assertIn("ingest_scan_job", results)
+        self.assertEqual(results["ingest_scan_job"]["ollama_calls"], 3)
+        self.assertEqual(results["gallery_load"]["items"], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
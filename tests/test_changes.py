@@ -0,0 +1,137 @@
+"""Tests for the sequence-numbered change feed."""
+
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from changes import (  # noqa: E402
+    CHANGE_RETENTION, StampChange, change_token, changes_since, new_token, prune_changes,
+)
+from db import Session, Stamp, Base, engine  # noqa: E402
+import maintenance  # noqa: E402
+
+
+class TestChangeFeed(unittest.TestCase):
+    """The feed reports inserts, updates and deletes since a token."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.session = Session()
+        self.session.add_all([Stamp(id=1, country="USA"), Stamp(id=2, country="Canada")])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        Base.metadata.drop_all(engine)
+
+    def test_first_call_is_full_snapshot(self):
+        feed = changes_since()
+        self.assertTrue(feed["reset"])
+        self.assertEqual([s.id for s in feed["inserted"]], [1, 2])
+        self.assertEqual(feed["token"], new_token())
+
+    def test_delta_after_token(self):
+        token = changes_since()["token"]
+
+        stamp = self.session.get(Stamp, 1)
+        stamp.country = "Peru"
+        self.session.add(Stamp(id=3, country="Chile"))
+        self.session.query(Stamp).filter(Stamp.id == 2).delete()
+        self.session.commit()
+
+        feed = changes_since(token)
+        self.assertFalse(feed["reset"])
+        self.assertEqual([s.id for s in feed["updated"]], [1])
+        self.assertEqual([s.id for s in feed["inserted"]], [3])
+        self.assertEqual(feed["deleted"], [2])
+        self.assertGreater(int(feed["token"]), int(token))
+
+    def test_unchanged_rows_are_not_returned(self):
+        feed = changes_since(changes_since()["token"])
+        self.assertEqual(feed["inserted"] + feed["updated"] + feed["deleted"], [])
+
+    def test_late_commit_is_not_missed(self):
+        # A write flushed long before it commits (like a scan chunk) must
+        # still show up for a token taken in between.
+        writer = Session()
+        try:
+            writer.get(Stamp, 1).country = "Peru"
+            writer.flush()
+            token = changes_since()["token"]
+            writer.commit()
+        finally:
+            writer.close()
+        self.assertEqual([s.id for s in changes_since(token)["updated"]], [1])
+
+    def test_reused_id_is_live(self):
+        token = new_token()
+        self.session.query(Stamp).filter(Stamp.id == 2).delete()
+        self.session.add(Stamp(id=2, country="Chile"))
+        self.session.commit()
+        feed = changes_since(token)
+        self.assertEqual([s.country for s in feed["inserted"]], ["Chile"])
+        self.assertEqual(feed["deleted"], [])
+
+    def test_pruned_or_foreign_token_forces_reset(self):
+        token = new_token()
+        self.session.get(Stamp, 1).country = "Peru"
+        self.session.commit()
+        self.session.get(Stamp, 1).country = "Chile"
+        self.session.commit()
+        expired = datetime.utcnow() - CHANGE_RETENTION - timedelta(days=1)
+        self.session.query(StampChange).update({StampChange.changed_at: expired})
+        self.session.commit()
+        self.assertEqual(prune_changes(), 3)
+        self.assertTrue(changes_since(token)["reset"])
+        self.assertFalse(changes_since(new_token())["reset"])
+        self.assertTrue(changes_since(str(change_token() + 10))["reset"])
+        with self.assertRaises(ValueError):
+            changes_since("not-a-token")
+
+    def test_prune_keeps_the_newest_row(self):
+        expired = datetime.utcnow() - CHANGE_RETENTION - timedelta(days=1)
+        self.session.query(StampChange).update({StampChange.changed_at: expired})
+        self.session.commit()
+        latest = change_token()
+        self.assertIn("prune_changes", maintenance.run_due({}))
+        self.assertEqual(self.session.query(StampChange.seq).all(), [(latest,)])
+        self.assertEqual(change_token(), latest)
+
+
+class TestOldDatabase(unittest.TestCase):
+    """Stamps from before ``updated_at`` existed get a timestamp on upgrade."""
+
+    def setUp(self):
+        Base.metadata.drop_all(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE stamps (id INTEGER PRIMARY KEY, country VARCHAR(100), created_at DATETIME)"
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO stamps (id, country, created_at) "
+                "VALUES (1, 'USA', '2020-01-01 00:00:00.000000'), (2, 'Canada', NULL)"
+            )
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+
+    def test_updated_at_is_added_and_backfilled(self):
+        Base.metadata.create_all(engine)
+        session = Session()
+        try:
+            stamps = session.query(Stamp).order_by(Stamp.id).all()
+            self.assertEqual(stamps[0].updated_at, datetime(2020, 1, 1))
+            self.assertIsNotNone(stamps[1].updated_at)
+            token = new_token()
+            session.query(Stamp).filter(Stamp.id == 2).delete()
+            session.commit()
+        finally:
+            session.close()
+        self.assertEqual(changes_since(token)["deleted"], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Tests for the cached, reloadable configuration service."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import ConfigService, _LiveConfig, settings, validate_config  # noqa: E402
+from inference_scheduler import InferenceScheduler  # noqa: E402
+import backup  # noqa: E402
+import job_queue  # noqa: E402
+import metadata_resolver  # noqa: E402
+import query_cache  # noqa: E402
+import scan_jobs  # noqa: E402
+
+
+class TestConfigService(unittest.TestCase):
+    """Caching, change detection, validation and subscribers."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "config.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, cfg):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(cfg, f)
+
+    def test_missing_file_gets_defaults(self):
+        service = ConfigService(self.path, defaults={"ai_model": "phi3"})
+        self.assertEqual(service.get(), {"ai_model": "phi3"})
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), {"ai_model": "phi3"})
+
+    def test_reloads_only_when_the_file_changes(self):
+        self.write({"ai_model": "phi3"})
+        service = ConfigService(self.path, check_interval=60)
+        seen = []
+        service.subscribe(lambda cfg, previous: seen.append((cfg["ai_model"], previous["ai_model"])))
+        self.assertFalse(service.reload())
+
+        self.write({"ai_model": "llava:13b"})
+        self.assertEqual(service.get()["ai_model"], "phi3")  # not checked again yet
+        self.assertTrue(service.reload())
+        self.assertEqual(service.get()["ai_model"], "llava:13b")
+        self.assertEqual(seen, [("llava:13b", "phi3")])
+
+        live = _LiveConfig(service)
+        service.save({"ai_model": "bakllava"})
+        self.assertEqual(live.get("ai_model"), "bakllava")
+        self.assertEqual(len(seen), 2)
+
+    def test_invalid_edits_keep_the_last_good_settings(self):
+        self.write({"ai_model": "phi3", "inference": {"max_concurrent": 2}})
+        service = ConfigService(self.path)
+        self.write({"ai_model": "phi3", "inference": {"max_concurrent": "two"}})
+        with self.assertLogs("stampd.config", "WARNING"):
+            self.assertFalse(service.reload())
+        self.assertEqual(service.get()["inference"]["max_concurrent"], 2)
+
+        with self.assertRaises(ValueError):
+            service.save({"inference": {"max_concurrent": True}})
+        with self.assertRaises(ValueError):
+            ConfigService(self.path)  # a broken file at startup is an error
+
+    def test_bind_loads_a_section_now_and_on_change(self):
+        self.write({"ai_model": "phi3", "ocr": {"workers": 2}})
+        service = ConfigService(self.path)
+        loaded = []
+
+        @service.bind("ocr")
+        def load(section):
+            loaded.append(section)
+
+        service.save({"ai_model": "llava:13b", "ocr": {"workers": 2}})  # other section
+        service.save({"ai_model": "llava:13b"})
+        self.assertEqual(loaded, [{"workers": 2}, {}])
+        self.assertIs(service.bind("ocr", load), load)
+
+    def test_schema(self):
+        validate_config({"ai_model": "phi3", "profiling": {"threshold_ms": 1.5}, "custom": [1]})
+        with self.assertRaises(ValueError) as ctx:
+            validate_config({"ai_model": 3, "metrics": {"port": "9464"}, "workers": []})
+        for path in ("ai_model", "metrics.port", "workers"):
+            self.assertIn(path, str(ctx.exception))
+
+
+class TestSchedulerReconfigure(unittest.TestCase):
+    def test_raising_the_limit_admits_waiters(self):
+        scheduler = InferenceScheduler(max_concurrent=1)
+        granted = threading.Event()
+
+        def waiter():
+            with scheduler.slot("batch", owner="b"):
+                granted.set()
+
+        with scheduler.slot("interactive", owner="a"):
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            self.assertFalse(granted.wait(0.1))
+            scheduler.reconfigure(max_concurrent=2)
+            self.assertTrue(granted.wait(1))
+        thread.join()
+        with self.assertRaises(ValueError):
+            scheduler.reconfigure(max_concurrent=0)
+
+
+class TestModuleSettings(unittest.TestCase):
+    """Modules re-read their settings when the configuration changes."""
+
+    MODULES = {
+        "backup": backup, "job_queue": job_queue, "resolver": metadata_resolver,
+        "gallery": query_cache, "scan_jobs": scan_jobs,
+    }
+
+    def tearDown(self):
+        for name, module in self.MODULES.items():
+            module._load_settings(settings.section(name))
+
+    def test_edits_apply_without_a_restart(self):
+        self.cfg = cfg = {
+            "backup": {"keep": 2},
+            "job_queue": {"lease_seconds": 5, "max_attempts": 1},
+            "resolver": {"min_confidence": 0.9},
+            "gallery": {"cache_size": 1, "cache_ttl": 1.5},
+            "scan_jobs": {"chunk_size": 3},
+        }
+        for name, module in self.MODULES.items():
+            module._load_settings(cfg[name])
+        self.assertEqual(backup.KEEP_SNAPSHOTS, 2)
+        self.assertEqual((job_queue.LEASE_SECONDS, job_queue.MAX_ATTEMPTS), (5, 1))
+        self.assertEqual(metadata_resolver.RESOLVER_MIN_CONFIDENCE, 0.9)
+        self.assertEqual(metadata_resolver.PHASH_MAX_DISTANCE, 6)  # default
+        self.assertEqual((query_cache.gallery_cache.maxsize, query_cache.gallery_cache.ttl), (1, 1.5))
+        self.assertEqual(scan_jobs.SCAN_CHUNK_SIZE, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
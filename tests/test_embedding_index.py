@@ -0,0 +1,146 @@
+"""Tests for the local image-embedding similarity index."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_index import (  # noqa: E402
+    EMBEDDING_DIM, KEYS_PATH, VECTORS_PATH, _load, add_to_index, find_similar,
+    image_embedding, indexed_hashes, indexed_vectors, rebuild_index, sync_index,
+    unreadable_hashes,
+)
+from image_utils import get_file_hash  # noqa: E402
+from db import DB_PATH, Session, Stamp, Base, engine  # noqa: E402
+
+
+def _draw(path, colour, stripes):
+    img = Image.new("RGB", (200, 240), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((20, 20, 180, 220), fill=colour)
+    for i in range(stripes):
+        draw.line((20, 30 + i * 20, 180, 30 + i * 20), fill="white", width=3)
+    img.save(path)
+
+
+class TestEmbeddingIndex(unittest.TestCase):
+    """Descriptors, incremental append and top-k search."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.tmp = tempfile.mkdtemp()
+        specs = {
+            "red.png": ((200, 30, 30), 8),
+            "red_again.png": ((190, 35, 35), 8),
+            "blue.png": ((30, 40, 200), 0),
+            "green.png": ((30, 160, 40), 3),
+        }
+        session = Session()
+        for sid, (name, (colour, stripes)) in enumerate(specs.items(), start=1):
+            path = os.path.join(self.tmp, name)
+            _draw(path, colour, stripes)
+            session.add(Stamp(id=sid, image_path=path, file_hash=get_file_hash(path)))
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        Base.metadata.drop_all(engine)
+
+    def test_descriptor_is_unit_float32(self):
+        vec = image_embedding(os.path.join(self.tmp, "red.png"))
+        self.assertEqual(vec.shape, (EMBEDDING_DIM,))
+        self.assertEqual(vec.dtype, np.float32)
+        self.assertAlmostEqual(float(np.linalg.norm(vec)), 1.0, places=5)
+        self.assertIsNone(image_embedding(os.path.join(self.tmp, "missing.png")))
+
+    def test_nearest_neighbour_and_incremental_append(self):
+        self.assertEqual(sync_index(), 4)
+        matches = find_similar(stamp_id=1, k=2)
+        self.assertEqual(matches[0][0], 2)
+        self.assertNotIn(1, [sid for sid, _ in matches])
+        self.assertEqual(len(indexed_hashes()), 4)
+
+        copy = os.path.join(self.tmp, "copy.png")
+        shutil.copy(os.path.join(self.tmp, "blue.png"), copy)
+        session = Session()
+        session.add(Stamp(id=5, image_path=copy, file_hash=get_file_hash(copy)))
+        session.commit()
+        session.close()
+        # Same content as stamp 3: no new row, and a perfect match.
+        self.assertEqual(add_to_index([(get_file_hash(copy), copy)]), 0)
+        self.assertEqual(find_similar(stamp_id=3, k=1), [(5, 1.0)])
+
+        # Descriptors of indexed files come from the index, not the images.
+        vectors = indexed_vectors([get_file_hash(copy), "0" * 32, None])
+        self.assertEqual(list(vectors), [get_file_hash(copy)])
+        np.testing.assert_allclose(vectors[get_file_hash(copy)], image_embedding(copy), atol=1e-6)
+        query = image_embedding(os.path.join(self.tmp, "blue.png"))
+        self.assertEqual(find_similar(vector=query, k=2)[0][1], 1.0)
+
+    def test_deleted_stamps_are_not_returned(self):
+        sync_index()
+        session = Session()
+        session.query(Stamp).filter(Stamp.id == 2).delete()
+        session.commit()
+        session.close()
+        self.assertNotIn(2, [sid for sid, _ in find_similar(stamp_id=1)])
+
+    def test_searches_do_not_sync_and_unreadable_images_are_skipped(self):
+        self.assertEqual(find_similar(image_path=os.path.join(self.tmp, "red.png")), [])
+        broken = os.path.join(self.tmp, "broken.png")
+        with open(broken, "wb") as f:
+            f.write(b"not an image")
+        session = Session()
+        session.add(Stamp(id=5, image_path=broken, file_hash=get_file_hash(broken)))
+        session.commit()
+        session.close()
+
+        self.assertEqual(sync_index(), 4)
+        self.assertEqual(unreadable_hashes(), {get_file_hash(broken)})
+        self.assertEqual(sync_index(), 0)
+        Image.new("RGB", (64, 64), "red").save(broken, format="PNG")  # repaired in place
+        self.assertEqual(rebuild_index(), 5)
+        self.assertEqual(unreadable_hashes(), set())
+
+    def test_appends_from_two_processes_stay_aligned(self):
+        images = []
+        for i in range(12):
+            path = os.path.join(self.tmp, f"extra_{i}.png")
+            _draw(path, (20 * i, 100, 255 - 20 * i), i)
+            images.append((get_file_hash(path), path))
+        script = (
+            "import sys; sys.path.insert(0, %r)\n"
+            "from embedding_index import add_to_index\n"
+            "print(add_to_index(%r))" % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))), images)
+        )
+        env = {**os.environ, "STAMPD_DB_PATH": DB_PATH}  # other tests change it at import
+        other = subprocess.Popen(
+            [sys.executable, "-c", script], stdout=subprocess.PIPE, text=True, env=env
+        )
+        added = add_to_index(reversed(images))
+        added += int(other.communicate()[0])
+        self.assertEqual(added, 12)
+
+        # A torn append is trimmed back to whole rows by the next writer.
+        with open(KEYS_PATH, "ab") as f:
+            f.write(b"0" * 32)
+        self.assertEqual(add_to_index(images), 0)
+        keys, vectors = _load()
+        self.assertEqual(os.path.getsize(KEYS_PATH) // 32, len(keys))
+        self.assertEqual(os.path.getsize(VECTORS_PATH) // (EMBEDDING_DIM * 4), len(keys))
+        self.assertEqual(len(set(keys)), 12)
+        by_hash = dict(images)
+        for key, vec in zip(keys, vectors):
+            np.testing.assert_allclose(vec, image_embedding(by_hash[key.decode()]), atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ sys.path.append(str(ROOT))
 os.environ["STAMPD_DB_PATH"] = str(ROOT / "test_export.db")
 
 from db_utils import Session, Stamp, init_db, insert_stamp  # noqa: E402
+import export_utils  # noqa: E402
 from export_utils import export_csv, export_pdf, export_xlsx  # noqa: E402
 
 
@@ -27,10 +28,19 @@ def setup_module(module):
     })
 
 
-def test_export_creates_files():
+def teardown_module(module):
+    session = Session()
+    session.query(Stamp).delete()
+    session.commit()
+    session.close()
+
+
+def test_export_creates_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_utils, "BACKUP_DIR", str(tmp_path))
     csv_path = export_csv()
     xlsx_path = export_xlsx()
     pdf_path = export_pdf()
     assert os.path.exists(csv_path)
     assert os.path.exists(xlsx_path)
     assert os.path.exists(pdf_path)
+    assert {os.path.dirname(p) for p in (csv_path, xlsx_path, pdf_path)} == {str(tmp_path)}
@@ -0,0 +1,97 @@
+"""Tests for the trigger-maintained facet summary table."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STAMPD_DB_PATH", os.path.join(tempfile.mkdtemp(), "test_facets.db"))
+
+from facets import StampFacet, facet_counts  # noqa: E402
+from gallery import search_stamps  # noqa: E402
+from db import Session, Stamp, Base, engine  # noqa: E402
+
+
+class TestFacetCounts(unittest.TestCase):
+    """Facet counts follow inserts, updates and deletes on ``stamps``."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.session = Session()
+        self.session.add_all([
+            Stamp(id=1, country="USA", year="1950", mint_used="Used", listing_status="Live"),
+            Stamp(id=2, country="USA", year="1957", mint_used="Mint"),
+            Stamp(id=3, country="Canada", year="1965", mint_used="Used"),
+        ])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        Base.metadata.drop_all(engine)
+
+    def test_counts_after_insert(self):
+        counts = facet_counts()
+        self.assertEqual(counts["country"], [("USA", 2), ("Canada", 1)])
+        self.assertEqual(dict(counts["decade"]), {"1950s": 2, "1960s": 1})
+        self.assertEqual(dict(counts["listing_status"]), {"Live": 1, "Unknown": 2})
+
+    def test_counts_after_update_and_delete(self):
+        stamp = self.session.get(Stamp, 2)
+        stamp.country = "Canada"
+        self.session.commit()
+        self.assertEqual(dict(facet_counts()["country"]), {"USA": 1, "Canada": 2})
+
+        self.session.query(Stamp).filter(Stamp.id == 1).delete()
+        self.session.commit()
+        counts = facet_counts()
+        self.assertEqual(counts["country"], [("Canada", 2)])
+        self.assertEqual(dict(counts["mint_used"]), {"Mint": 1, "Used": 1})
+
+    def test_summary_table_matches_group_by(self):
+        self.session.add(Stamp(id=4, country="  ", year="n/a"))
+        self.session.commit()
+        stored = {
+            (row.value, row.count)
+            for row in self.session.query(StampFacet).filter_by(facet="decade")
+            if row.count
+        }
+        self.assertEqual(stored, {("1950s", 2), ("1960s", 1), ("Unknown", 1)})
+        self.assertIn(("Unknown", 1), facet_counts()["country"])
+
+    def test_search_with_facet_filters(self):
+        results = search_stamps("", {"decade": "1950s", "mint_used": "Used"})
+        self.assertEqual([s.id for s in results], [1])
+        results = search_stamps("", {"listing_status": "Unknown"})
+        self.assertEqual(sorted(s.id for s in results), [2, 3])
+
+
+class TestOldDatabase(unittest.TestCase):
+    """Databases from before the newer columns are migrated, then counted."""
+
+    def setUp(self):
+        Base.metadata.drop_all(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE stamps (id INTEGER PRIMARY KEY, country VARCHAR(100), "
+                "year VARCHAR(20), collection VARCHAR(100), created_at DATETIME)"
+            )
+            connection.exec_driver_sql(
+                "INSERT INTO stamps (id, country, year) VALUES (1, 'USA', '1950'), (2, 'Canada', '1965')"
+            )
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+
+    def test_create_all_adds_missing_columns(self):
+        Base.metadata.create_all(engine)
+        with engine.connect() as connection:
+            columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(stamps)")}
+        self.assertTrue(set(Stamp.__table__.columns.keys()) <= columns)
+        counts = facet_counts()
+        self.assertEqual(counts["country"], [("Canada", 1), ("USA", 1)])
+        self.assertEqual(counts["mint_used"], [("Unknown", 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Tests for the enhance-and-crop stage."""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_utils  # noqa: E402
+from image_utils import (  # noqa: E402
+    enhance_and_crop, foreground_mask, min_area_rect, segment_sheet,
+)
+
+BED = (230, 235, 225)
+
+
+def _scan(angle):
+    """A 1200x900 scan holding one 400x600 dark stamp rotated by *angle*."""
+    stamp = Image.new("RGB", (400, 600), (50, 40, 120))
+    stamp = stamp.rotate(angle, expand=True, fillcolor=BED)
+    scan = Image.new("RGB", (1200, 900), BED)
+    scan.paste(stamp, (300, 100))
+    return scan
+
+
+class TestEnhanceAndCrop(unittest.TestCase):
+    """Stamp detection, deskew and crop on synthetic scans."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_min_area_rect_recovers_rotation(self):
+        mask, _ = foreground_mask(np.asarray(_scan(8)))
+        _, _, w, h, angle = min_area_rect(mask)
+        self.assertAlmostEqual(abs(angle), 8, delta=0.5)
+        self.assertAlmostEqual(min(w, h) / max(w, h), 400 / 600, delta=0.03)
+
+    def test_crop_is_deskewed_stamp(self):
+        path = os.path.join(self.tmp.name, "scan.jpg")
+        _scan(-12).save(path)
+        out = enhance_and_crop(path, os.path.join(self.tmp.name, "out.jpg"))
+        with Image.open(out) as img:
+            w, h = img.size
+            # Centre of the crop is stamp, not scanner bed.
+            centre = img.getpixel((w // 2, h // 2))
+        self.assertAlmostEqual(w, 400, delta=20)
+        self.assertAlmostEqual(h, 600, delta=20)
+        self.assertLess(sum(centre), 300)
+
+    def test_tight_crop_is_left_uncropped(self):
+        path = os.path.join(self.tmp.name, "tight.jpg")
+        noise = np.random.default_rng(0).integers(0, 255, (300, 200, 3), dtype=np.uint8)
+        Image.fromarray(noise).save(path)
+        out = enhance_and_crop(path, os.path.join(self.tmp.name, "out.jpg"))
+        with Image.open(out) as img:
+            self.assertEqual(img.size, (200, 300))
+
+    def test_same_name_uploads_get_their_own_jpeg(self):
+        outputs = []
+        with patch.object(image_utils, "TEMP_UPLOADS", self.tmp.name):
+            for i, angle in enumerate((-12, 5)):
+                os.makedirs(os.path.join(self.tmp.name, str(i)))
+                path = os.path.join(self.tmp.name, str(i), "stamp.png")
+                _scan(angle).save(path)
+                outputs.append(enhance_and_crop(path))
+        self.assertNotEqual(outputs[0], outputs[1])
+        for out in outputs:
+            self.assertTrue(os.path.basename(out).startswith("enhanced_stamp_"))
+            self.assertTrue(out.endswith(".jpg"))
+            with Image.open(out) as img:
+                self.assertEqual(img.format, "JPEG")
+
+    def test_missing_file_returns_input(self):
+        self.assertEqual(enhance_and_crop("no/such/file.jpg"), "no/such/file.jpg")
+
+
+class TestSegmentSheet(unittest.TestCase):
+    """Splitting a page scan into one image per stamp."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_grid_of_stamps_in_reading_order(self):
+        page = Image.new("RGB", (1600, 1200), BED)
+        for row in range(3):
+            for col in range(4):
+                shade = 30 + 15 * (row * 4 + col)
+                stamp = Image.new("RGB", (200, 240), (shade, 40, 120))
+                stamp = stamp.rotate(5 if col % 2 else -4, expand=True, fillcolor=BED)
+                page.paste(stamp, (100 + col * 370, 80 + row * 370))
+        page.paste((0, 0, 0), (1500, 1100, 1503, 1103))  # dust speck
+        path = os.path.join(self.tmp.name, "page.jpg")
+        page.save(path)
+
+        segments = segment_sheet(path, self.tmp.name)
+        self.assertEqual(len(segments), 12)
+        self.assertRegex(os.path.basename(segments[0]["path"]), r"^page_01_[0-9a-f]{8}\.jpg$")
+        lefts = [s["box"][0] for s in segments[:4]]
+        self.assertEqual(lefts, sorted(lefts))
+        self.assertLess(segments[3]["box"][1], segments[4]["box"][1])
+        with Image.open(segments[5]["path"]) as img:
+            self.assertAlmostEqual(img.size[0], 200, delta=15)
+            self.assertAlmostEqual(img.size[1], 240, delta=15)
+
+        # Re-splitting is idempotent; another page of that name keeps both.
+        self.assertEqual(segment_sheet(path, self.tmp.name), segments)
+        page.transpose(Image.FLIP_LEFT_RIGHT).save(path)
+        again = segment_sheet(path, self.tmp.name)
+        self.assertTrue(set(s["path"] for s in again).isdisjoint(s["path"] for s in segments))
+        self.assertTrue(all(os.path.exists(s["path"]) for s in segments))
+
+    def test_scan_without_background_yields_nothing(self):
+        path = os.path.join(self.tmp.name, "noise.jpg")
+        noise = np.random.default_rng(1).integers(0, 255, (300, 300, 3), dtype=np.uint8)
+        Image.fromarray(noise).save(path)
+        self.assertEqual(segment_sheet(path, self.tmp.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
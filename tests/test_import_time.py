@@ -0,0 +1,76 @@
+"""Import-time budget for the app and worker entry points.
+
+Runs ``python -X importtime`` in a fresh interpreter per module, so the
+numbers are cold-start costs.  Budgets are about three times what a
+developer laptop measures; set ``STAMPD_IMPORT_BUDGET_SCALE`` on slow
+machines rather than raising them here.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from typing import Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time allowed per module, in milliseconds.
+IMPORT_BUDGET_MS = {
+    "worker_pool": 1200,
+    "scan_jobs": 1500,
+    "app": 6000,
+}
+BUDGET_SCALE = float(os.environ.get("STAMPD_IMPORT_BUDGET_SCALE", "1"))
+
+# Optional dependencies loaded on first use by export, scraping, OCR and
+# AI code; ``app`` may still get requests through gradio.
+LAZY_DEPENDENCIES = {"fpdf", "openpyxl", "bs4", "pytesseract", "requests"}
+NOT_FOR_WORKERS = LAZY_DEPENDENCIES | {"gradio", "pandas", "matplotlib"}
+# Subsystems the app loads in its launch path or on first use.
+APP_SUBSYSTEMS = {"worker_pool", "backup", "scan_jobs", "embedding_index", "reverse_search"}
+NOT_FOR_APP = (LAZY_DEPENDENCIES - {"requests"}) | {"pandas", "matplotlib"} | APP_SUBSYSTEMS
+
+
+def import_times(module: str) -> Dict[str, float]:
+    """Import *module* in a new interpreter; return cumulative milliseconds
+    per imported module, from ``-X importtime``."""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "STAMPD_DB_PATH": os.path.join(tmp, "stampd.db")}
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=ROOT, env=env, capture_output=True, text=True, timeout=120,
+        )
+    if proc.returncode:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    """Startup stays within budget and heavy optional imports stay lazy."""
+
+    def test_entry_points_within_budget(self):
+        for module, budget in IMPORT_BUDGET_MS.items():
+            # Best of two runs: the first may pay for a cold disk cache.
+            elapsed = min(import_times(module)[module] for _ in range(2))
+            with self.subTest(module=module):
+                self.assertLessEqual(
+                    elapsed, budget * BUDGET_SCALE,
+                    f"import {module} took {elapsed:.0f} ms (budget {budget} ms)",
+                )
+
+    def test_optional_dependencies_load_lazily(self):
+        for module in ("worker_pool", "scan_jobs", "export_utils", "valuation", "reverse_search"):
+            with self.subTest(module=module):
+                self.assertFalse(NOT_FOR_WORKERS & set(import_times(module)))
+        self.assertFalse(NOT_FOR_APP & set(import_times("app")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""Tests for the priority inference scheduler."""
+
+import os
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import session_scope  # noqa: E402
+from inference_scheduler import (  # noqa: E402
+    GateSession, InferenceOwner, InferenceScheduler, InferenceSlot, InferenceStat, init_gate_db,
+)
+
+
+def clear_gate():
+    init_gate_db()
+    with session_scope(GateSession) as session:
+        session.query(InferenceSlot).delete()
+        session.query(InferenceOwner).delete()
+        session.query(InferenceStat).delete()
+
+
+class TestInferenceScheduler(unittest.TestCase):
+    """Priority classes, round-robin owners, cancellation and metrics."""
+
+    def setUp(self):
+        clear_gate()
+        self.scheduler = InferenceScheduler(max_concurrent=1, aging_seconds=60)
+        self.order = []
+        self.release = threading.Event()
+        self.threads = []
+
+    def tearDown(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join(2)
+
+    def _hold_slot(self):
+        """Occupy the only slot until ``self.release`` is set."""
+        started = threading.Event()
+
+        def hold():
+            with self.scheduler.slot("backfill", owner="holder"):
+                started.set()
+                self.release.wait(5)
+
+        self._start(hold)
+        started.wait(2)
+
+    def _start(self, fn):
+        thread = threading.Thread(target=fn)
+        thread.start()
+        self.threads.append(thread)
+
+    def _queue(self, name, priority, owner, scheduler=None):
+        scheduler = scheduler or self.scheduler
+        self._start(lambda: scheduler.run(
+            self.order.append, name, priority=priority, owner=owner
+        ))
+
+    def _wait_for_depth(self, depth):
+        deadline = time.monotonic() + 2
+        while self._gate_waiting() < depth and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _gate_waiting(self):
+        with session_scope(GateSession, read_only=True) as session:
+            return session.query(InferenceSlot).filter(InferenceSlot.started_at.is_(None)).count()
+
+    def _drain(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join(2)
+
+    def test_interactive_overtakes_queued_batch(self):
+        self._hold_slot()
+        for i in range(3):
+            self._queue(f"batch{i}", "batch", "bulk")
+            self._wait_for_depth(i + 1)
+        self._queue("lookup", "interactive", "user")
+        self._wait_for_depth(4)
+        self._drain()
+        self.assertEqual(self.order[0], "lookup")
+        self.assertEqual(sorted(self.order[1:]), ["batch0", "batch1", "batch2"])
+
+    def test_owners_share_a_class_round_robin(self):
+        self._hold_slot()
+        for i in range(3):
+            self._queue(f"big{i}", "batch", "big")
+            self._wait_for_depth(i + 1)
+        self._queue("small", "batch", "small")
+        self._wait_for_depth(4)
+        self._drain()
+        self.assertLess(self.order.index("small"), 2)
+
+    def test_cancel_queued_and_running(self):
+        self._hold_slot()
+        errors = []
+
+        def queued():
+            try:
+                self.scheduler.run(self.order.append, "never", priority="batch", owner="job")
+            except CancelledError as e:
+                errors.append(e)
+
+        self._start(queued)
+        self._wait_for_depth(1)
+        self.assertEqual(self.scheduler.cancel("job"), 1)
+        self.threads[-1].join(2)
+        self.assertEqual(len(errors), 1)
+
+        self.assertEqual(self.scheduler.cancel("holder"), 1)
+        self._drain()
+        self.assertEqual(self.order, [])
+        stats = self.scheduler.stats()["classes"]
+        self.assertEqual(stats["batch"]["cancelled"], 1)
+        self.assertEqual(stats["backfill"]["completed"], 1)
+
+    def test_aging_promotes_long_waits(self):
+        self.scheduler.aging_seconds = 0.05
+        self._hold_slot()
+        self._queue("old", "backfill", "background")
+        self._wait_for_depth(1)
+        time.sleep(0.15)
+        self._queue("new", "interactive", "user")
+        self._wait_for_depth(2)
+        self._drain()
+        self.assertEqual(self.order, ["old", "new"])
+
+    def test_metrics(self):
+        self._hold_slot()
+        self._queue("a", "interactive", "user")
+        self._wait_for_depth(1)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats["queue_depth"], stats["running"]), (1, 1))
+        time.sleep(0.05)
+        self._drain()
+        interactive = self.scheduler.stats()["classes"]["interactive"]
+        self.assertEqual(interactive["completed"], 1)
+        self.assertGreaterEqual(interactive["max_wait_ms"], 40)
+        with self.assertRaises(ValueError):
+            with self.scheduler.slot("urgent"):
+                pass
+
+
+    def test_processes_share_one_queue(self):
+        # A second scheduler stands in for a worker process: it has its own
+        # rows in the gate but competes for the same slot.
+        worker = InferenceScheduler(max_concurrent=1, aging_seconds=60)
+        self._hold_slot()
+        for i in range(2):
+            self._queue(f"batch{i}", "batch", "scan", scheduler=worker)
+            self._wait_for_depth(i + 1)
+        self._queue("lookup", "interactive", "user")
+        self._wait_for_depth(3)
+        self._drain()
+        self.assertEqual(self.order, ["lookup", "batch0", "batch1"])
+
+    def test_limit_applies_across_processes(self):
+        worker = InferenceScheduler(max_concurrent=1, aging_seconds=60)
+        self._hold_slot()
+        self._queue("worker", "interactive", "user", scheduler=worker)
+        self._wait_for_depth(1)
+        time.sleep(3 * 0.25)
+        self.assertEqual(self.order, [])
+        self._drain()
+        self.assertEqual(self.order, ["worker"])
+
+    def test_stats_include_other_processes(self):
+        worker = InferenceScheduler(max_concurrent=1, aging_seconds=60)
+        self._hold_slot()
+        self._queue("scan", "batch", "scan", scheduler=worker)
+        self._wait_for_depth(1)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats["queue_depth"], stats["running"], stats["processes"]), (1, 1, 2))
+        self.assertEqual(stats["classes"]["batch"]["waiting"], 1)
+        self._drain()
+        self.assertEqual(self.scheduler.stats()["classes"]["batch"]["completed"], 1)
+
+    def test_rows_of_dead_processes_expire(self):
+        now = time.time()
+        with session_scope(GateSession) as session:
+            session.add(InferenceSlot(
+                process="gone", owner="gone", priority="interactive",
+                submitted_at=now - 60, started_at=now - 60, lease_expires_at=now - 1,
+            ))
+        self.scheduler.run(self.order.append, "next", priority="batch")
+        self.assertEqual(self.order, ["next"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+"""Tests for the SQLite job queue and the out-of-process worker pool."""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_queue import (  # noqa: E402
+    QueuedJob, claim, complete, enqueue, fail, get_job, heartbeat, prune_jobs, queue_stats,
+    recover_expired, release, wait_for,
+)
+import worker_pool  # noqa: E402
+from worker_pool import JobInterrupted, WorkerPool  # noqa: E402
+from db import Session, Stamp, Base, engine  # noqa: E402
+from image_utils import get_file_hash  # noqa: E402
+
+
+class TestJobQueue(unittest.TestCase):
+    """Claiming, leases, retries and crash recovery."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+
+    def test_claim_by_priority_then_age(self):
+        batch = enqueue("preview", {"n": 1}, priority="batch")
+        other = enqueue("scan", {"n": 2}, priority="interactive")
+        urgent = enqueue("preview", {"n": 3}, priority="interactive")
+        job = claim(["preview"], "w1")
+        self.assertEqual((job["id"], job["payload"], job["attempts"]), (urgent, {"n": 3}, 1))
+        self.assertEqual(claim(["preview"], "w2")["id"], batch)
+        self.assertIsNone(claim(["preview"], "w3"))
+        self.assertEqual(get_job(other)["status"], "queued")
+
+    def test_only_the_lease_holder_finishes_a_job(self):
+        job_id = enqueue("index", {})
+        claim(["index"], "w1")
+        self.assertFalse(complete(job_id, "w2", 5))
+        self.assertTrue(heartbeat(job_id, "w1", {"done": 1}))
+        self.assertEqual(get_job(job_id)["progress"], {"done": 1})
+        self.assertTrue(complete(job_id, "w1", 5))
+        job = get_job(job_id)
+        self.assertEqual((job["status"], job["result"]), ("done", 5))
+        self.assertEqual(queue_stats()["index"]["done"], 1)
+
+    def test_failures_retry_until_attempts_run_out(self):
+        job_id = enqueue("scan", {}, max_attempts=2)
+        claim(["scan"], "w1")
+        fail(job_id, "w1", "boom")
+        self.assertEqual(get_job(job_id)["status"], "queued")
+        claim(["scan"], "w1")
+        fail(job_id, "w1", "boom again")
+        job = get_job(job_id)
+        self.assertEqual((job["status"], job["error"]), ("failed", "boom again"))
+
+    def test_expired_lease_is_recovered_and_release_is_free(self):
+        job_id = enqueue("scan", {})
+        claim(["scan"], "dead-worker")
+        session = Session()
+        session.query(QueuedJob).update({"lease_expires_at": datetime.utcnow() - timedelta(seconds=1)})
+        session.commit()
+        session.close()
+        self.assertEqual(recover_expired(), 1)
+        job = get_job(job_id)
+        self.assertEqual(job["status"], "queued")
+        self.assertIn("dead-worker", job["error"])
+        self.assertFalse(heartbeat(job_id, "dead-worker"))  # lease lost
+
+        claim(["scan"], "w2")
+        self.assertTrue(release(job_id, "w2"))
+        self.assertEqual(get_job(job_id)["attempts"], 1)
+        with self.assertRaises(ValueError):
+            enqueue("scan", {}, priority="urgent")
+
+    def test_old_finished_jobs_are_pruned(self):
+        old, recent, queued = enqueue("index", {}), enqueue("index", {}), enqueue("index", {})
+        for job_id in (old, recent):
+            claim(["index"], "w1")
+            complete(job_id, "w1", {"indexed": 1})
+        session = Session()
+        session.query(QueuedJob).filter(QueuedJob.id == old).update(
+            {"finished_at": datetime.utcnow() - timedelta(days=30)}
+        )
+        session.commit()
+        session.close()
+        self.assertEqual(prune_jobs(), 1)
+        self.assertEqual(prune_jobs(timedelta(0)), 1)
+        self.assertEqual(get_job(queued)["status"], "queued")
+        with self.assertRaises(ValueError):
+            get_job(old)
+
+
+class TestWorkerPool(unittest.TestCase):
+    """A real worker process consumes the queue and shuts down cleanly."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        Base.metadata.drop_all(engine)
+
+    def test_worker_runs_jobs_out_of_process(self):
+        image = os.path.join(self.tmp, "stamp.png")
+        Image.new("RGB", (64, 64), "red").save(image)
+        job_id = enqueue("index", {"images": [["a" * 32, image]]})
+        pool = WorkerPool({"index": 1}).start(supervise=False)
+        try:
+            job = wait_for(job_id, timeout=60)
+            self.assertEqual((job["status"], job["result"]), ("done", 1))
+            self.assertNotEqual(job["worker"].split(":")[1], str(os.getpid()))
+            self.assertEqual(pool.alive(), 1)
+        finally:
+            pool.stop(timeout=20)
+        self.assertEqual(pool.alive(), 0)
+        with self.assertRaises(ValueError):
+            WorkerPool({"nonsense": 1}).start()
+
+    def test_shutdown_keeps_finished_work_and_releases_interrupted_jobs(self):
+        stop = threading.Event()
+
+        def finishes(payload, stop, report):
+            stop.set()  # shutdown asked for while the job runs
+            return "done anyway"
+
+        def interrupted(payload, stop, report):
+            raise JobInterrupted()
+
+        with patch.dict(worker_pool.HANDLERS, {"test_a": finishes, "test_b": interrupted}):
+            first = enqueue("test_a", {})
+            worker_pool._run_one(claim(["test_a"], "w1"), "w1", stop)
+            second = enqueue("test_b", {})
+            worker_pool._run_one(claim(["test_b"], "w1"), "w1", stop)
+        self.assertEqual((get_job(first)["status"], get_job(first)["result"]), ("done", "done anyway"))
+        self.assertEqual(get_job(second)["status"], "queued")
+
+    def test_preview_images_runs_without_a_worker(self):
+        image = os.path.join(self.tmp, "stamp.png")
+        Image.new("RGB", (64, 64), "blue").save(image)
+        session = Session()
+        session.add(Stamp(image_path=image, file_hash=get_file_hash(image), country="Peru"))
+        session.commit()
+        session.close()
+        result = worker_pool.preview_images([image])
+        self.assertEqual(result["images"], [[image, ""]])
+        self.assertEqual(
+            (result["resolved"][image]["tier"], result["resolved"][image]["country"]), ("hash", "Peru")
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
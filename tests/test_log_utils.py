@@ -0,0 +1,117 @@
+"""Tests for structured, queued logging with correlation IDs."""
+
+import inspect
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log_utils  # noqa: E402
+from config import settings  # noqa: E402
+from log_utils import correlation, get_logger, setup_logging, shutdown_logging, with_request_id  # noqa: E402
+from job_queue import enqueue, get_job  # noqa: E402
+from db import Base, engine  # noqa: E402
+
+
+class TestLogUtils(unittest.TestCase):
+    """JSON lines, per-subsystem levels and request/job correlation."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutdown_logging()
+        shutil.rmtree(self.tmp)
+
+    def _records(self, process="test"):
+        shutdown_logging()  # flushes the queue
+        with open(os.path.join(self.tmp, f"{process}.jsonl"), encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines_with_extra_fields_and_exceptions(self):
+        setup_logging("test", self.tmp, console=False)
+        logger = get_logger("scan_jobs")
+        logger.info("✂️ Split %s into %d stamps", "sheet.jpg", 4, extra={"segments": 4})
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            logger.exception("chunk failed")
+        logger.debug("not at INFO")
+        first, second = self._records()
+        self.assertEqual(first["msg"], "✂️ Split sheet.jpg into 4 stamps")
+        self.assertEqual((first["level"], first["logger"], first["segments"]),
+                         ("INFO", "stampd.scan_jobs", 4))
+        self.assertNotIn("request_id", first)
+        self.assertEqual(second["level"], "ERROR")
+        self.assertIn("RuntimeError: boom", second["exc"])
+
+    def test_subsystem_levels_from_config(self):
+        with patch.object(log_utils, "SUBSYSTEM_LEVELS", {"db": "WARNING", "ocr_utils": "DEBUG"}):
+            setup_logging("test", self.tmp, console=False)
+        get_logger("db").info("hidden")
+        get_logger("db").warning("shown")
+        get_logger("ocr_utils").debug("debug shown")
+        self.assertEqual([r["msg"] for r in self._records()], ["shown", "debug shown"])
+        get_logger("db").setLevel("NOTSET")
+        get_logger("ocr_utils").setLevel("NOTSET")
+
+    def test_setting_changes_apply_to_a_running_setup(self):
+        setup_logging("test", self.tmp, console=False)
+        try:
+            log_utils._load_settings({"max_bytes": 1000, "levels": {"db": "WARNING"}})
+            listener = log_utils._listener
+            self.assertEqual(listener.handlers[0].maxBytes, 1000)
+            log_utils._load_settings({"max_bytes": 1000, "levels": {"db": "ERROR"}})
+            self.assertIs(log_utils._listener, listener)  # levels only: no rebuild
+            self.assertEqual(get_logger("db").level, logging.ERROR)
+        finally:
+            log_utils._load_settings(settings.section("logging"))
+            get_logger("db").setLevel("NOTSET")
+
+    def test_request_and_job_ids(self):
+        setup_logging("test", self.tmp, console=False)
+        logger = get_logger("app")
+
+        @with_request_id
+        def handler():
+            logger.info("plain")
+            return log_utils.request_id.get()
+
+        @with_request_id
+        def streaming():
+            for i in range(2):
+                logger.info("step %d", i)
+                yield log_utils.request_id.get()
+
+        rid = handler()
+        self.assertTrue(inspect.isgeneratorfunction(streaming))
+        step_ids = list(streaming())
+        self.assertIsNone(log_utils.request_id.get())
+        with correlation(job="scan:7"):
+            logger.info("in job")
+        records = self._records()
+        self.assertEqual(records[0]["request_id"], rid)
+        self.assertEqual({r["request_id"] for r in records[1:3]}, set(step_ids))
+        self.assertEqual(len(set(step_ids)), 1)
+        self.assertNotEqual(step_ids[0], rid)
+        self.assertEqual(records[3]["job_id"], "scan:7")
+
+    def test_queued_jobs_remember_the_request(self):
+        Base.metadata.create_all(engine)
+        try:
+            with correlation(request="req123"):
+                job_id = enqueue("index", {"images": []})
+            self.assertEqual(get_job(job_id)["payload"], {"images": [], "_request_id": "req123"})
+            self.assertEqual(get_job(enqueue("index", {}))["payload"], {})
+        finally:
+            Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    unittest.main()
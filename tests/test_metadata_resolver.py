@@ -0,0 +1,125 @@
+"""Tests for the tiered metadata resolver."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metadata_resolver  # noqa: E402
+from metadata_resolver import resolve_many, resolver_stats, reset_resolver_stats  # noqa: E402
+from ai_utils import validate_metadata  # noqa: E402
+from image_utils import get_file_hash  # noqa: E402
+from db import Session, Stamp, Base, engine  # noqa: E402
+
+
+def _stamp_image(path, colour, size=(300, 360)):
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((30, 30, size[0] - 30, size[1] - 30), fill=colour)
+    draw.ellipse((80, 90, 220, 250), fill="white")
+    img.save(path, quality=95)
+
+
+class TestTieredResolver(unittest.TestCase):
+    """Each tier answers only what the cheaper tiers could not."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        reset_resolver_stats()
+        self.tmp = tempfile.mkdtemp()
+        self.catalogued = os.path.join(self.tmp, "catalogued.jpg")
+        _stamp_image(self.catalogued, (150, 20, 30))
+        session = Session()
+        session.add(Stamp(
+            image_path=self.catalogued,
+            file_hash=get_file_hash(self.catalogued),
+            country="Canada", denomination="5c", year="1967",
+        ))
+        session.commit()
+        session.close()
+        metadata_resolver.backfill_signatures()  # done by the workers' startup job
+        # No OCR engine and no model server in tests.
+        self.ocr = patch.object(metadata_resolver, "ocr_images", return_value={})
+        self.vision = patch.object(
+            metadata_resolver, "generate_metadata",
+            return_value=validate_metadata({
+                "country": "France", "year": "1960", "denomination": "20c",
+                "stamp_name": "Marianne", "mint_used": "Used",
+            }),
+        )
+        self.ocr.start()
+        self.describe = self.vision.start()
+
+    def tearDown(self):
+        self.ocr.stop()
+        self.vision.stop()
+        shutil.rmtree(self.tmp)
+        Base.metadata.drop_all(engine)
+
+    def test_tiers_in_order(self):
+        copy = os.path.join(self.tmp, "copy.jpg")
+        shutil.copy(self.catalogued, copy)
+        rescan = os.path.join(self.tmp, "rescan.jpg")
+        Image.open(self.catalogued).resize((250, 300)).save(rescan, quality=70)
+        named = os.path.join(self.tmp, "Peru_1950_10c.jpg")
+        _stamp_image(named, (20, 120, 40), size=(360, 300))
+        unknown = os.path.join(self.tmp, "IMG_0001.jpg")
+        _stamp_image(unknown, (20, 40, 160), size=(200, 420))
+
+        results = resolve_many([copy, rescan, named, unknown])
+
+        self.assertEqual(results[copy]["tier"], "hash")
+        self.assertEqual(results[copy]["confidence"], 1.0)
+        self.assertEqual(results[rescan]["tier"], "phash")
+        self.assertEqual(results[rescan]["country"], "Canada")
+        self.assertEqual(results[named]["tier"], "vision")  # file name alone is 0.6
+        self.assertEqual(results[unknown]["tier"], "vision")
+        self.assertEqual(results[unknown]["country"], "France")
+        self.assertEqual(results[unknown]["stamp_name"], "Marianne")
+        self.assertEqual(results[unknown]["mint_used"], "Used")
+        self.assertEqual(self.describe.call_count, 2)
+
+        stats = resolver_stats()
+        self.assertEqual(stats["hash"], {"attempts": 4, "resolved": 1})
+        self.assertEqual(stats["phash"], {"attempts": 3, "resolved": 1})
+        self.assertEqual(stats["vision"]["attempts"], 2)
+
+    def test_confident_text_skips_vision(self):
+        path = os.path.join(self.tmp, "IMG_0002.jpg")
+        _stamp_image(path, (20, 40, 160), size=(200, 420))
+        with patch.object(metadata_resolver, "ocr_images",
+                          return_value={path: "CANADA POSTAGE 1967 5c"}):
+            result = resolve_many([path])[path]
+        self.assertEqual(result["tier"], "text")
+        self.assertEqual((result["country"], result["denomination"]), ("Canada", "5c"))
+        self.describe.assert_not_called()
+
+    def test_catalogue_hashes_are_cached_until_a_write(self):
+        ids, _ = metadata_resolver.catalogue_phashes()
+        self.assertIs(metadata_resolver.catalogue_phashes()[0], ids)
+        other = os.path.join(self.tmp, "other.jpg")
+        _stamp_image(other, (20, 120, 40))
+        session = Session()
+        session.add(Stamp(image_path=other, file_hash=get_file_hash(other), country="Peru"))
+        session.commit()
+        session.close()
+        metadata_resolver.backfill_signatures()
+        self.assertEqual(len(metadata_resolver.catalogue_phashes()[0]), 2)
+
+    def test_empty_answers_are_not_counted_as_resolved(self):
+        path = os.path.join(self.tmp, "IMG_0003.jpg")
+        _stamp_image(path, (20, 40, 160), size=(200, 420))
+        self.describe.return_value = validate_metadata({})
+        result = resolve_many([path])[path]
+        self.assertEqual((result["tier"], result["confidence"]), ("vision", 0.0))
+        self.assertEqual(resolver_stats()["vision"], {"attempts": 1, "resolved": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
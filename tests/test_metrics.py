@@ -0,0 +1,114 @@
+"""Tests for timing histograms, counters and the /metrics endpoint."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+from metrics import (  # noqa: E402
+    collect, incr, merge, observe, quantile, render_prometheus, reset_metrics,
+    serve_metrics, snapshot, summary, timed, write_snapshot,
+)
+from image_utils import get_file_hash  # noqa: E402
+from db import Session, Stamp, Base, engine  # noqa: E402
+
+
+class TestMetrics(unittest.TestCase):
+    """Recording, merging across processes and exposition."""
+
+    def setUp(self):
+        reset_metrics()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        reset_metrics()
+        shutil.rmtree(self.tmp)
+
+    def test_timers_counters_and_quantiles(self):
+        for ms in [1.5] * 90 + [40] * 5 + [900] * 5:
+            observe("stage", ms)
+        with timed("block"):
+            pass
+        with self.assertRaises(RuntimeError):
+            with timed("block"):
+                raise RuntimeError("boom")
+        incr("resolver_resolved", tier="hash")
+        row = {r["stage"]: r for r in summary(snapshot())}
+        self.assertEqual((row["stage"]["count"], row["block"]["count"]), (100, 2))
+        self.assertTrue(1 <= row["stage"]["p50_ms"] <= 2.5)
+        self.assertTrue(25 <= row["stage"]["p95_ms"] <= 50)
+        self.assertTrue(500 <= row["stage"]["p99_ms"] <= 1000)
+        counters = snapshot()["counters"]
+        self.assertEqual(counters["errors{stage=block}"], 1)
+        self.assertEqual(counters["resolver_resolved{tier=hash}"], 1)
+        self.assertEqual(quantile([0.0] * (len(metrics.BUCKETS_MS) + 1), 0.5), 0.0)
+
+    def test_instrumented_code_and_database(self):
+        Base.metadata.create_all(engine)
+        try:
+            get_file_hash(os.path.abspath(__file__))
+            session = Session()
+            session.query(Stamp).count()
+            session.close()
+        finally:
+            Base.metadata.drop_all(engine)
+        stages = snapshot()["histograms"]
+        self.assertIn("hash_file", stages)
+        self.assertIn("db_query", stages)
+
+    def test_worker_snapshots_are_merged(self):
+        observe("hash_file", 3)
+        other = {"histograms": {"hash_file": snapshot()["histograms"]["hash_file"]},
+                 "counters": {"errors{stage=x}": 2}}
+        with patch("os.getpid", return_value=999999):
+            reset_metrics()
+            observe("hash_file", 3)
+            incr("errors", 2, stage="x")
+            write_snapshot(self.tmp)
+        reset_metrics()
+        observe("hash_file", 3)
+        total = collect(self.tmp)
+        self.assertEqual(total, merge(snapshot(), other))
+        self.assertEqual(summary(total)[0]["count"], 2)
+
+    def test_prometheus_endpoint(self):
+        observe("export_csv", 12)
+        incr("errors", stage="export_csv")
+        text = render_prometheus(snapshot())
+        self.assertIn('stampd_stage_duration_seconds_bucket{stage="export_csv",le="0.025"} 1', text)
+        self.assertIn('stampd_stage_duration_seconds_count{stage="export_csv"} 1', text)
+        self.assertIn('stampd_errors_total{stage="export_csv"} 1', text)
+
+        with patch.object(metrics, "SNAPSHOT_DIR", self.tmp):
+            server = serve_metrics(port=0)
+            try:
+                url = f"http://127.0.0.1:{server.server_address[1]}"
+                self.assertIn("export_csv", requests.get(url + "/metrics", timeout=5).text)
+                self.assertEqual(requests.get(url + "/other", timeout=5).status_code, 404)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_disabled_metrics_cost_nothing(self):
+        def fn():
+            return 1
+
+        wrapped = timed("x")(fn)
+        with patch.object(metrics, "ENABLED", False):
+            self.assertEqual(wrapped(), 1)  # checked per call, not when decorated
+            with timed("x"):
+                observe("y", 1)
+                incr("z")
+            self.assertIsNone(serve_metrics(port=0))
+        self.assertEqual(snapshot(), {"histograms": {}, "counters": {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
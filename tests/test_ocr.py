@@ -0,0 +1,118 @@
+"""Tests for OCR preprocessing, the OCR cache and the OCR text parser."""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr_utils  # noqa: E402
+from ocr_utils import OcrResult, ocr_images, otsu_threshold, preprocess_for_ocr  # noqa: E402
+from parsing_utils import parse_ocr_text  # noqa: E402
+from db import Session, Base, engine  # noqa: E402
+
+
+def _label(path, fg, bg):
+    img = Image.new("RGB", (300, 200), bg)
+    ImageDraw.Draw(img).text((40, 80), "CANADA 5c", fill=fg)
+    img.save(path)
+
+
+class TestPreprocess(unittest.TestCase):
+    """Binarization, polarity and upscaling before Tesseract."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_otsu_splits_bimodal_histogram(self):
+        gray = np.array([20] * 50 + [220] * 50, dtype=np.uint8)
+        self.assertTrue(20 <= otsu_threshold(gray) < 220)
+
+    def test_output_is_upscaled_dark_text_on_white(self):
+        for name, fg, bg in (("dark.png", "black", "white"), ("light.png", "white", "navy")):
+            path = os.path.join(self.tmp.name, name)
+            _label(path, fg, bg)
+            img = preprocess_for_ocr(path)
+            arr = np.asarray(img)
+            trimmed = 200 - 2 * int(200 * ocr_utils.OCR_BORDER_INSET)
+            self.assertEqual(img.size[1], round(trimmed * ocr_utils.OCR_MAX_UPSCALE))
+            self.assertEqual(set(np.unique(arr)), {0, 255})
+            self.assertGreater((arr == 255).mean(), 0.5)
+
+
+class TestOcrCache(unittest.TestCase):
+    """Tesseract runs once per distinct file content."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = [os.path.join(self.tmp.name, n) for n in ("a.png", "b.png", "c.png")]
+        _label(self.paths[0], "black", "white")
+        _label(self.paths[1], "black", "white")  # same content as a.png
+        _label(self.paths[2], "white", "black")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        Base.metadata.drop_all(engine)
+
+    @patch.object(ocr_utils, "ocr_available", return_value=True)
+    def test_results_are_cached_by_hash(self, _available):
+        with patch.object(ocr_utils, "_ocr_worker", side_effect=lambda p: "CANADA 5c") as worker:
+            texts = ocr_images(self.paths, workers=1)
+            self.assertEqual(worker.call_count, 2)
+            self.assertEqual(set(texts.values()), {"CANADA 5c"})
+            ocr_images(self.paths, workers=1)
+            self.assertEqual(worker.call_count, 2)
+        session = Session()
+        self.assertEqual(session.query(OcrResult).count(), 2)
+        session.close()
+
+    @patch.object(ocr_utils, "ocr_available", return_value=True)
+    def test_failures_are_not_cached(self, _available):
+        with patch.object(ocr_utils, "_ocr_worker", side_effect=RuntimeError("bad")):
+            self.assertEqual(ocr_images(self.paths[:1], workers=1), {self.paths[0]: ""})
+        session = Session()
+        self.assertEqual(session.query(OcrResult).count(), 0)
+        session.close()
+
+
+class TestOcrPool(unittest.TestCase):
+    """One pool of OCR processes is kept between batches."""
+
+    def tearDown(self):
+        ocr_utils.shutdown_pool()
+
+    def test_pool_is_reused_and_resized(self):
+        pool = ocr_utils._get_pool(2)
+        self.assertIs(ocr_utils._get_pool(2), pool)
+        self.assertNotEqual(pool.submit(os.getpid).result(timeout=60), os.getpid())
+        resized = ocr_utils._get_pool(3)
+        self.assertIsNot(resized, pool)
+        ocr_utils.shutdown_pool(pool)  # already replaced: nothing to do
+        self.assertIs(ocr_utils._get_pool(3), resized)
+        ocr_utils.shutdown_pool()
+        self.assertIsNone(ocr_utils._pool)
+
+
+class TestParseOcrText(unittest.TestCase):
+    """Stamp lettering is reduced to year, country and denomination."""
+
+    def test_noise_words_and_symbols(self):
+        self.assertEqual(
+            parse_ocr_text("UNITED STATES POSTAGE\n| 3 CENTS ."),
+            ("", "United States", "3 CENTS"),
+        )
+        self.assertEqual(parse_ocr_text("CANADA 1967 5¢"), ("1967", "Canada", "5c"))
+        self.assertEqual(parse_ocr_text(""), ("", "", ""))
+
+
+if __name__ == '__main__':
+    unittest.main()
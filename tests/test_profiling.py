@@ -0,0 +1,101 @@
+"""Tests for opt-in profiling of slow handlers."""
+
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import profiling  # noqa: E402
+from profiling import format_profile, list_profiles, profiled, request_profile, top_functions  # noqa: E402
+
+
+def busy(ms):
+    deadline = time.perf_counter() + ms / 1000
+    while time.perf_counter() < deadline:
+        sum(range(200))
+
+
+@profiled()
+def slow_handler(ms, label="x"):
+    busy(ms)
+    return label
+
+
+@profiled("streaming")
+def slow_stream(steps):
+    for i in range(steps):
+        busy(30)
+        yield i
+
+
+@profiled()
+def outer_handler():
+    return slow_handler(60)
+
+
+class TestProfiling(unittest.TestCase):
+    """Threshold and on-request capture, saving and the viewer."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.patches = [
+            patch.object(profiling, "PROFILE_DIR", self.tmp),
+            patch.object(profiling, "PROFILING_ENABLED", True),
+            patch.object(profiling, "THRESHOLD_MS", 50),
+            patch.object(profiling, "_requested", 0),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_only_slow_calls_are_saved(self):
+        self.assertEqual(slow_handler(1), "x")
+        self.assertEqual(list_profiles(self.tmp), [])
+        self.assertEqual(slow_handler(120, label="gallery"), "gallery")
+        [path] = list_profiles(self.tmp)
+        record = profiling.load_profile(path)
+        self.assertEqual(record["handler"], "slow_handler")
+        self.assertGreaterEqual(record["elapsed_ms"], 120)
+        self.assertEqual(record["params"]["kwargs"], {"label": "'gallery'"})
+        self.assertTrue(any("busy" in row["function"] for row in top_functions(path, 5)))
+        self.assertIn("slow_handler took", format_profile(path))
+
+    def test_requested_profile_ignores_threshold_and_switch(self):
+        with patch.object(profiling, "PROFILING_ENABLED", False):
+            slow_handler(1)
+            self.assertEqual(list_profiles(self.tmp), [])
+            self.assertEqual(request_profile(), 1)
+            slow_handler(1)
+            slow_handler(1)
+        [path] = list_profiles(self.tmp)
+        self.assertTrue(profiling.load_profile(path)["forced"])
+
+    def test_generators_stay_generators_and_cprofile_mode(self):
+        self.assertTrue(inspect.isgeneratorfunction(slow_stream))
+        with patch.object(profiling, "PROFILE_MODE", "cprofile"):
+            self.assertEqual(list(slow_stream(3)), [0, 1, 2])
+        [path] = list_profiles(self.tmp)
+        record = profiling.load_profile(path)
+        self.assertEqual((record["handler"], record["mode"]), ("streaming", "cprofile"))
+        self.assertTrue(os.path.exists(path[:-5] + ".prof"))
+        busy_row = next(row for row in record["functions"] if "(busy)" in row["function"])
+        self.assertEqual(busy_row["calls"], 3)
+
+    def test_nested_handlers_are_profiled_once(self):
+        with patch.object(profiling, "PROFILE_MODE", "cprofile"):
+            outer_handler()
+        self.assertEqual(len(list_profiles(self.tmp)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests for the gallery query cache and its write-through invalidation."""
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_cache import QueryCache, gallery_cache, normalize  # noqa: E402
+from gallery import search_stamps, add_tag  # noqa: E402
+from db import Session, Stamp, Base, engine  # noqa: E402
+
+
+class TestQueryCache(unittest.TestCase):
+    """LRU behaviour, scope invalidation and metrics of ``QueryCache``."""
+
+    def test_lru_eviction_and_hit_rate(self):
+        cache = QueryCache(maxsize=2)
+        cache.put("a", 1, {"stamps"})
+        cache.put("b", 2, {"stamps"})
+        self.assertEqual(cache.get("a"), (True, 1))
+        cache.put("c", 3, {"stamps"})
+        self.assertEqual(cache.get("b"), (False, None))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_invalidation_is_scoped(self):
+        cache = QueryCache()
+        cache.put("detail1", "x", {"stamp:1"})
+        cache.put("detail2", "y", {"stamp:2"})
+        cache.put("tagged", "z", {"stamps", "tags"})
+        self.assertEqual(cache.invalidate({"stamp:1"}), 1)
+        self.assertEqual(cache.get("detail2"), (True, "y"))
+        self.assertEqual(cache.invalidate({"tags"}), 1)
+        self.assertEqual(cache.get("tagged"), (False, None))
+
+    def test_version_change_drops_stamp_entries(self):
+        version = [1]
+        cache = QueryCache(version=lambda: version[0], check_interval=0)
+        self.assertEqual(cache.get("search"), (False, None))
+        cache.put("search", "x", {"stamps"})
+        cache.put("tag_list", "y", {"tags"})
+        self.assertEqual(cache.get("search"), (True, "x"))
+        version[0] = 2  # another process wrote
+        self.assertEqual(cache.get("search"), (False, None))
+        self.assertEqual(cache.get("tag_list"), (True, "y"))
+
+    def test_version_is_checked_at_most_once_per_interval(self):
+        reads = []
+        cache = QueryCache(version=lambda: reads.append(1) or 1, check_interval=60)
+        cache.put("search", "x", {"stamps"})
+        for _ in range(5):
+            cache.get("search")
+        self.assertEqual(len(reads), 1)
+
+    def test_normalize_ignores_order_and_empty_values(self):
+        self.assertEqual(
+            normalize({"tags": ["b", "a", "a"], "country": " USA ", "decade": ""}),
+            normalize({"country": "USA", "tags": ["a", "b"]}),
+        )
+
+
+class TestSearchCaching(unittest.TestCase):
+    """``search_stamps`` results are reused until a write hook fires."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.session = Session()
+        self.session.add_all([Stamp(id=1, country="Canada"), Stamp(id=2, country="USA")])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        Base.metadata.drop_all(engine)
+
+    def test_equivalent_queries_share_an_entry(self):
+        search_stamps("canada")
+        hits = gallery_cache.hits
+        self.assertEqual(len(search_stamps("  CANADA ")), 1)
+        self.assertEqual(gallery_cache.hits, hits + 1)
+
+    def test_add_tag_invalidates_only_tag_queries(self):
+        self.assertEqual(search_stamps("", {"tags": ["rare"]}), [])
+        search_stamps("Canada")
+        add_tag(1, "rare")
+        self.assertEqual([s.id for s in search_stamps("", {"tags": ["rare"]})], [1])
+        hits = gallery_cache.hits
+        search_stamps("Canada")
+        self.assertEqual(gallery_cache.hits, hits + 1)
+
+    def test_callers_cannot_change_cached_results(self):
+        first = search_stamps("canada")
+        first[0:0] = ["junk"]
+        with self.assertRaises(AttributeError):
+            first[1].country = "Mexico"
+        self.assertEqual([s.country for s in search_stamps("canada")], ["Canada"])
+
+    @patch.object(gallery_cache, "check_interval", 0)
+    def test_writes_outside_the_hooks_are_noticed(self):
+        self.assertEqual(len(search_stamps("Peru")), 0)
+        self.session.add(Stamp(id=3, country="Peru"))  # as a scan worker would
+        self.session.commit()
+        self.assertEqual([s.id for s in search_stamps("Peru")], [3])
+        self.session.query(Stamp).filter(Stamp.id == 3).delete()
+        self.session.commit()
+        self.assertEqual(search_stamps("Peru"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
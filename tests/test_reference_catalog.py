@@ -0,0 +1,91 @@
+"""Tests for the reference catalog store and its use in reverse lookup."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reference_catalog  # noqa: E402
+from reference_catalog import (  # noqa: E402
+    RefBase, ref_engine, import_catalog, lookup_country_year, lookup_number,
+)
+from reverse_search import reverse_lookup  # noqa: E402
+from db import Base, engine  # noqa: E402
+
+
+def _draw(path, colour, line):
+    img = Image.new("RGB", (240, 300), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((20, 20, 220, 280), fill=colour)
+    draw.line(line, fill="black", width=8)
+    img.save(path)
+
+
+class TestReferenceCatalog(unittest.TestCase):
+    """Bulk import, indexed lookups and similarity matching."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        RefBase.metadata.drop_all(ref_engine)
+        self.tmp = tempfile.mkdtemp()
+        _draw(os.path.join(self.tmp, "a.png"), (170, 30, 40), (20, 20, 220, 280))
+        _draw(os.path.join(self.tmp, "b.png"), (30, 60, 170), (220, 20, 20, 280))
+        self.csv = os.path.join(self.tmp, "scott.csv")
+        with open(self.csv, "w", encoding="utf-8") as f:
+            f.write("catalog_number,country,year,denomination,title,image\n")
+            f.write("1031,USA,1954,1c,Washington,a.png\n")
+            f.write("1035,USA,1954,3c,Statue of Liberty,b.png\n")
+            f.write(",USA,1954,,no number,\n")
+            f.write("1036,USA,1954,4c,Lincoln,missing.png\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        RefBase.metadata.drop_all(ref_engine)
+        Base.metadata.drop_all(engine)
+
+    def test_import_and_indexed_lookups(self):
+        stats = import_catalog(self.csv, catalog="Scott", workers=2)
+        self.assertEqual(stats, {"imported": 3, "skipped": 1, "missing_images": 1})
+        [ref] = lookup_number("1035", "Scott")
+        self.assertEqual((ref["title"], ref["denomination"]), ("Statue of Liberty", "3c"))
+        self.assertTrue(os.path.exists(ref["thumbnail_path"]))
+        self.assertEqual(len(lookup_country_year("USA", "1954")), 3)
+
+        # Re-import as JSON lines updates in place; missing fields are kept.
+        jsonl = os.path.join(self.tmp, "update.jsonl")
+        with open(jsonl, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"catalog": "Scott", "catalog_number": "1035",
+                                "title": "Liberty", "image": "b.png"}) + "\n")
+        import_catalog(jsonl, workers=1)
+        [ref] = lookup_number("1035")
+        self.assertEqual((ref["title"], ref["denomination"]), ("Liberty", "3c"))
+        self.assertEqual(len(lookup_country_year("USA")), 3)
+
+    def test_reverse_lookup_uses_reference_images(self):
+        import_catalog(self.csv, catalog="Scott", workers=1)
+        query = os.path.join(self.tmp, "query.jpg")
+        Image.open(os.path.join(self.tmp, "b.png")).convert("RGB").resize((200, 250)).save(query)
+        best = reverse_lookup(query)["matches"][0]
+        self.assertEqual((best["source"], best["catalog_number"]), ("reference", "1035"))
+        self.assertGreater(best["score"], 0.85)
+
+    def test_tables_are_created_once(self):
+        self.assertEqual(lookup_number("1035"), [])  # creates the dropped tables
+        with patch.object(RefBase.metadata, "create_all") as create_all:
+            lookup_number("1035")
+            lookup_country_year("USA")
+        create_all.assert_not_called()
+        self.assertTrue(reference_catalog._initialised)
+        RefBase.metadata.drop_all(ref_engine)
+        self.assertFalse(reference_catalog._initialised)
+
+
+if __name__ == '__main__':
+    unittest.main()
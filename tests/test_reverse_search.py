@@ -0,0 +1,92 @@
+"""Tests for local-first reverse image lookup."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reverse_search  # noqa: E402
+from reverse_search import reverse_lookup  # noqa: E402
+from embedding_index import sync_index  # noqa: E402
+from metadata_resolver import backfill_signatures  # noqa: E402
+from image_utils import get_file_hash  # noqa: E402
+from db import Session, Stamp, Base, engine  # noqa: E402
+
+
+def _draw(path, colour, size=(240, 300)):
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((20, 20, size[0] - 20, size[1] - 20), fill=colour)
+    draw.ellipse((60, 80, 180, 220), fill=(240, 230, 200))
+    draw.line((20, 40, size[0] - 20, 260), fill="black", width=6)
+    img.save(path, quality=95)
+
+
+class TestReverseLookup(unittest.TestCase):
+    """Local sources answer first; remote is a configured fallback."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.tmp = tempfile.mkdtemp()
+        session = Session()
+        for sid, colour in enumerate([(160, 20, 30), (20, 60, 160)], start=1):
+            path = os.path.join(self.tmp, f"{sid}.jpg")
+            _draw(path, colour)
+            session.add(Stamp(id=sid, image_path=path, file_hash=get_file_hash(path),
+                              country="Canada", year=str(1960 + sid)))
+        session.commit()
+        session.close()
+        sync_index()
+        backfill_signatures()
+        self.query = os.path.join(self.tmp, "query.jpg")
+        Image.open(os.path.join(self.tmp, "1.jpg")).resize((200, 250)).save(self.query, quality=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        Base.metadata.drop_all(engine)
+
+    def test_rescan_matches_catalogued_stamp(self):
+        result = reverse_lookup(self.query, k=2)
+        best = result["matches"][0]
+        self.assertEqual((best["source"], best["id"], best["year"]), ("collection", 1, "1961"))
+        self.assertGreaterEqual(result["confidence"], reverse_search.MIN_LOCAL_CONFIDENCE)
+        self.assertGreater(best["score"], result["matches"][1]["score"])
+        self.assertFalse(result["escalated"])
+
+    def test_remote_only_when_configured_and_unsure(self):
+        other = os.path.join(self.tmp, "other.jpg")
+        _draw(other, (30, 160, 40), size=(400, 200))
+        with patch("requests.post") as post:
+            self.assertFalse(reverse_lookup(other)["escalated"])
+            post.assert_not_called()
+            with patch.multiple(reverse_search, TINEYE_API_URL="http://tineye.test",
+                                TINEYE_API_KEY="key"):
+                post.return_value.status_code = 200
+                post.return_value.json.return_value = {"results": [{"backlink": "x"}]}
+                result = reverse_lookup(other)
+                self.assertTrue(result["escalated"])
+                self.assertEqual(result["remote"], [{"backlink": "x"}])
+                reverse_lookup(self.query)
+                self.assertEqual(post.call_count, 1)
+
+    def test_query_image_is_embedded_once(self):
+        real = reverse_search.image_embedding
+        with patch.object(reverse_search, "image_embedding", side_effect=real) as embed, \
+                patch("embedding_index.image_embedding", side_effect=AssertionError("re-read")):
+            result = reverse_lookup(self.query, k=2)
+        embed.assert_called_once_with(self.query)
+        self.assertEqual(result["matches"][0]["id"], 1)
+
+    def test_missing_image(self):
+        with self.assertRaises(ValueError):
+            reverse_lookup(os.path.join(self.tmp, "missing.jpg"))
+
+
+if __name__ == '__main__':
+    unittest.main()
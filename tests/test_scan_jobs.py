@@ -0,0 +1,200 @@
+"""Tests for resumable batch scan jobs."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan_jobs  # noqa: E402
+from scan_jobs import (  # noqa: E402
+    REVIEW_TAG, ScanItem, ScanJob, create_job, job_status, pause_job, recover_jobs, retry_failed,
+    run_job,
+)
+from db import Session, Stamp, Base, engine  # noqa: E402
+from gallery import Tag  # noqa: E402
+
+
+class FakeResolver:
+    """Records which images were sent for inference; can fail some once."""
+
+    def __init__(self, fail_once=(), confidence=None):
+        self.calls = []
+        self.fail_once = set(fail_once)
+        self.confidence = confidence or {}
+
+    def __call__(self, paths, priority=None):
+        paths = list(paths)
+        self.calls.extend(paths)
+        for path in paths:
+            name = os.path.basename(path)
+            if name in self.fail_once:
+                self.fail_once.discard(name)
+                raise RuntimeError("model timed out")
+        return {
+            path: {
+                "tier": "vision", "confidence": self.confidence.get(os.path.basename(path), 0.8),
+                "country": "Peru", "denomination": "5c",
+                "year": "1950", "description": "Peru 1950 5c",
+                **{field: "" for field in scan_jobs.DETAIL_FIELDS},
+            }
+            for path in paths
+        }
+
+
+class TestScanJobs(unittest.TestCase):
+    """Checkpointed progress, pause/resume, retries and crash recovery."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.tmp = tempfile.mkdtemp()
+        self.paths = []
+        for i, colour in enumerate(["red", "green", "blue", "red"]):
+            path = os.path.join(self.tmp, f"{i}_{colour}.png")
+            Image.new("RGB", (60, 80), colour).save(path)
+            self.paths.append(path)
+        self.patches = [
+            patch.object(scan_jobs, "JOBS_DIR", os.path.join(self.tmp, "jobs")),
+            patch.object(scan_jobs, "SCAN_CHUNK_SIZE", 1),
+            patch.object(scan_jobs, "add_to_index", return_value=0),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmp)
+        Base.metadata.drop_all(engine)
+
+    def _stamp_count(self):
+        session = Session()
+        try:
+            return session.query(Stamp).count()
+        finally:
+            session.close()
+
+    def test_runs_to_completion_and_skips_duplicates(self):
+        job_id = create_job(self.paths)
+        with patch.object(scan_jobs, "resolve_many", FakeResolver()):
+            updates = list(run_job(job_id))
+        self.assertEqual(len(updates), 5)
+        status = job_status(job_id)
+        self.assertEqual(status["status"], "completed")
+        self.assertEqual(status["counts"]["done"], 3)
+        self.assertEqual(status["counts"]["duplicate"], 1)  # same red image twice
+        self.assertEqual(self._stamp_count(), 3)
+        # The job works on its own copies, not the uploads.
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.assertEqual(list(run_job(job_id))[-1]["status"], "completed")
+
+    def test_resume_after_the_runner_goes_away(self):
+        job_id = create_job(self.paths)
+        resolver = FakeResolver()
+        with patch.object(scan_jobs, "resolve_many", resolver):
+            runner = run_job(job_id)
+            next(runner)
+            runner.close()  # browser tab closed
+            self.assertEqual(job_status(job_id)["status"], "paused")
+            self.assertEqual(self._stamp_count(), 1)
+
+            list(run_job(job_id))
+        self.assertEqual(len(resolver.calls), 4)  # nothing inferred twice
+        self.assertEqual(job_status(job_id)["status"], "completed")
+
+    def test_pause_and_crash_recovery(self):
+        job_id = create_job(self.paths)
+        with patch.object(scan_jobs, "resolve_many", FakeResolver()):
+            runner = run_job(job_id)
+            next(runner)
+            self.assertTrue(pause_job(job_id))
+            self.assertEqual(list(runner)[-1]["status"], "paused")
+
+        # Simulate a process killed mid-chunk: first while its lease is
+        # still live, then after it ran out.
+        session = Session()
+        item = session.query(ScanItem).filter_by(job_id=job_id, status="pending").first()
+        item.status = "running"
+        job = session.get(ScanJob, job_id)
+        job.status, job.runner = "running", "dead"
+        job.lease_expires_at = datetime.utcnow() + timedelta(seconds=60)
+        session.commit()
+        self.assertEqual(recover_jobs(), 0)
+        self.assertEqual(list(run_job(job_id))[-1]["counts"]["running"], 1)
+
+        job.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+        session.commit()
+        session.close()
+        self.assertEqual(recover_jobs(), 1)
+        status = job_status(job_id)
+        self.assertEqual((status["status"], status["counts"]["running"]), ("paused", 0))
+
+    def test_expired_runner_is_taken_over(self):
+        job_id = create_job(self.paths)
+        session = Session()
+        session.query(ScanItem).filter_by(job_id=job_id, position=0).update({"status": "running"})
+        session.query(ScanJob).filter_by(id=job_id).update({
+            "status": "running", "runner": "dead",
+            "lease_expires_at": datetime.utcnow() - timedelta(seconds=1),
+        })
+        session.commit()
+        session.close()
+        with patch.object(scan_jobs, "resolve_many", FakeResolver()):
+            status = list(run_job(job_id))[-1]
+        self.assertEqual((status["status"], status["counts"]["done"]), ("completed", 3))
+        session = Session()
+        job = session.get(ScanJob, job_id)
+        self.assertEqual((job.runner, job.lease_expires_at), (None, None))
+        session.close()
+
+    def test_create_job_is_idempotent_per_upload_key(self):
+        job_id = create_job(self.paths, upload_key="upload-1")
+        self.assertEqual(create_job(self.paths, upload_key="upload-1"), job_id)
+        self.assertNotEqual(create_job(self.paths), job_id)
+        self.assertEqual(job_status(job_id)["total"], 4)
+
+    def test_retry_only_failed_items(self):
+        job_id = create_job(self.paths)
+        resolver = FakeResolver(fail_once={"00001_1_green.png"})
+        with patch.object(scan_jobs, "resolve_many", resolver):
+            list(run_job(job_id))
+            status = job_status(job_id)
+            self.assertEqual(status["counts"]["failed"], 1)
+            self.assertIn("model timed out", status["errors"][0][1])
+
+            self.assertEqual(retry_failed(job_id), 1)
+            list(run_job(job_id))
+        self.assertEqual(job_status(job_id)["counts"]["failed"], 0)
+        self.assertEqual(len(resolver.calls), 5)
+        self.assertEqual(self._stamp_count(), 3)
+
+    def test_unsure_answers_are_saved_for_review(self):
+        job_id = create_job(self.paths[:3])
+        resolver = FakeResolver(confidence={"00000_0_red.png": 0.0, "00001_1_green.png": 0.35})
+        with patch.object(scan_jobs, "resolve_many", resolver):
+            list(run_job(job_id))
+        status = job_status(job_id)
+        counts = status["counts"]
+        self.assertEqual((counts["done"], counts["review"], counts["failed"]), (1, 1, 1))
+        self.assertEqual(self._stamp_count(), 2)
+        self.assertEqual(status["errors"], [("0_red.png", "metadata could not be resolved")])
+        session = Session()
+        try:
+            tagged = session.query(Tag).filter_by(name=REVIEW_TAG).one().stamps
+            self.assertEqual([s.image_path for s in tagged], [
+                item.image_path for item in session.query(ScanItem).filter_by(status="review")
+            ])
+        finally:
+            session.close()
+        self.assertIn(f"tagged '{REVIEW_TAG}'", scan_jobs.format_job(status))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,13 +7,11 @@ to ensure that the security fixes don't break legitimate functionality.
 import os
 import sys
 import unittest
-import tempfile
-import shutil
 
 # Add the parent directory to the path to import our modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from gallery import search_stamps, add_tag, Tag
+from gallery import search_stamps, add_tag, bulk_tag, bulk_untag, tag_counts, Tag
 from db import Session, Stamp, Base, engine
 
 
@@ -148,6 +146,46 @@ class TestSearchIntegration(unittest.TestCase):
         self.assertIn("Royal Portrait", stamp_names)
         self.assertIn("Maple Leaf", stamp_names)
 
+    def test_tag_filtering_deduplicates_and_all_mode(self):
+        """Multi-tag matches return each stamp once; 'all' intersects tags."""
+        results = search_stamps("", {"tags": ["vintage", "commemorative"]})
+        self.assertEqual(sorted(r.id for r in results), [1, 2, 3])
+
+        results = search_stamps("", {"tags": ["vintage", "commemorative"], "tag_mode": "all"})
+        self.assertEqual([r.id for r in results], [1])
+
+        results = search_stamps("", {"tags": ["royal", "nature"], "tag_mode": "all"})
+        self.assertEqual(results, [])
+
+        with self.assertRaises(ValueError):
+            search_stamps("", {"tags": ["royal"], "tag_mode": "some"})
+
+    def test_add_tag_is_idempotent(self):
+        """Re-adding an existing tag does not create a duplicate link."""
+        add_tag(1, "vintage")
+        add_tag(1, "vintage")
+        self.assertIn(("vintage", 3), tag_counts())
+
+    def test_bulk_tag_and_untag(self):
+        """Bulk operations link and unlink many stamps at once."""
+        self.assertEqual(bulk_tag([1, 2, 3, 99], "sale"), 3)
+        self.assertEqual(bulk_tag([1, 2], "sale"), 0)
+        results = search_stamps("", {"tags": ["sale", "royal"], "tag_mode": "all"})
+        self.assertEqual([r.id for r in results], [3])
+
+        self.assertEqual(bulk_untag([1, 3], "sale"), 2)
+        results = search_stamps("", {"tags": ["sale"]})
+        self.assertEqual([r.id for r in results], [2])
+
+        with self.assertRaises(ValueError):
+            bulk_tag([0], "sale")
+
+    def test_tag_counts(self):
+        """Tag counts are ordered by usage and refresh after writes."""
+        self.assertEqual(tag_counts()[0], ("vintage", 3))
+        add_tag(2, "royal")
+        self.assertIn(("royal", 2), tag_counts())
+
     def test_combined_search(self):
         """Test combining text search with tag filtering."""
         # This functionality might not be implemented yet, but we test the current behavior
@@ -156,7 +194,9 @@ class TestSearchIntegration(unittest.TestCase):
         # Current implementation might not support this, so we just verify it doesn't crash
         self.assertIsInstance(results, list)
         for result in results:
-            self.assertIsInstance(result, Stamp)
+            # Read-only snapshots with the Stamp column names
+            self.assertIsInstance(result, tuple)
+            self.assertEqual(set(result._fields), set(Stamp.__table__.columns.keys()))
 
     def test_empty_search(self):
         """Test that empty search returns all stamps."""
@@ -234,5 +274,27 @@ class TestSearchIntegration(unittest.TestCase):
         self.assertEqual(len(results), 2)
 
 
+
+class TestOldTagTable(unittest.TestCase):
+    """Tag tables from before the unique index are deduplicated once."""
+
+    def setUp(self):
+        Base.metadata.drop_all(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE stamp_tags (stamp_id INTEGER, tag_id INTEGER)")
+            connection.exec_driver_sql("INSERT INTO stamp_tags VALUES (1, 1), (1, 1), (2, 1)")
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+
+    def test_create_all_dedupes_and_adds_the_unique_index(self):
+        Base.metadata.create_all(engine)
+        Base.metadata.create_all(engine)  # already migrated: no-op
+        with engine.connect() as connection:
+            rows = connection.exec_driver_sql("SELECT stamp_id, tag_id FROM stamp_tags").fetchall()
+            indexes = {row[1] for row in connection.exec_driver_sql("PRAGMA index_list(stamp_tags)")}
+        self.assertEqual(sorted(rows), [(1, 1), (2, 1)])
+        self.assertEqual(indexes, {"uq_stamp_tags", "ix_stamp_tags_tag_stamp"})
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
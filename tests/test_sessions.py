@@ -0,0 +1,72 @@
+"""Tests for the scoped session provider and the open-session leak detector."""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STAMPD_DB_PATH", os.path.join(tempfile.mkdtemp(), "test_sessions.db"))
+
+import db  # noqa: E402
+from db import Session, Stamp, Base, engine, open_sessions, session_scope  # noqa: E402
+import maintenance  # noqa: E402
+
+
+class TestSessionScope(unittest.TestCase):
+    """``session_scope`` commits, rolls back and always releases sessions."""
+
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+
+    def test_commit_and_release(self):
+        with session_scope() as session:
+            session.add(Stamp(id=1, country="USA"))
+        self.assertEqual(open_sessions(), [])
+        with session_scope(read_only=True) as session:
+            stamp = session.get(Stamp, 1)
+        # Read-only results stay usable after the scope has closed.
+        self.assertEqual(stamp.country, "USA")
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            with session_scope() as session:
+                session.add(Stamp(id=2, country="Canada"))
+                session.flush()
+                raise ValueError("boom")
+        with session_scope(read_only=True) as session:
+            self.assertIsNone(session.get(Stamp, 2))
+        self.assertEqual(open_sessions(), [])
+
+    def test_read_only_scope_refuses_writes(self):
+        with self.assertRaises(RuntimeError):
+            with session_scope(read_only=True) as session:
+                session.add(Stamp(id=3, country="Peru"))
+                session.flush()
+
+    def test_leak_detector_reports_unclosed_session(self):
+        leaked = Session()
+        leaked.query(Stamp).count()
+        leaks = open_sessions()
+        self.assertEqual(len(leaks), 1)
+        self.assertIn("test_sessions.py", leaks[0]["origin"])
+        leaked.close()
+        self.assertEqual(open_sessions(), [])
+
+    def test_maintenance_thread_reports_leaks(self):
+        leaked = Session()
+        leaked.query(Stamp).count()
+        try:
+            with patch.object(db, "LEAK_AGE", 0.0), self.assertLogs(db.logger, "WARNING") as logs:
+                self.assertIn("report_open_sessions", maintenance.run_due({}))
+        finally:
+            leaked.close()
+        self.assertIn("test_sessions.py", "\n".join(logs.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Tests for the offline Ollama and marketplace stand-in."""
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import requests
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_utils  # noqa: E402
+import valuation  # noqa: E402
+from standin_server import StandinServer, canned_listing_prices, run_load  # noqa: E402
+
+
+class TestStandinServer(unittest.TestCase):
+    """The real clients talk to the stand-in as they would to Ollama and eBay."""
+
+    def setUp(self):
+        self.server = StandinServer(latency_ms=5, tokens_per_sec=0, slots=2).start()
+        self.image = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
+        Image.new("RGB", (40, 50), "teal").save(self.image)
+
+    def tearDown(self):
+        self.server.stop()
+        os.remove(self.image)
+
+    def test_metadata_and_description_through_ai_utils(self):
+        with patch.object(ai_utils, "OLLAMA_URL", self.server.url):
+            metadata = ai_utils.generate_metadata(self.image)
+            description = ai_utils.generate_description(self.image)
+        self.assertTrue(metadata["country"] and metadata["year"])
+        self.assertEqual(metadata["format"], "Single")
+        self.assertNotIn("Stamp from", description)
+
+    def test_non_streaming_generate(self):
+        resp = requests.post(f"{self.server.url}/api/generate",
+                             json={"prompt": "hi", "stream": False, "format": "json"}, timeout=5)
+        body = resp.json()
+        self.assertTrue(body["done"])
+        self.assertIn("country", ai_utils.repair_json(body["response"]))
+
+    def test_marketplace_prices_feed_valuation(self):
+        prices = canned_listing_prices("canada 1967")
+        with patch.object(valuation, "MARKETPLACE_URL", self.server.url):
+            value = valuation.get_valuation("canada 1967")
+        self.assertAlmostEqual(value, sum(prices) / len(prices), places=2)
+
+    def test_slots_bound_concurrency_and_errors_are_injected(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(requests.post(
+                f"{self.server.url}/api/generate", json={"prompt": "x"}, timeout=5
+            ).status_code))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = self.server.stats()
+        self.assertEqual((results, stats["generate"]), ([200] * 5, 5))
+        self.assertLessEqual(stats["max_in_flight"], 2)
+
+        with StandinServer(latency_ms=0, error_rate=1.0) as failing:
+            with patch.object(ai_utils, "OLLAMA_URL", failing.url):
+                self.assertEqual(ai_utils.generate_metadata(self.image)["country"], "")
+            self.assertEqual(failing.stats()["errors"], 1)
+        with self.assertRaises(ValueError):
+            StandinServer(slots=0)
+
+    def test_load_run_restores_client_settings(self):
+        result = run_load(self.server.url, "metadata", requests_total=6, concurrency=3, client_slots=2)
+        self.assertEqual((result["ok"], result["requests"]), (6, 6))
+        self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+        self.assertNotEqual(ai_utils.OLLAMA_URL, self.server.url)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,18 @@
-import requests
-from bs4 import BeautifulSoup
+import os
 
+from metrics import timed
 
+# Point at a stand-in (see standin_server.py) to test without eBay.
+MARKETPLACE_URL = os.getenv("MARKETPLACE_URL", "https://www.ebay.com")
+
+
+@timed("marketplace_scrape")
 def get_valuation(stamp_desc):
+    import requests
+    from bs4 import BeautifulSoup
+
     url = (
-        f"https://www.ebay.com/sch/i.html?_nkw={stamp_desc}&_sop=13&LH_Sold=1"
+        f"{MARKETPLACE_URL}/sch/i.html?_nkw={stamp_desc}&_sop=13&LH_Sold=1"
     )
     resp = requests.get(url, headers={"User-Agent": "Mozilla/5.0"})
     soup = BeautifulSoup(resp.text, "html.parser")
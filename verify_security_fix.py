@@ -104,7 +104,7 @@ def test_sql_injection_prevention():
             
             # Verify results are legitimate
             for result in results:
-                if not isinstance(result, Stamp):
+                if getattr(result, "_fields", None) is None or "country" not in result._fields:
                     print(f"  ❌ ERROR: Non-stamp object returned: {type(result)}")
                     return False
                     
@@ -0,0 +1,327 @@
+"""Out-of-process workers for Stamp'd.
+
+Heavy work -- hashing, Pillow processing, model calls and the database
+writes that follow -- runs in worker processes that consume
+:mod:`job_queue`, so a large upload never competes with the web server for
+its interpreter.  Each job type gets its own processes (``workers.counts``
+in ``config.json``)::
+
+    python worker_pool.py          # run the pool until Ctrl-C / SIGTERM
+
+``app.py`` starts a pool itself unless ``workers.autostart`` is false.
+
+Shutdown is graceful: workers finish or checkpoint their current job (scan
+jobs pause after the current chunk) and hand it back to the queue.  A
+worker that crashes stops renewing its lease; the job is then recovered by
+:func:`job_queue.recover_expired` and the process is restarted.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from config import settings
+from db import DB_PATH
+import job_queue
+import metrics
+from log_utils import correlation, get_logger, setup_logging
+
+logger = get_logger("worker_pool")
+
+
+@settings.bind("workers")
+def _load_settings(section: Dict[str, Any]) -> None:
+    global WORKER_COUNTS, AUTOSTART, POLL_INTERVAL, SHUTDOWN_TIMEOUT
+    # Counts and autostart are read when a pool starts: restart to apply.
+    WORKER_COUNTS = section.get("counts", {"preview": 1, "scan": 1, "index": 1})
+    AUTOSTART = section.get("autostart", True)
+    POLL_INTERVAL = section.get("poll_interval", 0.5)
+    SHUTDOWN_TIMEOUT = section.get("shutdown_timeout", 30)
+
+
+# How often the pool restarts dead workers and recovers their jobs.
+SUPERVISE_INTERVAL = 5
+
+# job type -> fn(payload, stop, report); *stop* is set on shutdown and
+# ``report(dict)`` publishes progress for pollers.  The return value must
+# be JSON-serialisable.  A handler that stops early because of *stop*
+# raises JobInterrupted; its job is then released for the next start
+# rather than completed.
+Handler = Callable[[Dict[str, Any], threading.Event, Callable[[Dict[str, Any]], None]], Any]
+HANDLERS: Dict[str, Handler] = {}
+
+
+class JobInterrupted(Exception):
+    """Raised by a handler that stopped before finishing its job."""
+
+
+def register_handler(job_type: str, fn: Handler) -> None:
+    """Register *fn* for *job_type*.  Handlers must be registered at import
+    time of this module (or one it imports) to exist in worker processes."""
+    HANDLERS[job_type] = fn
+
+
+def preview_images(
+    paths: List[str], split_sheets: bool = False, priority: Optional[str] = None,
+    report: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """Split page scans if asked, then resolve metadata for every image.
+
+    Returns ``{"images": [[image_path, source_note], ...], "resolved":
+    {image_path: metadata}}``.  Runs in ``preview`` workers, and in the app
+    itself for single-image previews.
+    """
+    from image_utils import segment_sheet
+    from metadata_resolver import resolve_many
+
+    images = []  # [image_path, source_note]
+    for path in paths:
+        segments = segment_sheet(path) if split_sheets else []
+        if not segments:
+            images.append([path, ""])
+            continue
+        name = os.path.basename(path)
+        images.extend([s["path"], f"Cut from {name} at {s['box']}"] for s in segments)
+    if report is not None:
+        report({"images": len(images)})
+    resolved = resolve_many([path for path, _ in images], priority=priority)
+    return {"images": images, "resolved": resolved}
+
+
+def _preview(payload, stop, report):
+    return preview_images(
+        payload["paths"], payload.get("split_sheets", False), payload.get("priority"), report
+    )
+
+
+def _scan(payload, stop, report):
+    """Create (from ``paths``) or continue (``job_id``) a scan job."""
+    import scan_jobs
+
+    job_id = payload.get("job_id")
+    if job_id is None:
+        if "upload_key" not in payload:
+            # Saved before any work, so a retry after a crash finds the
+            # job this attempt creates instead of making another.
+            payload["upload_key"] = uuid.uuid4().hex
+            report(None)
+        job_id = scan_jobs.create_job(
+            payload["paths"], split_sheets=payload.get("split_sheets", False),
+            upload_key=payload["upload_key"],
+        )
+        payload["job_id"] = job_id  # saved by report(): a retry continues this job
+    status = scan_jobs.job_status(job_id)
+    report(status)
+    for status in scan_jobs.run_job(job_id, cancel=stop):
+        report(status)
+    if stop.is_set() and status["status"] == "paused":
+        raise JobInterrupted(f"scan job {job_id} paused for shutdown")
+    return status
+
+
+def _index(payload, stop, report):
+    from embedding_index import add_to_index
+
+    if payload.get("sync"):
+        return _backfill(stop)
+    return add_to_index(tuple(image) for image in payload["images"])
+
+
+def _backfill(stop):
+    """Index and hash catalogued images that were missed, e.g. saved
+    while no worker ran or before an upgrade."""
+    from embedding_index import sync_index
+    from metadata_resolver import backfill_signatures
+
+    indexed = sync_index()
+    hashed = 0
+    while not stop.is_set():
+        added = backfill_signatures()
+        hashed += added
+        if not added:
+            break
+    return {"indexed": indexed, "signatures": hashed}
+
+
+register_handler("preview", _preview)
+register_handler("scan", _scan)
+register_handler("index", _index)
+
+
+def _run_one(job: Dict[str, Any], worker: str, stop: threading.Event) -> None:
+    """Run *job* while a side thread renews its lease.
+
+    ``report(progress)`` stores the progress together with the payload, so
+    handlers can record what they created (e.g. a scan job id) before a
+    crash or shutdown hands the job to another worker.
+    """
+    done = threading.Event()
+
+    def renew():
+        while not done.wait(job_queue.LEASE_SECONDS / 3):
+            if not job_queue.heartbeat(job["id"], worker):
+                logger.warning("⚠️ %s lost the lease on job %s", worker, job["id"])
+                return
+
+    def report(progress):
+        job_queue.heartbeat(job["id"], worker, progress, payload=job["payload"])
+
+    keeper = threading.Thread(target=renew, daemon=True)
+    keeper.start()
+    try:
+        with metrics.timed(f"job_{job['job_type']}"):
+            result = HANDLERS[job["job_type"]](job["payload"], stop, report)
+    except JobInterrupted:
+        job_queue.release(job["id"], worker)  # resumes on next start
+        return
+    except Exception as e:
+        logger.exception("❌ %s: job %s (%s) failed: %s", worker, job["id"], job["job_type"], e)
+        job_queue.fail(job["id"], worker, f"{type(e).__name__}: {e}")
+        return
+    finally:
+        done.set()
+        keeper.join()
+    # Finished work counts even if shutdown was asked for meanwhile.
+    job_queue.complete(job["id"], worker, result)
+
+
+def worker_main(job_types: List[str], slot: int = 0) -> None:
+    """Claim and run jobs of *job_types* until SIGTERM or SIGINT.
+
+    *slot* numbers the workers of one type, so each writes its own log.
+    """
+    from db import init_db
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    setup_logging(f"worker-{'+'.join(job_types)}-{slot}")
+    init_db()
+    metrics.start_snapshot_thread(stop)
+    settings.start_watcher()  # model and concurrency changes apply without a restart
+    worker = f"{socket.gethostname()}:{os.getpid()}:{'+'.join(job_types)}"
+    while not stop.is_set():
+        job = job_queue.claim(job_types, worker)
+        if job is None:
+            stop.wait(POLL_INTERVAL)
+            continue
+        # Records carry the job, and the request that queued it if any.
+        with correlation(request=job["payload"].get("_request_id"), job=f"{job['job_type']}:{job['id']}"):
+            _run_one(job, worker, stop)
+    if metrics.ENABLED:
+        metrics.write_snapshot()
+
+
+class WorkerPool:
+    """Starts, supervises and stops the worker processes."""
+
+    def __init__(self, counts: Optional[Dict[str, int]] = None):
+        self.counts = dict(WORKER_COUNTS if counts is None else counts)
+        self._processes: Dict[str, List[subprocess.Popen]] = {}
+        self._stopping = threading.Event()
+        self._supervisor: Optional[threading.Thread] = None
+
+    def _spawn(self, job_type: str, slot: int) -> subprocess.Popen:
+        # A fresh interpreter rather than a fork: no inherited database
+        # connections, and the web app's module is not re-imported.  The
+        # database is the one this process uses, whatever the environment
+        # says now.
+        env = dict(os.environ, STAMPD_DB_PATH=DB_PATH)
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", job_type, "--slot", str(slot)],
+            env=env,
+        )
+
+    def start(self, supervise: bool = True) -> "WorkerPool":
+        for job_type in self.counts:
+            if job_type not in HANDLERS:
+                raise ValueError(f"No handler for job type '{job_type}'")
+        job_queue.recover_expired()
+        metrics.clear_snapshots()  # numbers from an earlier pool
+        for job_type, count in self.counts.items():
+            self._processes[job_type] = [self._spawn(job_type, slot) for slot in range(count)]
+        if self.counts.get("index"):
+            # Index and hash images saved while no worker was running.
+            job_queue.enqueue("index", {"sync": True}, priority="backfill")
+        if supervise:
+            self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+            self._supervisor.start()
+        logger.info("👷 Started workers: %s", self.counts)
+        return self
+
+    def check(self) -> int:
+        """Restart workers that died and recover their jobs; return how
+        many were restarted."""
+        restarted = 0
+        for job_type, processes in self._processes.items():
+            for i, process in enumerate(processes):
+                if process.poll() is not None and not self._stopping.is_set():
+                    logger.warning(
+                        "⚠️ %s worker %s exited (%s); restarting", job_type, process.pid, process.returncode
+                    )
+                    processes[i] = self._spawn(job_type, i)
+                    restarted += 1
+        job_queue.recover_expired()
+        return restarted
+
+    def _supervise(self) -> None:
+        while not self._stopping.wait(SUPERVISE_INTERVAL):
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception("⚠️ Worker supervision failed: %s", e)
+
+    def alive(self) -> int:
+        return sum(p.poll() is None for ps in self._processes.values() for p in ps)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Ask workers to finish or checkpoint their job, then wait up to
+        *timeout* seconds (default ``SHUTDOWN_TIMEOUT``) before killing
+        stragglers (whose jobs are recovered when their lease runs out)."""
+        timeout = SHUTDOWN_TIMEOUT if timeout is None else timeout
+        self._stopping.set()
+        processes = [p for ps in self._processes.values() for p in ps]
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()  # SIGTERM: graceful in worker_main
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning("⚠️ Worker %s did not stop in time; killing it", process.pid)
+                process.kill()
+                process.wait()
+        logger.info("👷 Workers stopped")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run Stamp'd background workers")
+    parser.add_argument("--worker", metavar="JOB_TYPE", action="append",
+                        help="run a single worker for these job types (internal)")
+    parser.add_argument("--slot", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker:
+        worker_main(args.worker, args.slot)
+        return
+    setup_logging("workers")
+    pool = WorkerPool().start()
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    while not stopping.wait(1):
+        pass
+    pool.stop()
+
+
+if __name__ == "__main__":
+    main()